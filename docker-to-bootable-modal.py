@@ -3,11 +3,37 @@ import subprocess
 import os
 import tempfile
 import shutil
+import socket
 from pathlib import Path
 import logging
 import click
+import stat
 import sys
-from typing import Optional, Dict, Any
+import fcntl
+import hashlib
+import io
+import json
+import queue
+import random
+import tarfile
+import threading
+import time
+import uuid
+from typing import Optional, Dict, Any, BinaryIO, Callable, List, Union
+
+from docker2img.archive import ArchiveError, assemble_blob, cached_layers, read_archive, upload_layers, write_part
+from docker2img.aptcache import AptCache, AptCacheError, VolumeLock, restore_docker_clean, suspend_docker_clean
+from docker2img.blobcache import BlobCache
+from docker2img.bootbench import DEFAULT_READY_MARKER, boot_once, summarize
+from docker2img.diskformats import FORMAT_EXTENSIONS, data_extents, export_formats, file_sha256
+from docker2img.exportstream import stream_export
+from docker2img.fstune import DEFAULT_INODE_RATIO, estimate_fs_bytes, ext_tuning, journal_args, scan_tar, scan_tree
+from docker2img.initramfs import DEFAULT_MODULES, BundleModuleTree, InitramfsCache, InitramfsError, ModuleTree
+from docker2img.kernels import KernelBundleStore, _version_key, distro_family, parse_os_release, platform_arch
+from docker2img.profiles import PROFILES, mask_units, prune_modules, remove_firmware
+from docker2img.registry import RootfsStream, fetch_layers, layer_changes, resolve_reference
+from docker2img.tar2ext4 import Ext4Writer
+from docker2img.transfer import DEFAULT_CHUNK_SIZE, DEFAULT_CONCURRENCY, download_image, plan_ranges, read_range
 
 # Define the Modal app
 app = modal.App("docker-to-bootable-img")
@@ -18,8 +44,19 @@ docker_converter_image = (
     .apt_install([
         "docker.io",
         "qemu-utils", 
+        "qemu-system-x86",
         "extlinux", 
         "syslinux-common",
+        "syslinux",
+        "mtools",
+        "squashfs-tools",
+        "btrfs-progs",
+        "f2fs-tools",
+        "erofs-utils",
+        "busybox-static",
+        "kmod",
+        "lz4",
+        "zstd",
         "fdisk",
         "parted",
         "e2fsprogs",
@@ -35,25 +72,2209 @@ docker_converter_image = (
     .pip_install([
         "docker",
         "requests",
-        "click"
+        "click",
+        "zstandard"
     ])
+    .add_local_python_source("docker2img")
 )
 
+conversion_volume = modal.Volume.from_name("docker-conversion-volume", create_if_missing=True)
+
+# Layer blobs fetched from registries are shared across conversions through a
+# digest-keyed cache on the volume, trimmed to LAYER_CACHE_MAX_MB (LRU).
+LAYER_CACHE_DIR = "/tmp/conversion/cache/blobs"
+LAYER_CACHE_MAX_MB = 20480
+
+
+class _DockerExportSource:
+    """Rootfs stream produced by `docker export` of a created container"""
+    
+    def __init__(self, container_id: str):
+        self.container_id = container_id
+        self._cmd = ["docker", "export", container_id]
+        self._proc = None
+    
+    def open(self) -> BinaryIO:
+        self._proc = subprocess.Popen(self._cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return self._proc.stdout
+    
+    def abort(self) -> None:
+        if self._proc:
+            self._proc.kill()
+    
+    def close(self) -> None:
+        if not self._proc:
+            return
+        self._proc.stdout.close()
+        stderr = self._proc.stderr.read().decode(errors="replace")
+        if self._proc.wait() != 0:
+            raise subprocess.CalledProcessError(self._proc.returncode, self._cmd, stderr=stderr)
+
+
+class _RegistrySource:
+    """Rootfs stream flattened from layer blobs fetched without a Docker daemon"""
+    
+    def __init__(self, layer_paths):
+        self.layer_paths = layer_paths
+        self._rootfs = None
+    
+    def open(self) -> BinaryIO:
+        self._rootfs = RootfsStream(self.layer_paths)
+        return self._rootfs.stream
+    
+    def abort(self) -> None:
+        # Closing the read end makes the flattening thread stop on EPIPE
+        if self._rootfs:
+            self._rootfs.stream.close()
+    
+    def close(self) -> None:
+        if self._rootfs:
+            self._rootfs.close()
+
+
+def _export_and_extract(source, dest_dir: str) -> Dict[str, Any]:
+    """Pipe the rootfs stream straight into `tar -x` without an intermediate tar file"""
+    extract_cmd = ["tar", "-xf", "-", "-C", dest_dir]
+    stream = source.open()
+    extract_proc = subprocess.Popen(extract_cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    
+    stats = None
+    try:
+        stats = stream_export(stream, extract_proc.stdin)
+    except BrokenPipeError:
+        # tar exited early; its return code and stderr explain why
+        source.abort()
+    finally:
+        try:
+            extract_proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    
+    extract_stderr = extract_proc.stderr.read().decode(errors="replace")
+    extract_rc = extract_proc.wait()
+    source_error = None
+    try:
+        source.close()
+    except Exception as e:
+        source_error = e
+    if extract_rc != 0:
+        raise subprocess.CalledProcessError(extract_rc, extract_cmd, stderr=extract_stderr)
+    if source_error is not None:
+        raise source_error
+    return stats
+
+
+def _create_disk_image(img_path: str, size_mb: int, sparse: bool = True) -> None:
+    """Create an empty disk image, as a file full of holes unless sparse is False"""
+    if sparse:
+        with open(img_path, "wb") as img_file:
+            img_file.truncate(size_mb * 1024 * 1024)
+    else:
+        subprocess.run([
+            "dd", "if=/dev/zero", f"of={img_path}", 
+            f"bs=1M", f"count={size_mb}"
+        ], check=True, capture_output=True)
+
+
+def _file_usage(path: str) -> Dict[str, int]:
+    """Return the apparent size and the bytes actually allocated on disk for a file"""
+    st = os.stat(path)
+    return {"apparent_bytes": st.st_size, "allocated_bytes": st.st_blocks * 512}
+
+
+def _sparse_copy(src: str, dst: str, fsync: bool = False, chunk_size: int = 4 * 1024 * 1024) -> int:
+    """
+    Copy a file, reproducing its holes in the destination
+    
+    Only the data extents reported by SEEK_DATA/SEEK_HOLE are read and written,
+    and the destination is truncated to the source's apparent size, so a mostly
+    empty image stays mostly empty. Falls back to copying every byte when the
+    source filesystem does not support hole detection.
+    
+    Returns:
+        int: Number of data bytes copied
+    """
+    copied = 0
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            for offset, end in data_extents(src_fd, size):
+                while offset < end:
+                    chunk = os.pread(src_fd, min(chunk_size, end - offset), offset)
+                    if not chunk:
+                        break
+                    os.pwrite(dst_fd, chunk, offset)
+                    offset += len(chunk)
+                    copied += len(chunk)
+            os.ftruncate(dst_fd, size)
+            if fsync:
+                os.fsync(dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    shutil.copystat(src, dst)
+    return copied
+
+
+def _sparse_move(src: str, dst: str, fsync: bool = False) -> None:
+    """Move a file, falling back to a hole-preserving copy across filesystems"""
+    try:
+        os.rename(src, dst)
+    except OSError:
+        _sparse_copy(src, dst, fsync=fsync)
+        os.remove(src)
+
+
+FICLONE = 0x40049409
+
+
+def _clone_file(src: str, dst: str) -> str:
+    """
+    Copy a file as cheaply as the filesystem allows
+    
+    Tries a reflink (shared extents, copy-on-write) and falls back to a
+    hole-preserving copy. Hardlinks are not used: a later write to the
+    output would silently change the other copy too.
+    
+    Returns:
+        str: "reflink" or "copy"
+    """
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            return "reflink"
+        except OSError:
+            pass
+    _sparse_copy(src, dst)
+    return "copy"
+
+
+# Finished images are cached by (image digest, build parameters, converter
+# version). Bump CONVERTER_VERSION whenever the same inputs would produce a
+# different image. The cache is trimmed to RESULT_CACHE_MAX_MB (LRU); entries
+# used within RESULT_CACHE_MIN_AGE seconds are kept, since a concurrent job
+# may be materializing them.
+RESULT_CACHE_DIR = "/tmp/conversion/cache/results"
+RESULT_CACHE_MAX_MB = 20480
+RESULT_CACHE_MIN_AGE = 60 * 60
+CONVERTER_VERSION = 3
+
+
+def _result_cache_key(image_digest: str, params: Dict[str, Any]) -> str:
+    """Hash everything that determines the bytes of the output image"""
+    payload = {
+        "converter_version": CONVERTER_VERSION,
+        "image_digest": image_digest,
+        "params": params,
+        # Bootloader and init settings are part of the image too
+        "extlinux_conf": hashlib.sha256(EXTLINUX_CONF_TEMPLATE.encode()).hexdigest(),
+        "init_script": hashlib.sha256(BASIC_INIT_SCRIPT.encode()).hexdigest(),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _lookup_cached_result(key: str, img_paths: Dict[str, str],
+                          scratch_paths: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    """
+    Materialize the cached images at img_paths (one per output format) and
+    return their result, or None
+    
+    Each image is cloned to its scratch path first and renamed into place,
+    so a concurrent job writing the same output name never sees a partial
+    file.
+    """
+    entry_dir = os.path.join(RESULT_CACHE_DIR, key)
+    try:
+        with open(os.path.join(entry_dir, "result.json")) as f:
+            result = json.load(f)
+        methods = [
+            _clone_file(os.path.join(entry_dir, f"image.{FORMAT_EXTENSIONS[fmt]}"), scratch_paths[fmt])
+            for fmt in img_paths
+        ]
+    except (FileNotFoundError, ValueError):
+        return None
+    # Refresh the entry's LRU position (mtime rather than atime, which the
+    # volume may not track)
+    os.utime(os.path.join(entry_dir, "result.json"))
+    for fmt, img_path in img_paths.items():
+        os.replace(scratch_paths[fmt], img_path)
+    for output in result["outputs"]:
+        output["path"] = img_paths[output["format"]]
+    img_path = next(iter(img_paths.values()))
+    usage = _file_usage(img_path)
+    output_filename = os.path.basename(img_path)
+    result.update({
+        "output_file": img_path,
+        "file_size_mb": usage["apparent_bytes"] // (1024 * 1024),
+        "allocated_mb": usage["allocated_bytes"] // (1024 * 1024),
+        "layer_cache": None,
+        "result_cache": "hit",
+        "result_cache_materialized": methods[0],
+        "message": f"Reused cached conversion of {result['docker_image']} as {output_filename}"
+    })
+    return result
+
+
+def _store_cached_result(key: str, img_paths: Dict[str, str], result: Dict[str, Any]) -> None:
+    """Add finished images (one per output format) to the result cache; the entry appears atomically"""
+    os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+    entry_dir = os.path.join(RESULT_CACHE_DIR, key)
+    if os.path.exists(entry_dir):
+        return
+    staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=RESULT_CACHE_DIR)
+    try:
+        for fmt, img_path in img_paths.items():
+            _clone_file(img_path, os.path.join(staging_dir, f"image.{FORMAT_EXTENSIONS[fmt]}"))
+        with open(os.path.join(staging_dir, "result.json"), "w") as f:
+            json.dump(result, f)
+        os.rename(staging_dir, entry_dir)
+    except OSError:
+        # Best effort: another container may have stored the same key first
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def _evict_cached_results(max_bytes: int, min_age: float = RESULT_CACHE_MIN_AGE) -> Dict[str, int]:
+    """
+    Trim the result cache to max_bytes, least recently used entries first
+    
+    An entry's last use is the mtime of its result.json (set when it is
+    stored and on every hit); its size is the space its images allocate.
+    Abandoned staging directories older than min_age are removed too.
+    """
+    now = time.time()
+    entries = []
+    total = 0
+    for name in os.listdir(RESULT_CACHE_DIR) if os.path.isdir(RESULT_CACHE_DIR) else []:
+        entry_dir = os.path.join(RESULT_CACHE_DIR, name)
+        try:
+            if name.startswith(".staging-"):
+                if now - os.path.getmtime(entry_dir) >= min_age:
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            last_used = os.path.getmtime(os.path.join(entry_dir, "result.json"))
+            size = sum(_file_usage(os.path.join(entry_dir, f))["allocated_bytes"] for f in os.listdir(entry_dir))
+        except FileNotFoundError:
+            continue
+        entries.append((last_used, size, entry_dir))
+        total += size
+    
+    entries.sort()
+    evicted = 0
+    for last_used, size, entry_dir in entries:
+        if total <= max_bytes:
+            break
+        if now - last_used < min_age:
+            continue
+        # Without result.json the entry is a miss, even before it is gone
+        try:
+            os.remove(os.path.join(entry_dir, "result.json"))
+        except FileNotFoundError:
+            continue
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+        evicted += 1
+    return {"total_bytes": total, "entries": len(entries) - evicted, "evicted_entries": evicted}
+
+
+# Partition layout used by the direct (loop-device-free) assembly backend: a
+# small FAT boot partition holding SYSLINUX, kernel and initrd, followed by the
+# root filesystem. SYSLINUX can be installed into a FAT filesystem inside an
+# image file, which EXTLINUX cannot do for ext* without a mount.
+SECTOR_SIZE = 512
+PARTITION_ALIGN_SECTORS = 2048
+BOOT_PARTITION_MB = 128
+
+EXTLINUX_CONF_TEMPLATE = """SERIAL 0 115200
+DEFAULT linux
+TIMEOUT {timeout}
+PROMPT {prompt}
+
+LABEL linux
+    MENU LABEL Boot Linux
+    LINUX /vmlinuz
+    INITRD /initrd.img
+    APPEND root={root_device} rw console=tty0 console=ttyS0,115200n8{kernel_args}
+"""
+
+BASIC_INIT_SCRIPT = """#!/bin/sh
+mount -t proc proc /proc
+mount -t sysfs sysfs /sys
+mount -t devtmpfs devtmpfs /dev
+echo "Container-based Linux system booted successfully!"
+/bin/sh
+"""
+
+
+def _boot_config(root_device: str, kernel: Dict[str, Any], profile: str = "default") -> str:
+    """Render the SYSLINUX/EXTLINUX config, with any kernel arguments the distro needs"""
+    kernel_args = f" {kernel['cmdline']}" if kernel.get("cmdline") else ""
+    # boot-fast skips the 3 second boot prompt
+    timeout, prompt = (0, 0) if profile == "boot-fast" else (30, 1)
+    return EXTLINUX_CONF_TEMPLATE.format(
+        root_device=root_device, kernel_args=kernel_args, timeout=timeout, prompt=prompt
+    )
+
+
+def _scan_export(source, tar_path: Optional[str] = None) -> Dict[str, Any]:
+    """Pre-scan the export (a separate pass over the stream) for filesystem tuning"""
+    if tar_path:
+        with open(tar_path, "rb") as f:
+            return scan_tar(f)
+    stream = source.open()
+    try:
+        return scan_tar(stream)
+    except Exception:
+        source.abort()
+        raise
+    finally:
+        source.close()
+
+
+def _tuning_report(tuning: Dict[str, Any], stats: Dict[str, Any]) -> Dict[str, Any]:
+    report = {key: value for key, value in tuning.items() if key not in ("mkfs_args", "extended_options")}
+    report["scan"] = stats
+    return report
+
+
+def _extract_rootfs(
+    dest_dir: str,
+    source,
+    tar_path: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
+    """Extract the container filesystem into dest_dir, from tar_path if given, else streamed"""
+    if tar_path:
+        subprocess.run(["tar", "-xf", tar_path, "-C", dest_dir], check=True)
+        return None
+    return _export_and_extract(source, dest_dir)
+
+
+# Package downloads for the chroot install are shared through the volume (see
+# docker2img.aptcache) and trimmed to APT_CACHE_MAX_MB
+APT_CACHE_DIR = "/tmp/conversion/cache/apt"
+APT_CACHE_MAX_MB = 8192
+
+
+def _kernel_packages(family: str, arch: str) -> list:
+    # Ubuntu ships a generic meta package; Debian names it after the architecture
+    kernel = "linux-image-generic" if family == "ubuntu" else f"linux-image-{arch}"
+    return [kernel, "systemd-sysv", "extlinux", "syslinux-common"]
+
+
+def _read_os_release(root: str) -> Dict[str, str]:
+    os_release_path = _resolve_in_root(root, "etc/os-release")
+    if not os_release_path:
+        return {}
+    with open(os_release_path, errors="replace") as f:
+        return parse_os_release(f.read())
+
+
+def _install_kernel(root: str, logger: logging.Logger, arch: str = "amd64", offline: bool = False) -> bool:
+    """
+    Install a kernel into a Debian/Ubuntu-based root via chroot
+    
+    Package lists and .debs come from the shared apt cache, which is
+    bind-mounted into the chroot; only packages missing from it are
+    downloaded. With offline=True nothing is downloaded and the install
+    fails fast if the cache cannot satisfy it.
+    
+    Returns:
+        bool: True if the root looked like Debian/Ubuntu and an install was attempted
+    """
+    if not _is_debian_root(lambda path: os.path.exists(os.path.join(root, path))):
+        return False
+    
+    os_release = _read_os_release(root)
+    family = distro_family(os_release) or "debian"
+    packages = _kernel_packages(family, arch)
+    cache = AptCache(APT_CACHE_DIR, APT_CACHE_MAX_MB * 1024 * 1024)
+    key = cache.release_key(os_release, arch)
+    
+    logger.info(f"Installing kernel via apt-get in chroot (package cache {key})...")
+    mounts = [
+        ("/dev", f"{root}/dev"),
+        ("/proc", f"{root}/proc"),
+        ("/sys", f"{root}/sys"),
+        (cache.archives_dir(key), f"{root}/var/cache/apt/archives"),
+        (cache.lists_dir(key), f"{root}/var/lib/apt/lists"),
+    ]
+    mounted = []
+    stash_dir = tempfile.mkdtemp(prefix="docker2img-aptconf-")
+    suspended = suspend_docker_clean(root, stash_dir)
+    try:
+        # Set up chroot environment with the shared cache in place
+        for source, target in mounts:
+            os.makedirs(target, exist_ok=True)
+            if subprocess.run(["mount", "--bind", source, target], capture_output=True).returncode == 0:
+                mounted.append(target)
+            elif source.startswith(APT_CACHE_DIR):
+                if offline:
+                    raise AptCacheError(f"Offline install needs the package cache mounted at {target}")
+                logger.warning(f"Could not mount the package cache at {target}; downloading uncached")
+        
+        # Locking across containers is done with the cache's VolumeLock
+        env = dict(os.environ, DEBIAN_FRONTEND="noninteractive")
+        apt_get = ["chroot", root, "apt-get", "-o", "Debug::NoLocking=1", "-y"]
+        with cache.lock(key):
+            if offline:
+                if not cache.has_lists(key):
+                    raise AptCacheError(f"Offline install: no cached package lists for {key}")
+            else:
+                subprocess.run(apt_get + ["update"], env=env, check=False, capture_output=True)
+            
+            plan = subprocess.run(
+                apt_get + ["install", "-s"] + packages, env=env, capture_output=True, text=True
+            )
+            if plan.returncode != 0:
+                raise AptCacheError(f"apt-get could not plan the kernel install: {plan.stderr.strip()}")
+            files = cache.planned_files(plan.stdout)
+            if offline:
+                missing = cache.missing(key, files)
+                if missing:
+                    raise AptCacheError(
+                        f"Offline install: {len(missing)} packages not cached for {key}: "
+                        + ", ".join(missing[:10])
+                    )
+            else:
+                subprocess.run(
+                    apt_get + ["install", "--download-only"] + packages,
+                    env=env, check=False, capture_output=True
+                )
+            cache.touch(key, files)
+        
+        # Install from the cache outside the lock; the touched files are
+        # protected from eviction while this runs
+        install = subprocess.run(
+            apt_get + ["install", "--no-download"] + packages,
+            env=env, capture_output=True, text=True
+        )
+        if install.returncode != 0:
+            if offline:
+                raise AptCacheError(f"Offline kernel install failed: {install.stderr.strip()}")
+            logger.warning(f"Kernel install failed: {install.stderr.strip()}")
+    finally:
+        for target in reversed(mounted):
+            subprocess.run(["umount", target], check=False, capture_output=True)
+        restore_docker_clean(root, stash_dir, suspended)
+        shutil.rmtree(stash_dir, ignore_errors=True)
+        cache.evict()
+    return True
+
+
+# Alpine kernels come from apk (linux-virt, a few MB) with a shared package
+# cache; the initramfs is built with only the features a VM disk boot needs
+APK_CACHE_DIR = "/tmp/conversion/cache/apk"
+APK_CACHE_MAX_MB = 2048
+ALPINE_MKINITFS_FEATURES = "ata base ext4 scsi virtio"
+ALPINE_KERNEL_ARGS = "modules=sd-mod,ext4"
+APK_ARCHES = {"amd64": "x86_64", "arm64": "aarch64", "386": "x86", "arm": "armv7"}
+
+
+def _install_alpine_kernel(root: str, logger: logging.Logger, arch: str = "amd64",
+                           offline: bool = False) -> Optional[str]:
+    """
+    Install linux-virt and a minimal initramfs into an Alpine root via chroot apk
+    
+    Packages and indexes are cached on the volume per Alpine release and
+    architecture. With offline=True apk runs with --no-network and a missing
+    package fails the conversion.
+    
+    Returns:
+        str: The installed kernel version, or None if the install failed
+    """
+    with open(os.path.join(root, "etc", "alpine-release")) as f:
+        release = ".".join(f.read().strip().split(".")[:2])
+    cache = AptCache(APK_CACHE_DIR, APK_CACHE_MAX_MB * 1024 * 1024, package_suffix=".apk")
+    key = f"alpine-v{release}-{APK_ARCHES.get(arch, arch)}"
+    
+    # mkinitfs keeps an existing config, so the initramfs stays minimal
+    mkinitfs_conf = os.path.join(root, "etc", "mkinitfs", "mkinitfs.conf")
+    if not os.path.exists(mkinitfs_conf):
+        os.makedirs(os.path.dirname(mkinitfs_conf), exist_ok=True)
+        with open(mkinitfs_conf, "w") as f:
+            f.write(f'features="{ALPINE_MKINITFS_FEATURES}"\n')
+    
+    logger.info(f"Installing kernel via apk in chroot (package cache {key})...")
+    mounts = [
+        ("/dev", f"{root}/dev"),
+        ("/proc", f"{root}/proc"),
+        ("/sys", f"{root}/sys"),
+        (cache.archives_dir(key), f"{root}/var/cache/apk"),
+    ]
+    mounted = []
+    resolv_conf = os.path.join(root, "etc", "resolv.conf")
+    resolv_backup = None
+    resolv_copied = False
+    try:
+        for source, target in mounts:
+            os.makedirs(target, exist_ok=True)
+            if subprocess.run(["mount", "--bind", source, target], capture_output=True).returncode == 0:
+                mounted.append(target)
+            elif offline and source.startswith(APK_CACHE_DIR):
+                raise AptCacheError(f"Offline install needs the package cache mounted at {target}")
+        if not offline and os.path.exists("/etc/resolv.conf"):
+            if os.path.lexists(resolv_conf):
+                resolv_backup = resolv_conf + ".docker2img"
+                os.rename(resolv_conf, resolv_backup)
+            shutil.copy("/etc/resolv.conf", resolv_conf)
+            resolv_copied = True
+        
+        # apk installs in seconds, so it runs entirely under the cache lock
+        apk_add = ["chroot", root, "apk", "add", "--cache-dir", "/var/cache/apk", "--no-progress"]
+        if offline:
+            apk_add.append("--no-network")
+        with cache.lock(key):
+            install = subprocess.run(apk_add + ["linux-virt", "mkinitfs"], capture_output=True, text=True)
+        if install.returncode != 0:
+            if offline:
+                raise AptCacheError(f"Offline apk install failed: {install.stderr.strip()}")
+            logger.warning(f"Kernel install failed: {install.stderr.strip()}")
+            return None
+    finally:
+        for target in reversed(mounted):
+            subprocess.run(["umount", target], check=False, capture_output=True)
+        if resolv_copied:
+            os.remove(resolv_conf)
+        if resolv_backup:
+            os.rename(resolv_backup, resolv_conf)
+        cache.evict()
+    
+    # The boot partition is populated from the Debian-style /vmlinuz and
+    # /initrd.img names
+    for link, target in (("vmlinuz", "boot/vmlinuz-virt"), ("initrd.img", "boot/initramfs-virt")):
+        if not os.path.lexists(os.path.join(root, link)):
+            os.symlink(target, os.path.join(root, link))
+    modules_dir = os.path.join(root, "lib", "modules")
+    versions = os.listdir(modules_dir) if os.path.isdir(modules_dir) else []
+    if not versions:
+        return None
+    # An image may already ship other module trees; the one just installed
+    # belongs to linux-virt
+    virt = [version for version in versions if version.endswith("-virt")]
+    return max(virt or versions, key=_version_key)
+
+
+# Kernels harvested from earlier apt installs, injected without a package
+# manager run (see docker2img.kernels)
+KERNEL_STORE_DIR = "/tmp/conversion/cache/kernels"
+
+
+def _is_debian_root(exists: Callable[[str], bool]) -> bool:
+    return exists("etc/apt/sources.list") or exists("etc/debian_version")
+
+
+def _provide_kernel(root: str, arch: str, logger: logging.Logger, offline: bool = False) -> Dict[str, Any]:
+    """
+    Give a Debian/Ubuntu root a kernel, from the bundle store when it has one
+    for the distro family and architecture, else via the chroot apt install
+    (whose result is harvested into the store for the next conversion)
+    
+    Alpine roots get linux-virt through apk instead.
+    
+    Returns:
+        dict: How the kernel was provided ("image", "bundle", "apt", "apk" or
+            "none"), its version when known and extra kernel arguments
+    """
+    if _resolve_in_root(root, "vmlinuz"):
+        return {"method": "image", "version": None}
+    if os.path.exists(os.path.join(root, "etc", "alpine-release")):
+        version = _install_alpine_kernel(root, logger, arch, offline)
+        return {"method": "apk" if version else "none", "version": version, "cmdline": ALPINE_KERNEL_ARGS}
+    if not _is_debian_root(lambda path: os.path.exists(os.path.join(root, path))):
+        return {"method": "none", "version": None}
+    
+    family = distro_family(_read_os_release(root)) or "debian"
+    
+    store = KernelBundleStore(KERNEL_STORE_DIR)
+    bundle = store.lookup(family, arch)
+    if bundle:
+        logger.info(f"Injecting prebuilt {family}/{arch} kernel {bundle['version']}...")
+        store.inject(bundle, root)
+        return {"method": "bundle", "version": bundle["version"]}
+    
+    _install_kernel(root, logger, arch, offline)
+    bundle = store.add_from_root(root, family, arch)
+    if bundle:
+        logger.info(f"Stored {family}/{arch} kernel {bundle['version']} in the bundle store")
+    return {"method": "apt", "version": bundle["version"] if bundle else None}
+
+
+# The converter's own initramfs: a static busybox and only the listed drivers
+# (see docker2img.initramfs), cached by kernel version and module set
+INITRAMFS_CACHE_DIR = "/tmp/conversion/cache/initramfs"
+BUSYBOX_PATH = "/bin/busybox"
+
+
+def _minimal_initramfs(
+    modules,
+    version: Optional[str],
+    initramfs: Optional[Dict[str, Any]],
+    arch: str,
+    logger: logging.Logger
+) -> Optional[Dict[str, Any]]:
+    """
+    Build (or fetch from the cache) a minimal initramfs for a kernel
+    
+    Args:
+        modules: ModuleTree or BundleModuleTree for the kernel
+        version: Kernel version
+        initramfs: {"compression", "modules", "strict"}, or None to keep the
+            distro's initrd
+    
+    Returns:
+        dict: The cached image path, its size, compression and whether it was
+            a cache hit; None when the distro initrd is kept
+    """
+    if initramfs is None or version is None:
+        return None
+    if APK_ARCHES.get(arch, arch) != os.uname().machine:
+        # The static busybox comes from the converter image
+        logger.warning(f"Keeping the distro initrd: cannot build a {arch} initramfs here")
+        return None
+    try:
+        info = InitramfsCache(INITRAMFS_CACHE_DIR).get_or_build(
+            modules, version, initramfs["modules"], BUSYBOX_PATH,
+            initramfs["compression"], initramfs["strict"]
+        )
+    except (InitramfsError, OSError, subprocess.CalledProcessError) as e:
+        logger.warning(f"Keeping the distro initrd: minimal initramfs failed: {e}")
+        return None
+    logger.info(
+        f"Minimal {initramfs['compression']} initramfs for {version}: {info['size_bytes']} bytes"
+        f"{' (cached)' if info['cached'] else ''}"
+    )
+    info["compression"] = initramfs["compression"]
+    return info
+
+
+def _kernel_version(root: str, kernel: Dict[str, Any]) -> Optional[str]:
+    """The provided kernel's version, or the only one under /lib/modules"""
+    if kernel.get("version"):
+        return kernel["version"]
+    modules_dir = _resolve_in_root(root, "lib/modules")
+    versions = os.listdir(modules_dir) if modules_dir and os.path.isdir(modules_dir) else []
+    return versions[0] if len(versions) == 1 else None
+
+
+def _apply_profile(root: str, version: Optional[str], profile: str, logger: logging.Logger) -> Dict[str, Any]:
+    """
+    Trim a staged root for the image profile (see docker2img.profiles)
+    
+    Returns:
+        dict: The profile name and, for boot-fast, the masked units and the
+            modules and bytes removed
+    """
+    if profile != "boot-fast":
+        return {"name": profile}
+    unit_dirs = [
+        _resolve_in_root(root, path) for path in ("lib/systemd/system", "usr/lib/systemd/system")
+    ]
+    etc_systemd = _resolve_in_root(root, "etc/systemd") or os.path.join(root, "etc", "systemd")
+    masked = mask_units(os.path.join(etc_systemd, "system"), [d for d in unit_dirs if d])
+    modules = {"removed_modules": 0, "removed_bytes": 0}
+    modules_dir = _resolve_in_root(root, f"lib/modules/{version}") if version else None
+    if modules_dir:
+        modules = prune_modules(root, modules_dir, version)
+    firmware_dir = _resolve_in_root(root, "lib/firmware")
+    firmware_bytes = remove_firmware(firmware_dir) if firmware_dir else 0
+    removed_bytes = modules["removed_bytes"] + firmware_bytes
+    logger.info(
+        f"boot-fast: masked {len(masked)} units, removed {modules['removed_modules']} modules "
+        f"and {removed_bytes // (1024 * 1024)}MB"
+    )
+    return {
+        "name": profile,
+        "pruned": True,
+        "masked_units": masked,
+        "removed_modules": modules["removed_modules"],
+        "removed_module_bytes": modules["removed_bytes"],
+        "removed_firmware_bytes": firmware_bytes,
+        "removed_bytes": removed_bytes,
+    }
+
+
+def _write_basic_init(root: str, logger: logging.Logger) -> None:
+    """Create a minimal /sbin/init when the image has no init system"""
+    if not os.path.lexists(f"{root}/sbin/init"):
+        logger.info("Creating basic init script...")
+        os.makedirs(f"{root}/sbin", exist_ok=True)
+        with open(f"{root}/sbin/init", "w") as f:
+            f.write(BASIC_INIT_SCRIPT)
+        os.chmod(f"{root}/sbin/init", 0o755)
+
+
+def _resolve_in_root(root: str, path: str) -> Optional[str]:
+    """Resolve a path inside a staged rootfs, following absolute symlinks relative to root"""
+    current = path.lstrip("/")
+    for _ in range(40):
+        candidate = os.path.join(root, current)
+        if not os.path.islink(candidate):
+            return candidate if os.path.exists(candidate) else None
+        target = os.readlink(candidate)
+        if target.startswith("/"):
+            current = target.lstrip("/")
+        else:
+            current = os.path.normpath(os.path.join(os.path.dirname(current), target))
+    return None
+
+
+# Read-only compressed root filesystems: packed from the staged rootfs, sized
+# from their content, and booted under a tmpfs overlay by the minimal initramfs
+READONLY_FILESYSTEMS = ("squashfs", "erofs")
+
+# Writable filesystems with transparent compression: files are compressed as
+# the root is populated, and the same options are passed to the kernel and
+# fstab so later writes are compressed too
+COMPRESSED_FILESYSTEMS = ("btrfs", "f2fs")
+DEFAULT_COMPRESS_LEVEL = 3
+
+# Modules the minimal initramfs needs to mount each non-ext root
+ROOT_FS_MODULES = {
+    "squashfs": ["squashfs", "overlay"],
+    "erofs": ["erofs", "overlay"],
+    "btrfs": ["btrfs"],
+    "f2fs": ["f2fs"],
+}
+
+
+def _write_at_offset(src: str, dst: str, offset: int) -> None:
+    """Copy a (sparse) filesystem image into a disk image at offset, skipping holes"""
+    src_fd = os.open(src, os.O_RDONLY)
+    dst_fd = os.open(dst, os.O_WRONLY)
+    try:
+        size = os.fstat(src_fd).st_size
+        for start, end in data_extents(src_fd, size):
+            while start < end:
+                chunk = os.pread(src_fd, min(4 * 1024 * 1024, end - start), start)
+                if not chunk:
+                    break
+                os.pwrite(dst_fd, chunk, offset + start)
+                start += len(chunk)
+    finally:
+        os.close(dst_fd)
+        os.close(src_fd)
+
+
+def _read_from_offset(src: str, offset: int, dst: str) -> None:
+    """Copy everything from offset to the end of a disk image into its own (sparse) file"""
+    src_fd = os.open(src, os.O_RDONLY)
+    dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        size = os.fstat(src_fd).st_size
+        os.ftruncate(dst_fd, size - offset)
+        for start, end in data_extents(src_fd, size):
+            start = max(start, offset)
+            while start < end:
+                chunk = os.pread(src_fd, min(4 * 1024 * 1024, end - start), start)
+                if not chunk:
+                    break
+                os.pwrite(dst_fd, chunk, start - offset)
+                start += len(chunk)
+    finally:
+        os.close(dst_fd)
+        os.close(src_fd)
+
+
+def _root_mount_options(filesystem_type: str, level: int) -> Optional[str]:
+    """Mount options that keep compression on for a compressed root"""
+    if filesystem_type == "btrfs":
+        return f"compress=zstd:{level}"
+    if filesystem_type == "f2fs":
+        return f"compress_algorithm=zstd:{level},compress_extension=*"
+    return None
+
+
+def _make_compressed_filesystem(
+    root: str,
+    fs_path: str,
+    filesystem_type: str,
+    size_bytes: int,
+    level: int,
+    logger: logging.Logger
+) -> None:
+    """
+    Create a btrfs (zstd) or f2fs (zstd) filesystem image populated from root
+    
+    btrfs-progs with `--compress` compresses while copying `--rootdir`;
+    older versions get a loop mount with compress=zstd:N and a copy instead.
+    f2fs is formatted with the compression feature and populated by
+    sload.f2fs with compression enabled.
+    """
+    with open(fs_path, "wb") as f:
+        f.truncate(size_bytes)
+    logger.info(f"Creating a zstd-compressed {filesystem_type} filesystem...")
+    if filesystem_type == "f2fs":
+        subprocess.run([
+            "mkfs.f2fs", "-q", "-f", "-O", "extra_attr,inode_checksum,sb_checksum,compression", fs_path
+        ], check=True, capture_output=True)
+        subprocess.run([
+            "sload.f2fs", "-f", root, "-t", "/", "-P", "-c", "-a", "zstd", fs_path
+        ], check=True, capture_output=True)
+        return
+    mkfs_help = subprocess.run(["mkfs.btrfs", "--help"], capture_output=True, text=True)
+    if "--compress" in mkfs_help.stdout + mkfs_help.stderr:
+        subprocess.run([
+            "mkfs.btrfs", "-q", "-f", "--rootdir", root, "--compress", f"zstd:{level}", fs_path
+        ], check=True, capture_output=True)
+        return
+    subprocess.run(["mkfs.btrfs", "-q", "-f", fs_path], check=True, capture_output=True)
+    loop_device, pooled = _attach_loop_device(fs_path)
+    mount_point = tempfile.mkdtemp(prefix="docker2img-btrfs-")
+    try:
+        subprocess.run([
+            "mount", "-o", _root_mount_options("btrfs", level), loop_device, mount_point
+        ], check=True, capture_output=True)
+        try:
+            subprocess.run(["cp", "-a", f"{root}/.", mount_point], check=True, capture_output=True)
+        finally:
+            subprocess.run(["umount", mount_point], check=False, capture_output=True)
+    finally:
+        os.rmdir(mount_point)
+        subprocess.run(["losetup", "-d", loop_device], check=False, capture_output=True)
+        if pooled:
+            _loop_pool.put(loop_device)
+
+
+def _write_root_fstab(root: str, root_device: str, filesystem_type: str, options: str) -> None:
+    """Add a root entry to /etc/fstab unless the image already has one"""
+    fstab_path = _resolve_in_root(root, "etc/fstab") or os.path.join(root, "etc", "fstab")
+    lines = []
+    if os.path.exists(fstab_path):
+        with open(fstab_path) as f:
+            lines = f.read().splitlines()
+    for line in lines:
+        fields = line.split()
+        if len(fields) > 1 and not fields[0].startswith("#") and fields[1] == "/":
+            return
+    os.makedirs(os.path.dirname(fstab_path), exist_ok=True)
+    lines.append(f"{root_device} / {filesystem_type} {options} 0 0")
+    with open(fstab_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def _tree_bytes(root: str) -> int:
+    """Apparent size of the regular files under a staged root"""
+    total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            if stat.S_ISREG(st.st_mode):
+                total += st.st_size
+    return total
+
+
+def _make_readonly_filesystem(root: str, fs_path: str, filesystem_type: str, logger: logging.Logger) -> int:
+    """
+    Pack a staged root into a SquashFS (zstd) or EROFS (lz4hc) image
+    
+    Returns:
+        int: Size of the filesystem image in bytes
+    """
+    logger.info(f"Packing the root into a read-only {filesystem_type} image...")
+    if filesystem_type == "squashfs":
+        command = [
+            "mksquashfs", root, fs_path, "-noappend", "-no-progress",
+            "-comp", "zstd", "-Xcompression-level", "15", "-b", "256K"
+        ]
+    else:
+        command = ["mkfs.erofs", "-zlz4hc,12", fs_path, root]
+    subprocess.run(command, check=True, capture_output=True)
+    return os.path.getsize(fs_path)
+
+
+def _disk_size_mb_for_root(fs_bytes: int) -> int:
+    """Smallest disk holding the alignment gap, the boot partition and the root image"""
+    mb = 1024 * 1024
+    needed = PARTITION_ALIGN_SECTORS * SECTOR_SIZE + BOOT_PARTITION_MB * mb + fs_bytes
+    # Round the root partition up to the partition alignment (1MB)
+    return -(-needed // mb) + 1
+
+
+# disk_size_mb="auto": the flattened rootfs (scanned before the build) plus a
+# kernel allowance when the image has none, filesystem overhead and headroom.
+# shrink=True also cuts the finished ext root down to its content plus
+# headroom and truncates the image to match.
+DEFAULT_SIZE_HEADROOM = 0.2
+AUTO_SIZE_KERNEL_MB = 400
+AUTO_SIZE_MIN_FREE_MB = 64
+AUTO_SIZE_JOURNAL_MB = 64
+
+
+def _auto_disk_size_mb(stats: Dict[str, Any], headroom: float) -> int:
+    """Disk size for a scanned rootfs: boot partition plus root content, overhead and headroom"""
+    mb = 1024 * 1024
+    content = estimate_fs_bytes(stats)
+    if not stats["kernels"]:
+        content += AUTO_SIZE_KERNEL_MB * mb
+    root_bytes = int(content * (1 + headroom)) + (AUTO_SIZE_MIN_FREE_MB + AUTO_SIZE_JOURNAL_MB) * mb
+    # ext_tuning keeps at least one 256-byte inode per DEFAULT_INODE_RATIO
+    # bytes of filesystem, whose tables come out of the same space
+    root_bytes = int(root_bytes / (1 - 256 / DEFAULT_INODE_RATIO))
+    return _disk_size_mb_for_root(root_bytes)
+
+
+def _shrink_image(img_path: str, partition_number: int, filesystem_type: str,
+                  headroom: float, logger: logging.Logger) -> Optional[Dict[str, int]]:
+    """
+    Shrink an ext root partition to its minimum plus headroom, then the
+    partition entry and the image file
+    
+    The root must be the last partition. resize2fs truncates image files
+    to the new filesystem size, ignoring ?offset=, so the partition is
+    shrunk as a file of its own and written back. Returns the sizes before
+    and after in MB, or None when the filesystem cannot be shrunk here.
+    """
+    if filesystem_type in READONLY_FILESYSTEMS:
+        # Already sized from content
+        return None
+    if filesystem_type not in ("ext2", "ext3", "ext4"):
+        logger.warning(f"Shrinking {filesystem_type} roots is not supported; keeping the full size")
+        return None
+    table = json.loads(subprocess.run(
+        ["sfdisk", "--json", img_path], capture_output=True, text=True, check=True
+    ).stdout)["partitiontable"]
+    partition = table["partitions"][partition_number - 1]
+    root_offset = partition["start"] * SECTOR_SIZE
+    device = f"{img_path}?offset={root_offset}"
+    before_mb = os.path.getsize(img_path) // (1024 * 1024)
+    
+    # resize2fs refuses to touch a filesystem that was not checked first
+    fsck = subprocess.run(["e2fsck", "-fy", device], capture_output=True, text=True)
+    if fsck.returncode >= 4:
+        raise subprocess.CalledProcessError(fsck.returncode, fsck.args, stderr=fsck.stderr)
+    header = subprocess.run(["dumpe2fs", "-h", device], capture_output=True, text=True, check=True).stdout
+    fields = dict(line.split(":", 1) for line in header.splitlines() if ":" in line)
+    block_size = int(fields["Block size"])
+    block_count = int(fields["Block count"])
+    minimum = int(subprocess.run(
+        ["resize2fs", "-P", device], capture_output=True, text=True, check=True
+    ).stdout.rsplit(":", 1)[1])
+    target = int(minimum * (1 + headroom)) + AUTO_SIZE_MIN_FREE_MB * 1024 * 1024 // block_size
+    if target >= block_count:
+        return {"before_mb": before_mb, "after_mb": before_mb}
+    
+    logger.info(f"Shrinking the root filesystem from {block_count} to {target} blocks...")
+    fs_path = f"{img_path}.rootfs"
+    try:
+        _read_from_offset(img_path, root_offset, fs_path)
+        subprocess.run(["resize2fs", fs_path, str(target)], check=True, capture_output=True)
+        os.truncate(img_path, root_offset)
+        _write_at_offset(fs_path, img_path, root_offset)
+    finally:
+        if os.path.exists(fs_path):
+            os.remove(fs_path)
+    mb = 1024 * 1024
+    after_bytes = -(-(root_offset + target * block_size) // mb) * mb
+    os.truncate(img_path, after_bytes)
+    subprocess.run(
+        ["sfdisk", "--no-reread", "--no-tell-kernel", "-N", str(partition_number), img_path],
+        input=f", {(after_bytes - root_offset) // SECTOR_SIZE}\n", text=True, check=True, capture_output=True
+    )
+    return {"before_mb": before_mb, "after_mb": after_bytes // mb}
+
+
+def _partition_for_direct_assembly(img_path: str, disk_size_mb: int) -> Dict[str, int]:
+    """
+    Write an MBR with a bootable FAT boot partition and a Linux root partition
+    
+    Returns:
+        dict: Byte offsets and sizes of the boot and root partitions
+    """
+    boot_start = PARTITION_ALIGN_SECTORS
+    boot_sectors = BOOT_PARTITION_MB * 1024 * 1024 // SECTOR_SIZE
+    root_start = boot_start + boot_sectors
+    total_sectors = disk_size_mb * 1024 * 1024 // SECTOR_SIZE
+    root_sectors = total_sectors - root_start
+    if root_sectors <= PARTITION_ALIGN_SECTORS:
+        raise ValueError(
+            f"Disk size {disk_size_mb}MB is too small for a {BOOT_PARTITION_MB}MB boot partition"
+        )
+    
+    layout = f"""label: dos
+start={boot_start}, size={boot_sectors}, type=c, bootable
+start={root_start}, size={root_sectors}, type=83
+"""
+    subprocess.run(
+        ["sfdisk", "--no-reread", "--no-tell-kernel", img_path],
+        input=layout, text=True, check=True, capture_output=True
+    )
+    return {
+        "boot_offset": boot_start * SECTOR_SIZE,
+        "boot_size": boot_sectors * SECTOR_SIZE,
+        "root_offset": root_start * SECTOR_SIZE,
+        "root_size": root_sectors * SECTOR_SIZE
+    }
+
+
+def _populate_boot_partition(img_path: str, offset: int, size: int, files: Dict[str, str]) -> None:
+    """Format the FAT boot partition in place and install SYSLINUX plus boot files"""
+    subprocess.run([
+        "mkfs.fat", "-n", "BOOT", "--offset", str(offset // SECTOR_SIZE),
+        img_path, str(size // 1024)
+    ], check=True, capture_output=True)
+    image_ref = f"{img_path}@@{offset}"
+    for name, source in files.items():
+        subprocess.run(
+            ["mcopy", "-o", "-i", image_ref, source, f"::/{name}"],
+            check=True, capture_output=True
+        )
+    subprocess.run([
+        "syslinux", "--install", "--offset", str(offset), img_path
+    ], check=True, capture_output=True)
+
+
+def _assemble_direct(
+    img_path: str,
+    disk_size_mb: int,
+    filesystem_type: str,
+    source,
+    tar_path: Optional[str],
+    logger: logging.Logger,
+    arch: str = "amd64",
+    offline: bool = False,
+    initramfs: Optional[Dict[str, Any]] = None,
+    profile: str = "default",
+    compress_level: int = DEFAULT_COMPRESS_LEVEL
+) -> Dict[str, Any]:
+    """
+    Assemble the bootable image without loop devices or mounts
+    
+    The export is staged in a private directory, then the root filesystem is
+    created and populated at the root partition's offset with `mke2fs -d`, and
+    the FAT boot partition is written with mtools/SYSLINUX. Nothing is mounted,
+    so concurrent conversions only share the filesystem they write to.
+    
+    Read-only filesystems (squashfs, erofs) are packed next to the image
+    first; the image is then resized to fit them, ignoring disk_size_mb.
+    btrfs and f2fs are built zstd-compressed next to the image and copied
+    into the root partition.
+    """
+    readonly = filesystem_type in READONLY_FILESYSTEMS
+    layout = None if readonly else _partition_for_direct_assembly(img_path, disk_size_mb)
+    root_fs_bytes = None
+    usage_bytes = None
+    tuning_report = None
+    staging_dir = tempfile.mkdtemp(prefix="docker2img-rootfs-")
+    try:
+        logger.info(f"Staging container filesystem in {staging_dir}...")
+        export_stats = _extract_rootfs(staging_dir, source, tar_path)
+        
+        logger.info("Installing kernel and bootloader components...")
+        kernel = _provide_kernel(staging_dir, arch, logger, offline)
+        version = _kernel_version(staging_dir, kernel)
+        # The initramfs is built before boot-fast prunes modules, so the
+        # drivers it was asked for are still there to copy
+        initramfs_info = _minimal_initramfs(
+            ModuleTree(staging_dir, version), version, initramfs, arch, logger
+        ) if version else None
+        profile_info = _apply_profile(staging_dir, version, profile, logger)
+        _write_basic_init(staging_dir, logger)
+        
+        boot_kernel = kernel
+        if readonly:
+            if not initramfs_info:
+                raise ValueError(f"A {filesystem_type} root needs the minimal initramfs to mount its overlay")
+            fs_path = f"{img_path}.rootfs"
+            root_fs_bytes = _make_readonly_filesystem(staging_dir, fs_path, filesystem_type, logger)
+            disk_size_mb = _disk_size_mb_for_root(root_fs_bytes)
+            logger.info(f"Resizing the disk image to {disk_size_mb}MB for a {root_fs_bytes} byte root")
+            os.truncate(img_path, disk_size_mb * 1024 * 1024)
+            layout = _partition_for_direct_assembly(img_path, disk_size_mb)
+            _write_at_offset(fs_path, img_path, layout["root_offset"])
+            usage_bytes = {"logical": _tree_bytes(staging_dir), "physical": root_fs_bytes}
+            os.remove(fs_path)
+            overlay_args = f"rootfstype={filesystem_type} docker2img.overlay=tmpfs"
+            boot_kernel = dict(kernel, cmdline=f"{kernel['cmdline']} {overlay_args}"
+                               if kernel.get("cmdline") else overlay_args)
+        elif filesystem_type in COMPRESSED_FILESYSTEMS:
+            options = _root_mount_options(filesystem_type, compress_level)
+            _write_root_fstab(staging_dir, "/dev/sda2", filesystem_type, options)
+            fs_path = f"{img_path}.rootfs"
+            try:
+                _make_compressed_filesystem(
+                    staging_dir, fs_path, filesystem_type, layout["root_size"], compress_level, logger
+                )
+                usage_bytes = {
+                    "logical": _tree_bytes(staging_dir),
+                    "physical": _file_usage(fs_path)["allocated_bytes"],
+                }
+                _write_at_offset(fs_path, img_path, layout["root_offset"])
+            finally:
+                if os.path.exists(fs_path):
+                    os.remove(fs_path)
+            root_args = f"rootfstype={filesystem_type} rootflags={options}"
+            boot_kernel = dict(kernel, cmdline=f"{kernel['cmdline']} {root_args}"
+                               if kernel.get("cmdline") else root_args)
+        else:
+            # The staged root already holds the kernel, so the scan is exact
+            stats = scan_tree(staging_dir)
+            tuning = ext_tuning(stats, layout["root_size"], filesystem_type, kernel_allowance=0)
+            tuning_report = _tuning_report(tuning, stats)
+            logger.info(
+                f"Creating {filesystem_type} filesystem at offset {layout['root_offset']} "
+                f"({tuning['inodes']} inodes, {tuning['block_size']}-byte blocks)..."
+            )
+            subprocess.run([
+                "mke2fs", "-q", "-F", "-t", filesystem_type, *tuning["mkfs_args"],
+                "-d", staging_dir,
+                "-E", f"offset={layout['root_offset']},{tuning['extended_options']}",
+                img_path, f"{layout['root_size'] // 1024}k"
+            ], check=True, capture_output=True)
+            if journal_args(tuning):
+                # Populated without a journal; add it now
+                subprocess.run([
+                    "tune2fs", *journal_args(tuning), f"{img_path}?offset={layout['root_offset']}"
+                ], check=True, capture_output=True)
+        
+        logger.info("Installing SYSLINUX on boot partition...")
+        config_path = os.path.join(staging_dir, ".syslinux.cfg")
+        with open(config_path, "w") as f:
+            f.write(_boot_config("/dev/sda2", boot_kernel, profile))
+        boot_files = {"syslinux.cfg": config_path}
+        for name in ("vmlinuz", "initrd.img"):
+            source = _resolve_in_root(staging_dir, name)
+            if source:
+                boot_files[name] = source
+            else:
+                logger.warning(f"No /{name} in image; boot partition will not contain it")
+        if initramfs_info:
+            boot_files["initrd.img"] = initramfs_info["path"]
+        _populate_boot_partition(img_path, layout["boot_offset"], layout["boot_size"], boot_files)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    
+    return {
+        "export_stats": export_stats, "root_partition": "/dev/sda2",
+        "kernel": kernel, "initramfs": initramfs_info, "profile": profile_info,
+        "disk_size_mb": disk_size_mb, "root_filesystem_bytes": root_fs_bytes,
+        "root_usage_bytes": usage_bytes, "filesystem_tuning": tuning_report
+    }
+
+
+def _assemble_stream(
+    img_path: str,
+    disk_size_mb: int,
+    filesystem_type: str,
+    source,
+    tar_path: Optional[str],
+    logger: logging.Logger,
+    arch: str = "amd64",
+    offline: bool = False,
+    initramfs: Optional[Dict[str, Any]] = None,
+    profile: str = "default"
+) -> Dict[str, Any]:
+    """
+    Assemble the bootable image by writing the export straight into ext4
+    
+    Uses the same partition layout as the direct backend, but the root
+    filesystem is produced by docker2img.tar2ext4 in one pass over the export:
+    no staging directory, no mkfs, no mount, and about one copy of the data on
+    disk. Debian/Ubuntu images get their kernel from the bundle store; until
+    one is stored for their family and architecture they need the direct
+    backend, since there is no directory to chroot into.
+    """
+    if filesystem_type != "ext4":
+        raise ValueError("The stream backend only writes ext4 filesystems")
+    layout = _partition_for_direct_assembly(img_path, disk_size_mb)
+    
+    logger.info(f"Writing ext4 filesystem from the export at offset {layout['root_offset']}...")
+    writer = Ext4Writer(img_path, offset=layout["root_offset"], size=layout["root_size"])
+    export_stats = None
+    if tar_path:
+        with open(tar_path, "rb", buffering=0) as source:
+            writer.add_tar_stream(source)
+    else:
+        digest = hashlib.sha256()
+        try:
+            stream = writer.add_tar_stream(source.open(), hasher=digest)
+        except Exception:
+            source.abort()
+            raise
+        finally:
+            source.close()
+        export_stats = {"bytes": stream["bytes"], "sha256": digest.hexdigest()}
+    
+    kernel = {"method": "image" if writer.exists("vmlinuz", follow_symlinks=True) else "none", "version": None}
+    # The writer has no directory listing, so only bundle kernels (whose
+    # modules are read from the bundle) get the minimal initramfs here
+    initramfs_info = None
+    if kernel["method"] == "none" and writer.exists("etc/alpine-release"):
+        logger.warning("Stream backend cannot run apk to install an Alpine kernel; use the direct backend")
+    if kernel["method"] == "none" and _is_debian_root(lambda path: writer.exists(path, follow_symlinks=True)):
+        os_release = {}
+        if writer.exists("etc/os-release", follow_symlinks=True):
+            os_release = parse_os_release(writer.read_file("etc/os-release").decode(errors="replace"))
+        family = distro_family(os_release) or "debian"
+        bundle = KernelBundleStore(KERNEL_STORE_DIR).lookup(family, arch)
+        if bundle:
+            logger.info(f"Injecting prebuilt {family}/{arch} kernel {bundle['version']}...")
+            KernelBundleStore.inject_stream(bundle, writer.add_tar_stream)
+            kernel = {"method": "bundle", "version": bundle["version"]}
+            initramfs_info = _minimal_initramfs(
+                BundleModuleTree(bundle["path"], bundle["version"]), bundle["version"],
+                initramfs, arch, logger
+            )
+        else:
+            logger.warning(
+                f"No {family}/{arch} kernel bundle stored and the stream backend cannot run "
+                "the chroot kernel install; use the direct backend once to populate the store"
+            )
+    profile_info = {"name": profile}
+    if profile == "boot-fast":
+        # Files already written cannot be removed from the stream
+        logger.warning("Stream backend cannot prune units, modules or firmware; only the boot config is trimmed")
+        profile_info["pruned"] = False
+    if not writer.exists("sbin/init"):
+        logger.info("Creating basic init script...")
+        writer.add_file("sbin/init", BASIC_INIT_SCRIPT.encode(), mode=0o755)
+    
+    boot_dir = tempfile.mkdtemp(prefix="docker2img-boot-")
+    try:
+        boot_files = {"syslinux.cfg": os.path.join(boot_dir, "syslinux.cfg")}
+        with open(boot_files["syslinux.cfg"], "w") as f:
+            f.write(_boot_config("/dev/sda2", kernel, profile))
+        for name in ("vmlinuz", "initrd.img"):
+            if writer.exists(name, follow_symlinks=True):
+                boot_files[name] = os.path.join(boot_dir, name)
+                with open(boot_files[name], "wb") as f:
+                    f.write(writer.read_file(name))
+            else:
+                logger.warning(f"No /{name} in image; boot partition will not contain it")
+        if initramfs_info:
+            boot_files["initrd.img"] = initramfs_info["path"]
+        fs_info = writer.close()
+        logger.info(
+            f"Wrote {fs_info['used_inodes']} inodes, {fs_info['used_blocks']} of "
+            f"{fs_info['blocks_count']} blocks"
+        )
+        
+        # The writer leaves the journal out so file data is laid out in one run
+        subprocess.run([
+            "tune2fs", "-O", "has_journal", f"{img_path}?offset={layout['root_offset']}"
+        ], check=True, capture_output=True)
+        
+        logger.info("Installing SYSLINUX on boot partition...")
+        _populate_boot_partition(img_path, layout["boot_offset"], layout["boot_size"], boot_files)
+    finally:
+        shutil.rmtree(boot_dir, ignore_errors=True)
+    
+    return {
+        "export_stats": export_stats, "root_partition": "/dev/sda2",
+        "kernel": kernel, "initramfs": initramfs_info, "profile": profile_info
+    }
+
+
+def _assemble_with_loop_device(
+    img_path: str,
+    filesystem_type: str,
+    source,
+    tar_path: Optional[str],
+    logger: logging.Logger,
+    work_dir: str,
+    arch: str = "amd64",
+    offline: bool = False,
+    initramfs: Optional[Dict[str, Any]] = None,
+    profile: str = "default"
+) -> Dict[str, Any]:
+    """Assemble the bootable image through a loop device and a mounted partition"""
+    # Step 6: Create partition table and filesystem
+    logger.info("Creating partition table...")
+    fdisk_commands = f"""o
+n
+p
+1
+
+
+a
+1
+w
+"""
+    subprocess.run(
+        ["fdisk", img_path], 
+        input=fdisk_commands, text=True, check=True, capture_output=True
+    )
+    
+    # Step 7: Set up loop device
+    logger.info("Setting up loop device...")
+    loop_device, pooled = _attach_loop_device(img_path)
+    partition_device = f"{loop_device}p1"
+    
+    try:
+        # Step 8: Create filesystem on partition, tuned from a pre-scan of
+        # the export (a second pass over the stream)
+        stats = _scan_export(source, tar_path)
+        partition_bytes = int(subprocess.run(
+            ["blockdev", "--getsize64", partition_device], capture_output=True, text=True, check=True
+        ).stdout)
+        tuning = ext_tuning(stats, partition_bytes, filesystem_type)
+        logger.info(
+            f"Creating {filesystem_type} filesystem ({tuning['inodes']} inodes, "
+            f"{tuning['block_size']}-byte blocks)..."
+        )
+        # mkfs discards the (empty) loop device, which keeps the image sparse
+        subprocess.run([
+            f"mkfs.{filesystem_type}", *tuning["mkfs_args"], "-E", tuning["extended_options"],
+            partition_device
+        ], check=True, capture_output=True)
+        
+        # Step 9: Mount the partition
+        mount_point = os.path.join(work_dir, "mnt")
+        os.makedirs(mount_point, exist_ok=True)
+        subprocess.run([
+            "mount", partition_device, mount_point
+        ], check=True)
+        
+        try:
+            # Step 10: Extract container filesystem
+            logger.info("Extracting container filesystem to mounted partition...")
+            export_stats = _extract_rootfs(mount_point, source, tar_path)
+            
+            # Step 11: Install kernel (for Debian/Ubuntu-based images)
+            logger.info("Installing kernel and bootloader components...")
+            kernel = _provide_kernel(mount_point, arch, logger, offline)
+            version = _kernel_version(mount_point, kernel)
+            # The initramfs is built before boot-fast prunes modules, so the
+            # drivers it was asked for are still there to copy
+            initramfs_info = _minimal_initramfs(
+                ModuleTree(mount_point, version), version, initramfs, arch, logger
+            ) if version else None
+            profile_info = _apply_profile(mount_point, version, profile, logger)
+            if initramfs_info:
+                # EXTLINUX boots /initrd.img from the root filesystem itself
+                os.makedirs(f"{mount_point}/boot", exist_ok=True)
+                shutil.copy(initramfs_info["path"], f"{mount_point}/boot/initrd.img-docker2img")
+                if os.path.lexists(f"{mount_point}/initrd.img"):
+                    os.remove(f"{mount_point}/initrd.img")
+                os.symlink("boot/initrd.img-docker2img", f"{mount_point}/initrd.img")
+            
+            # Step 12: Install bootloader
+            logger.info("Installing EXTLINUX bootloader...")
+            boot_dir = f"{mount_point}/boot"
+            os.makedirs(f"{boot_dir}/extlinux", exist_ok=True)
+            
+            # Install EXTLINUX
+            subprocess.run([
+                "extlinux", "--install", f"{boot_dir}/extlinux"
+            ], check=True, capture_output=True)
+            
+            # Create bootloader configuration
+            config_path = f"{boot_dir}/extlinux/extlinux.conf"
+            with open(config_path, "w") as f:
+                f.write(_boot_config("/dev/sda1", kernel, profile))
+            
+            # Step 13: Create basic init system (if systemd not available)
+            _write_basic_init(mount_point, logger)
+            
+        finally:
+            # Cleanup: Unmount filesystem
+            logger.info("Unmounting filesystems...")
+            subprocess.run(["umount", mount_point], check=False, capture_output=True)
+        
+        # The filesystem was populated without a journal; add it now
+        if journal_args(tuning):
+            subprocess.run(
+                ["tune2fs", *journal_args(tuning), partition_device], check=True, capture_output=True
+            )
+            
+    finally:
+        # Cleanup: Detach loop device
+        subprocess.run(["losetup", "-d", loop_device], check=False, capture_output=True)
+        if pooled:
+            _loop_pool.put(loop_device)
+    
+    return {
+        "export_stats": export_stats, "root_partition": "/dev/sda1",
+        "kernel": kernel, "initramfs": initramfs_info, "profile": profile_info,
+        "filesystem_tuning": _tuning_report(tuning, stats)
+    }
+
+
+# Output formats are written from the finished raw image in one pass
+# (docker2img.diskformats). In backing-chain mode one qcow2 per base image
+# (and build parameters) is kept in BASE_IMAGE_DIR; images whose layers
+# extend the base's are built by applying only the extra layers to a copy of
+# the base root and written as overlays holding the clusters that differ.
+OUTPUT_FORMATS = tuple(FORMAT_EXTENSIONS)
+BASE_IMAGE_DIR = "/tmp/conversion/bases"
+# A job converting a base holds its lock for at most the function timeout
+# (3600s), so an older lock belongs to a killed job. Waiters give up well
+# before their own timeout, so the job fails with an error instead of being
+# killed mid-wait
+BASE_IMAGE_LOCK_TIMEOUT = 45 * 60
+BASE_IMAGE_LOCK_STALE = 3600
+
+
+def _output_filename(output_filename: str, output_format: str) -> str:
+    """Give the output the extension of its format (bootable.img -> bootable.qcow2)"""
+    if output_format == "raw":
+        return output_filename
+    stem = output_filename[:-len(".img")] if output_filename.endswith(".img") else output_filename
+    return f"{stem}.{FORMAT_EXTENSIONS[output_format]}"
+
+
+def _write_qcow2_overlay(src: str, dst: str, backing: str, backing_name: str, compress: bool = False) -> None:
+    """
+    Write a raw image as a qcow2 overlay that stores only the clusters
+    differing from backing, and refer to the backing file as backing_name
+    """
+    command = ["qemu-img", "convert", "-f", "raw", "-O", "qcow2", "-B", backing, "-F", "qcow2"]
+    if compress:
+        command += ["-c", "-o", "compression_type=zstd"]
+    subprocess.run(command + [src, dst], check=True, capture_output=True)
+    subprocess.run([
+        "qemu-img", "rebase", "-u", "-f", "qcow2", "-F", "qcow2", "-b", backing_name, dst
+    ], check=True, capture_output=True)
+
+
+def _base_image_key(manifest_digest: str, params: Dict[str, Any]) -> str:
+    return _result_cache_key(manifest_digest, {"base": True, **params})
+
+
+def _ensure_base_image(
+    backing_base: str,
+    base_image: Dict[str, Any],
+    params: Dict[str, Any],
+    compress: bool,
+    logger: logging.Logger
+) -> Dict[str, Any]:
+    """
+    Return the shared qcow2 of a base image, converting it on first use
+
+    Args:
+        backing_base: Base image reference
+        base_image: Its resolved manifest (resolve_reference)
+        params: _convert_image parameters the base is built with
+        compress: Compress the base's clusters
+
+    Returns:
+        dict: path, the base's root_partition, kernel, initramfs and profile,
+            and built (False when an existing base was reused)
+    """
+    os.makedirs(BASE_IMAGE_DIR, exist_ok=True)
+    key = _base_image_key(base_image["digest"], {**params, "compress": compress})
+    name = f"{backing_base.replace(':', '_').replace('/', '_')}-{key[:16]}"
+    path = os.path.join(BASE_IMAGE_DIR, f"{name}.qcow2")
+    meta_path = os.path.join(BASE_IMAGE_DIR, f"{name}.json")
+    # Concurrent jobs on the same base wait for one conversion
+    try:
+        with VolumeLock(os.path.join(BASE_IMAGE_DIR, f".{name}.lock"),
+                        timeout=BASE_IMAGE_LOCK_TIMEOUT, stale_after=BASE_IMAGE_LOCK_STALE):
+            if os.path.exists(meta_path):
+                with open(meta_path) as f:
+                    return {**json.load(f), "path": path, "built": False}
+
+            logger.info(f"Converting base image {backing_base}...")
+            raw_name = f".base-{name}.img"
+            result = _convert_image(backing_base, raw_name, output_format="raw", **params)
+            if result["status"] != "success":
+                raise RuntimeError(f"Converting base image {backing_base} failed: {result['error']}")
+            try:
+                if result["manifest_digest"] != base_image["digest"]:
+                    raise RuntimeError(f"{backing_base} changed while its base image was converted")
+                partial_path = f"{path}.partial"
+                export_formats(result["output_file"], {"qcow2": partial_path}, compress, params["compress_level"])
+                os.replace(partial_path, path)
+            finally:
+                os.remove(result["output_file"])
+            meta = {
+                "docker_image": backing_base,
+                "manifest_digest": base_image["digest"],
+                "layers": [layer["digest"] for layer in base_image["layers"]],
+                "root_partition": result["root_partition"],
+                "kernel": result["kernel"],
+                "initramfs": result["initramfs"],
+                "profile": result["profile"],
+            }
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+    except AptCacheError as e:
+        raise RuntimeError(f"Base image {backing_base} is still being converted by another job ({e})") from e
+    conversion_volume.commit()
+    return {**meta, "path": path, "built": True}
+
+
+def _remove_entry(path: str) -> None:
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def _apply_layer_delta(root: str, layers) -> Dict[str, Any]:
+    """
+    Apply layers on top of a populated root: whiteouts and opaque
+    directories are carried out first, directories replaced by other entry
+    types are removed, then the merged upper entries are extracted over it
+
+    Returns:
+        dict: Export stats of the merged entries plus removed (entries deleted)
+    """
+    changes = layer_changes(layers)
+    removed = 0
+    for path in sorted(changes["removed"] | changes["opaque"] | changes["replaced"]):
+        parent = _resolve_in_root(root, os.path.dirname(path))
+        if parent is None or not os.path.isdir(parent):
+            continue
+        if path in changes["opaque"] and path not in changes["removed"]:
+            directory = _resolve_in_root(root, path)
+            if directory and os.path.isdir(directory):
+                for name in os.listdir(directory):
+                    _remove_entry(os.path.join(directory, name))
+                    removed += 1
+            continue
+        target = os.path.join(parent, os.path.basename(path))
+        if path in changes["removed"] and os.path.lexists(target):
+            _remove_entry(target)
+            removed += 1
+        elif os.path.isdir(target) and not os.path.islink(target):
+            # tar cannot replace a directory with a file or symlink
+            shutil.rmtree(target)
+            removed += 1
+    stats = _export_and_extract(_RegistrySource(layers), root)
+    return {**stats, "removed": removed}
+
+
+def _assemble_on_base(
+    img_path: str,
+    base: Dict[str, Any],
+    layers,
+    work_dir: str,
+    logger: logging.Logger
+) -> Dict[str, Any]:
+    """Build an image as the base's raw image with the remaining layers applied to its root"""
+    # Step 5: Expand the base into the job's raw image
+    logger.info(f"Expanding base image {base['docker_image']}...")
+    subprocess.run([
+        "qemu-img", "convert", "-f", "qcow2", "-O", "raw", base["path"], img_path
+    ], check=True, capture_output=True)
+
+    # Steps 6-13: Kernel, bootloader and init come with the base; only the
+    # application layers are applied, through the mounted root partition
+    loop_device, pooled = _attach_loop_device(img_path)
+    partition_device = f"{loop_device}p{base['root_partition'][-1]}"
+    mount_point = os.path.join(work_dir, "mnt")
+    os.makedirs(mount_point, exist_ok=True)
+    try:
+        subprocess.run(["mount", partition_device, mount_point], check=True, capture_output=True)
+        try:
+            logger.info(f"Applying {len(layers)} application layers to the base root...")
+            export_stats = _apply_layer_delta(mount_point, layers)
+        finally:
+            subprocess.run(["umount", mount_point], check=False, capture_output=True)
+    finally:
+        subprocess.run(["losetup", "-d", loop_device], check=False, capture_output=True)
+        if pooled:
+            _loop_pool.put(loop_device)
+    return {
+        "export_stats": export_stats, "root_partition": base["root_partition"],
+        "kernel": base["kernel"], "initramfs": base["initramfs"], "profile": base["profile"]
+    }
+
+
+# Per-job scratch space on the container's local disk: the image is built
+# here and only the finished artifact is copied to the volume
+JOB_WORKSPACE_ROOT = "/tmp/docker2img-jobs"
+SCRATCH_RESERVE_MB = 512
+
+_scratch_lock = threading.Lock()
+_scratch_reserved = 0
+
+# Conversions are mostly I/O bound (registry, tar, mke2fs, volume writes), so
+# one worker container runs several at once. Read when the app is deployed,
+# since it sizes the @modal.concurrent limit
+CONVERSION_CONCURRENCY = int(os.environ.get("DOCKER2IMG_CONVERSION_CONCURRENCY", "4"))
+
+DOCKER_SOCKET = "/var/run/docker.sock"
+DOCKER_READY_TIMEOUT = 60
+
+# Tools the pipeline shells out to; discovered once per worker container
+REQUIRED_TOOLS = ["tar", "sfdisk", "mke2fs", "mkfs.fat", "mcopy", "syslinux", "tune2fs", "dd"]
+OPTIONAL_TOOLS = ["dockerd", "docker", "losetup", "zstd"]
+LOOP_POOL_SIZE = 8
+
+
+def _docker_ping(socket_path: str = DOCKER_SOCKET) -> bool:
+    """Check daemon readiness with GET /_ping over the API socket"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(2)
+            sock.connect(socket_path)
+            sock.sendall(b"GET /_ping HTTP/1.0\r\nHost: docker\r\n\r\n")
+            return sock.recv(64).split(b" ", 2)[1:2] == [b"200"]
+    except (OSError, IndexError):
+        return False
+
+
+def _ensure_docker_daemon(
+    logger: logging.Logger,
+    timeout: float = DOCKER_READY_TIMEOUT
+) -> Optional[subprocess.Popen]:
+    """
+    Start dockerd unless it already answers, and wait until it is ready
+    
+    Returns:
+        Popen: The daemon process if it was started here, else None
+    """
+    if _docker_ping():
+        return None
+    logger.info("Starting Docker daemon...")
+    log_file = open("/tmp/dockerd.log", "ab")
+    daemon = subprocess.Popen(
+        ["dockerd", f"--host=unix://{DOCKER_SOCKET}"],
+        stdout=log_file, stderr=subprocess.STDOUT
+    )
+    log_file.close()
+    deadline = time.monotonic() + timeout
+    while not _docker_ping():
+        if daemon.poll() is not None:
+            raise RuntimeError(f"dockerd exited with {daemon.returncode}; see /tmp/dockerd.log")
+        if time.monotonic() > deadline:
+            daemon.terminate()
+            raise RuntimeError(f"dockerd not ready after {timeout}s; see /tmp/dockerd.log")
+        time.sleep(0.1)
+    return daemon
+
+
+def _discover_tools() -> Dict[str, Optional[str]]:
+    """Resolve every external tool once, so missing ones are reported up front"""
+    return {tool: shutil.which(tool) for tool in REQUIRED_TOOLS + OPTIONAL_TOOLS}
+
+
+# Loop devices set up by the worker; each concurrent job takes its own
+_loop_pool: "queue.Queue[str]" = queue.Queue()
+
+
+def _prepare_loop_devices(count: int) -> list:
+    """
+    Make sure /dev/loop0..count-1 exist and add them to the job pool, so
+    `losetup` does not have to create nodes under load; returns the devices
+    available (may be none in sandboxes without loop support)
+    """
+    devices = []
+    for index in range(count):
+        path = f"/dev/loop{index}"
+        if not os.path.exists(path):
+            try:
+                os.mknod(path, 0o660 | stat.S_IFBLK, os.makedev(7, index))
+            except OSError:
+                break
+        devices.append(path)
+        _loop_pool.put(path)
+    return devices
+
+
+def _attach_loop_device(img_path: str):
+    """
+    Attach img_path to a pooled loop device, or any free one if the pool is
+    empty or its device is busy
+    
+    Returns:
+        tuple: The loop device and whether it must go back to the pool
+    """
+    try:
+        device = _loop_pool.get_nowait()
+    except queue.Empty:
+        device = None
+    if device:
+        attached = subprocess.run(
+            ["losetup", "-P", device, img_path], capture_output=True, text=True
+        )
+        if attached.returncode == 0:
+            return device, True
+        _loop_pool.put(device)
+    loop_result = subprocess.run(
+        ["losetup", "-P", "--find", "--show", img_path],
+        capture_output=True, text=True, check=True
+    )
+    return loop_result.stdout.strip(), False
+
+
+def _reserve_scratch(path: str, needed: int) -> None:
+    """
+    Reserve scratch bytes for a job, failing before the build starts if the
+    local disk cannot hold them alongside the other running jobs
+    """
+    global _scratch_reserved
+    with _scratch_lock:
+        free = shutil.disk_usage(path).free - _scratch_reserved
+        if needed + SCRATCH_RESERVE_MB * 1024 * 1024 > free:
+            raise RuntimeError(
+                f"Not enough scratch space in {path}: need {needed // (1024 * 1024)}MB, "
+                f"{max(free, 0) // (1024 * 1024)}MB available"
+            )
+        _scratch_reserved += needed
+
+
+def _release_scratch(needed: int) -> None:
+    global _scratch_reserved
+    with _scratch_lock:
+        _scratch_reserved -= needed
+
+
+def _reload_volume(logger: logging.Logger) -> None:
+    """Pick up files committed by other containers, if nothing is open here"""
+    try:
+        conversion_volume.reload()
+    except Exception as e:
+        # Concurrent jobs in this container may hold files open on the volume
+        logger.info(f"Skipping volume reload: {e}")
+
+
+def _convert_image(
+    docker_image: str,
+    output_filename: str = "bootable_system.img",
+    disk_size_mb: Union[int, str] = 2048,
+    filesystem_type: str = "ext4",
+    keep_tar: bool = False,
+    sparse: bool = True,
+    assembly_backend: str = "direct",
+    image_source: str = "registry",
+    platform: str = "linux/amd64",
+    use_cache: bool = True,
+    apt_offline: bool = False,
+    initramfs: str = "minimal",
+    initramfs_compression: str = "lz4",
+    initramfs_modules: Optional[List[str]] = None,
+    profile: str = "default",
+    compress_level: int = DEFAULT_COMPRESS_LEVEL,
+    size_headroom: float = DEFAULT_SIZE_HEADROOM,
+    shrink: bool = False,
+    output_format: Union[str, List[str]] = "raw",
+    compress_output: bool = False,
+    backing_base: Optional[str] = None,
+    archive_image: Optional[Dict[str, Any]] = None
+) -> dict:
+    """Run the conversion pipeline; see convert_docker_to_bootable_img"""
+    
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+    
+    # Everything a job writes outside the caches is keyed by its job ID, so
+    # concurrent jobs (even for the same image and output name) never collide
+    job_id = uuid.uuid4().hex[:12]
+    work_dir = os.path.join(JOB_WORKSPACE_ROOT, job_id)
+    os.makedirs(work_dir)
+    formats = [output_format] if isinstance(output_format, str) else list(dict.fromkeys(output_format))
+    if backing_base and "qcow2" not in formats:
+        formats.insert(0, "qcow2")
+    # One output per format; the first is the primary output_file
+    img_paths = {
+        fmt: f"/tmp/conversion/{_output_filename(output_filename, fmt)}" for fmt in formats if fmt in OUTPUT_FORMATS
+    }
+    img_path = next(iter(img_paths.values()), f"/tmp/conversion/{output_filename}")
+    output_filename = os.path.basename(img_path)
+    # Built on local scratch (always as a raw image), exported to the output
+    # formats there, then copied next to img_paths and renamed over them
+    work_img_path = os.path.join(work_dir, "disk.img")
+    publish_paths = {
+        fmt: os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{job_id}.partial")
+        for fmt, path in img_paths.items()
+    }
+    scratch_reserved = 0
+    
+    container_id = None
+    blob_cache = None
+    manifest_digest = None
+    try:
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown image profile: {profile}")
+        if filesystem_type in READONLY_FILESYSTEMS + COMPRESSED_FILESYSTEMS and assembly_backend != "direct":
+            raise ValueError(f"{filesystem_type} roots are only built by the direct backend")
+        if filesystem_type in READONLY_FILESYSTEMS:
+            if initramfs != "minimal":
+                raise ValueError(f"{filesystem_type} roots boot through the minimal initramfs")
+        unknown = [fmt for fmt in formats if fmt not in OUTPUT_FORMATS]
+        if unknown or not formats:
+            raise ValueError(f"Unknown output format: {', '.join(unknown) or 'none given'}")
+        if shrink and assembly_backend == "loop":
+            # EXTLINUX's ldlinux.sys lives in the ext root there, with its
+            # sector list patched into the VBR; resize2fs may move it
+            raise ValueError("shrink is not supported by the loop backend (the bootloader lives in the root)")
+        if image_source == "archive" and not archive_image:
+            raise ValueError("The archive source needs the uploaded image (see upload_archive in the CLI)")
+        if backing_base:
+            if image_source != "registry":
+                raise ValueError("Backing-chain builds need the registry image source")
+            if filesystem_type not in ("ext2", "ext3", "ext4"):
+                raise ValueError(f"Backing-chain builds apply layers to an ext root, not {filesystem_type}")
+            if assembly_backend != "loop":
+                # The application layers are applied to the base's mounted root
+                raise ValueError(f"Backing-chain builds need the loop backend, not {assembly_backend}")
+            if disk_size_mb == "auto" or shrink or keep_tar:
+                # Every image of a family must keep the base's disk layout
+                raise ValueError("Backing-chain builds need a fixed disk size, without shrink or keep_tar")
+        
+        # Pick up blobs and results committed by other containers
+        _reload_volume(logger)
+        
+        if image_source == "registry":
+            # Step 1: Resolve the reference to a platform manifest
+            logger.info(f"Resolving {docker_image} ({platform}) against the registry")
+            registry_client, image = resolve_reference(
+                docker_image, platform=platform,
+                username=os.environ.get("REGISTRY_USERNAME"),
+                password=os.environ.get("REGISTRY_PASSWORD")
+            )
+            manifest_digest = image["digest"]
+            image_digest = manifest_digest
+            if backing_base:
+                _, base_image = resolve_reference(
+                    backing_base, platform=platform,
+                    username=os.environ.get("REGISTRY_USERNAME"),
+                    password=os.environ.get("REGISTRY_PASSWORD")
+                )
+                base_layers = [layer["digest"] for layer in base_image["layers"]]
+                if [layer["digest"] for layer in image["layers"][:len(base_layers)]] != base_layers:
+                    raise ValueError(f"{docker_image} is not built on {backing_base}")
+        elif image_source == "archive":
+            # Step 1: The layers were uploaded from a local archive into the
+            # layer cache (convert --from-archive); the config digest is the
+            # image ID
+            logger.info(f"Converting {docker_image} from {len(archive_image['layers'])} uploaded layers")
+            image_digest = archive_image["digest"]
+        elif image_source == "docker":
+            # Step 1: Start Docker daemon (already running on a warm worker)
+            _ensure_docker_daemon(logger)
+            
+            # Step 2: Pull the Docker image
+            logger.info(f"Pulling Docker image: {docker_image}")
+            result = subprocess.run(
+                ["docker", "pull", docker_image], 
+                capture_output=True, text=True, check=True
+            )
+            image_digest = subprocess.run(
+                ["docker", "image", "inspect", "--format", "{{.Id}}", docker_image],
+                capture_output=True, text=True, check=True
+            ).stdout.strip()
+        else:
+            raise ValueError(f"Unknown image source: {image_source}")
+        
+        # An unchanged image converted with the same parameters is served
+        # from the result cache (the debug tar is only produced by a real run)
+        cache_key = None
+        if use_cache and not keep_tar:
+            cache_key = _result_cache_key(image_digest, {
+                "disk_size_mb": disk_size_mb,
+                "filesystem_type": filesystem_type,
+                "sparse": sparse,
+                "assembly_backend": assembly_backend,
+                "image_source": image_source,
+                "platform": platform,
+                "initramfs": initramfs,
+                "initramfs_compression": initramfs_compression,
+                "initramfs_modules": initramfs_modules,
+                "profile": profile,
+                "compress_level": compress_level,
+                "size_headroom": size_headroom,
+                "shrink": shrink,
+                "output_formats": formats,
+                "compress_output": compress_output,
+                "backing_base": base_image["digest"] if backing_base else None,
+            })
+            cached = _lookup_cached_result(cache_key, img_paths, publish_paths)
+            if cached is not None:
+                logger.info(f"Result cache hit for {image_digest}: {img_path}")
+                cached["job_id"] = job_id
+                return cached
+        
+        if image_source in ("registry", "archive"):
+            # Steps 2-3: Fetch the layer blobs through the shared layer cache
+            # (uploaded archive layers are already there); they are flattened
+            # on the fly when extracted
+            blob_dir = os.path.join(work_dir, "blobs")
+            blob_cache = BlobCache(LAYER_CACHE_DIR, LAYER_CACHE_MAX_MB * 1024 * 1024)
+            if image_source == "archive":
+                layer_paths = cached_layers(archive_image, blob_cache)
+            else:
+                layer_paths = fetch_layers(registry_client, image, blob_dir, cache=blob_cache)
+            # Publish new blobs and leases to other containers right away
+            conversion_volume.commit()
+            logger.info(
+                f"Layer cache: {blob_cache.stats['hits']} hits, {blob_cache.stats['misses']} misses, "
+                f"{blob_cache.stats['bytes_saved']} bytes saved"
+            )
+            source = _RegistrySource(layer_paths)
+        else:
+            # Step 3: Create a container from the image  
+            logger.info("Creating container from image...")
+            container_result = subprocess.run(
+                ["docker", "create", docker_image], 
+                capture_output=True, text=True, check=True
+            )
+            container_id = container_result.stdout.strip()
+            source = _DockerExportSource(container_id)
+        
+        # Step 4: Export container filesystem to tar (debug mode only; by
+        # default the export is streamed into the filesystem in Step 10)
+        tar_name = f"{docker_image.replace(':', '_').replace('/', '_')}-{job_id}.tar"
+        tar_path = os.path.join(work_dir, tar_name)
+        export_stats = None
+        
+        base = None
+        if backing_base:
+            base = _ensure_base_image(backing_base, base_image, {
+                "disk_size_mb": disk_size_mb,
+                "filesystem_type": filesystem_type,
+                "sparse": sparse,
+                "assembly_backend": assembly_backend,
+                "platform": platform,
+                "use_cache": False,
+                "apt_offline": apt_offline,
+                "initramfs": initramfs,
+                "initramfs_compression": initramfs_compression,
+                "initramfs_modules": initramfs_modules,
+                "profile": profile,
+                "compress_level": compress_level,
+            }, compress_output, logger)
+        
+        size_scan = None
+        if disk_size_mb == "auto":
+            # A separate pass over the export measures the flattened rootfs
+            size_scan = _scan_export(source)
+            disk_size_mb = _auto_disk_size_mb(size_scan, size_headroom)
+            logger.info(
+                f"Auto size: {disk_size_mb}MB for {size_scan['file_bytes']} bytes in "
+                f"{size_scan['files']} files"
+            )
+        elif not isinstance(disk_size_mb, int):
+            raise ValueError(f"Disk size must be a number of MB or 'auto', not {disk_size_mb!r}")
+        
+        # The image may fill up entirely, and the direct backend also stages
+        # the rootfs next to it
+        scratch_needed = disk_size_mb * 1024 * 1024 * (2 if assembly_backend == "direct" and not base else 1)
+        if formats != ["raw"]:
+            # Each output is staged next to the raw image before the commit
+            scratch_needed += disk_size_mb * 1024 * 1024 * len(formats)
+        if keep_tar:
+            # The kept export is written to scratch too; a rootfs that fits
+            # the disk fits in a tar of about the same size
+            scratch_needed += disk_size_mb * 1024 * 1024
+        _reserve_scratch(work_dir, scratch_needed)
+        scratch_reserved = scratch_needed
+        if keep_tar:
+            logger.info(f"Exporting container filesystem to {tar_path}")
+            try:
+                with open(tar_path, "wb") as tar_file:
+                    export_stats = stream_export(source.open(), tar_file)
+            except Exception:
+                source.abort()
+                raise
+            finally:
+                source.close()
+        
+        # Step 5: Create empty disk image (read-only roots resize it to fit
+        # their content, so it starts out sparse; backing-chain builds start
+        # from the base image instead)
+        if not base:
+            logger.info(f"Creating {disk_size_mb}MB {'sparse ' if sparse else ''}disk image: {img_path}")
+            _create_disk_image(
+                work_img_path, disk_size_mb, sparse=sparse or filesystem_type in READONLY_FILESYSTEMS
+            )
+        
+        # Steps 6-13: Partition, create and populate the filesystem, install
+        # kernel, bootloader and init
+        arch = platform_arch(platform)
+        initramfs_spec = None
+        if initramfs == "minimal":
+            initramfs_spec = {
+                "compression": initramfs_compression,
+                "modules": (initramfs_modules or DEFAULT_MODULES) + ROOT_FS_MODULES.get(filesystem_type, []),
+                # A caller-chosen module list must resolve completely
+                "strict": bool(initramfs_modules),
+            }
+        if base:
+            assembly = _assemble_on_base(
+                work_img_path, base, layer_paths[len(base["layers"]):], work_dir, logger
+            )
+        elif assembly_backend == "direct":
+            assembly = _assemble_direct(
+                work_img_path, disk_size_mb, filesystem_type, source,
+                tar_path if keep_tar else None, logger, arch, apt_offline, initramfs_spec, profile,
+                compress_level
+            )
+        elif assembly_backend == "stream":
+            assembly = _assemble_stream(
+                work_img_path, disk_size_mb, filesystem_type, source,
+                tar_path if keep_tar else None, logger, arch, apt_offline, initramfs_spec, profile
+            )
+        elif assembly_backend == "loop":
+            assembly = _assemble_with_loop_device(
+                work_img_path, filesystem_type, source,
+                tar_path if keep_tar else None, logger, work_dir, arch, apt_offline, initramfs_spec,
+                profile
+            )
+        else:
+            raise ValueError(f"Unknown assembly backend: {assembly_backend}")
+        if assembly["export_stats"] is not None:
+            export_stats = assembly["export_stats"]
+        logger.info(
+            f"Exported {export_stats['bytes']} bytes (sha256 {export_stats['sha256']})"
+        )
+        shrink_info = None
+        if shrink:
+            shrink_info = _shrink_image(
+                work_img_path, int(assembly["root_partition"][-1]), filesystem_type, size_headroom, logger
+            )
+        
+        # Step 14: Install MBR bootloader
+        logger.info("Installing MBR bootloader...")
+        subprocess.run([
+            "dd", "bs=440", "count=1", "conv=notrunc",
+            "if=/usr/lib/syslinux/mbr.bin", f"of={work_img_path}"
+        ], check=True, capture_output=True)
+        
+        # Step 15: Write the output formats from one read of the raw image
+        # (a raw-only build keeps the image as it is)
+        if formats == ["raw"]:
+            staged = {"raw": work_img_path}
+            outputs = {"raw": {"format": "raw", "path": work_img_path, "sha256": file_sha256(work_img_path)}}
+        else:
+            export_dir = os.path.join(work_dir, "export")
+            os.makedirs(export_dir)
+            staged = {fmt: os.path.join(export_dir, os.path.basename(path)) for fmt, path in img_paths.items()}
+            single_pass = {fmt: path for fmt, path in staged.items() if not (base and fmt == "qcow2")}
+            logger.info(f"Writing {', '.join(single_pass)} in one pass...")
+            outputs = export_formats(work_img_path, single_pass, compress_output, compress_level) if single_pass else {}
+            if base:
+                logger.info("Writing qcow2 overlay...")
+                _write_qcow2_overlay(
+                    work_img_path, staged["qcow2"], base["path"],
+                    # The overlay finds its base relative to the output directory
+                    os.path.relpath(base["path"], os.path.dirname(img_paths["qcow2"])), compress_output
+                )
+                outputs["qcow2"] = {"format": "qcow2", "path": staged["qcow2"],
+                                    "sha256": file_sha256(staged["qcow2"])}
+        
+        # Step 16: Commit the outputs to the volume in one sequential,
+        # hole-preserving write each and rename them into place; keep the
+        # debug tar
+        for fmt in formats:
+            logger.info(f"Committing image to volume: {img_paths[fmt]}")
+            _sparse_move(staged[fmt], publish_paths[fmt], fsync=True)
+            os.replace(publish_paths[fmt], img_paths[fmt])
+            usage = _file_usage(img_paths[fmt])
+            outputs[fmt].update({
+                "path": img_paths[fmt],
+                "size_bytes": usage["apparent_bytes"],
+                "allocated_bytes": usage["allocated_bytes"],
+            })
+        if keep_tar:
+            kept_tar_path = f"/tmp/conversion/{tar_name}"
+            _sparse_move(tar_path, kept_tar_path, fsync=True)
+        
+        # Get file size (apparent) and volume footprint (allocated)
+        usage = _file_usage(img_path)
+        file_size = usage["apparent_bytes"]
+        
+        logger.info(f"Conversion completed successfully! Output: {img_path}")
+        
+        result = {
+            "status": "success",
+            "job_id": job_id,
+            "output_file": img_path,
+            "file_size_mb": file_size // (1024 * 1024),
+            "allocated_mb": usage["allocated_bytes"] // (1024 * 1024),
+            "sparse": sparse,
+            "docker_image": docker_image,
+            "disk_size_mb": shrink_info["after_mb"] if shrink_info else assembly.get("disk_size_mb", disk_size_mb),
+            "size_auto": {"rootfs_bytes": size_scan["file_bytes"], "files": size_scan["files"],
+                          "headroom": size_headroom} if size_scan else None,
+            "shrink": shrink_info,
+            "filesystem_type": filesystem_type,
+            "root_filesystem_bytes": assembly.get("root_filesystem_bytes"),
+            "root_usage_bytes": assembly.get("root_usage_bytes"),
+            "filesystem_tuning": assembly.get("filesystem_tuning"),
+            "assembly_backend": assembly_backend,
+            "image_source": image_source,
+            "manifest_digest": manifest_digest,
+            "layer_cache": blob_cache.stats if blob_cache else None,
+            "root_partition": assembly["root_partition"],
+            "kernel": assembly["kernel"],
+            "initramfs": assembly["initramfs"],
+            "profile": assembly["profile"],
+            "export_bytes": export_stats["bytes"],
+            "export_sha256": export_stats["sha256"],
+            "tar_path": kept_tar_path if keep_tar else None,
+            "outputs": [outputs[fmt] for fmt in formats],
+            "compressed": compress_output and "qcow2" in formats,
+            "backing": {
+                "base_image": backing_base,
+                "base_file": base["path"],
+                "base_digest": base["manifest_digest"],
+                "base_built": base["built"],
+                "base_size_mb": os.path.getsize(base["path"]) // (1024 * 1024),
+                "delta_layers": len(layer_paths) - len(base["layers"]),
+            } if base else None,
+            "message": f"Successfully converted {docker_image} to bootable {output_filename}"
+        }
+        result["result_cache"] = "disabled"
+        if cache_key:
+            _store_cached_result(cache_key, img_paths, result)
+            _evict_cached_results(RESULT_CACHE_MAX_MB * 1024 * 1024)
+            result["result_cache"] = "miss"
+        return result
+        
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Command failed: {e.cmd}")
+        logger.error(f"Error output: {e.stderr}")
+        return {
+            "status": "error",
+            "error": str(e),
+            "command": e.cmd,
+            "stderr": e.stderr if hasattr(e, 'stderr') else None
+        }
+    except Exception as e:
+        logger.error(f"Unexpected error: {str(e)}")
+        return {
+            "status": "error", 
+            "error": str(e)
+        }
+    finally:
+        # Clean up Docker container and fetched layer blobs
+        if container_id:
+            subprocess.run(["docker", "rm", container_id], check=False, capture_output=True)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        _release_scratch(scratch_reserved)
+        for publish_path in publish_paths.values():
+            if os.path.exists(publish_path):
+                os.remove(publish_path)
+        if blob_cache:
+            blob_cache.release()
+            blob_cache.evict()
+
 @app.function(
     image=docker_converter_image,
     cpu=4,
     memory=8192,
     timeout=3600,  # 1 hour timeout for large conversions
-    volumes={
-        "/tmp/conversion": modal.Volume.from_name("docker-conversion-volume", create_if_missing=True)
-    },
+    volumes={"/tmp/conversion": conversion_volume},
     allow_network_access=True
 )
 def convert_docker_to_bootable_img(
     docker_image: str,
     output_filename: str = "bootable_system.img",
-    disk_size_mb: int = 2048,
-    filesystem_type: str = "ext4"
+    disk_size_mb: Union[int, str] = 2048,
+    filesystem_type: str = "ext4",
+    keep_tar: bool = False,
+    sparse: bool = True,
+    assembly_backend: str = "direct",
+    image_source: str = "registry",
+    platform: str = "linux/amd64",
+    use_cache: bool = True,
+    apt_offline: bool = False,
+    initramfs: str = "minimal",
+    initramfs_compression: str = "lz4",
+    initramfs_modules: Optional[List[str]] = None,
+    profile: str = "default",
+    compress_level: int = DEFAULT_COMPRESS_LEVEL,
+    size_headroom: float = DEFAULT_SIZE_HEADROOM,
+    shrink: bool = False,
+    output_format: Union[str, List[str]] = "raw",
+    compress_output: bool = False,
+    backing_base: Optional[str] = None,
+    archive_image: Optional[Dict[str, Any]] = None
 ) -> dict:
     """
     Convert a Docker image/container to a bootable .img file
@@ -61,242 +2282,364 @@ def convert_docker_to_bootable_img(
     Args:
         docker_image: Docker image name (e.g., "alpine:latest", "ubuntu:20.04")
         output_filename: Name of the output .img file
-        disk_size_mb: Size of the bootable disk image in MB
-        filesystem_type: Filesystem type (ext4, ext3, ext2)
+        disk_size_mb: Size of the bootable disk image in MB, or "auto" to
+            size it from the scanned rootfs (ignored for read-only roots,
+            which are sized from their content)
+        filesystem_type: Filesystem type (ext4, ext3, ext2), squashfs/erofs
+            for a compressed read-only root under a tmpfs overlay, or
+            btrfs/f2fs for a writable root with zstd compression
+        keep_tar: Write the container export to the volume and keep it for
+            debugging instead of streaming it straight into the filesystem
+        sparse: Create the image with holes so only written blocks use space
+        assembly_backend: "direct" populates the filesystem at the partition
+            offset without loop devices or mounts; "stream" writes ext4
+            straight from the export with no staging directory; "loop" uses
+            losetup/mount
+        image_source: "registry" fetches manifests and layers over the OCI
+            distribution API and flattens them without a Docker daemon;
+            "docker" pulls and exports through dockerd; "archive" converts
+            layers uploaded from a local archive (archive_image)
+        platform: Platform to select from multi-arch images (registry source)
+        use_cache: Return a previous result for the same image digest and
+            parameters instead of converting again
+        apt_offline: Install kernel packages only from the shared apt cache,
+            failing fast if any are missing, when no kernel bundle is stored
+        initramfs: "minimal" boots a generated initramfs with only the needed
+            drivers; "distro" keeps the distribution's initrd
+        initramfs_compression: Minimal initramfs compression (lz4, zstd, none)
+        initramfs_modules: Drivers for the minimal initramfs (default:
+            virtio, AHCI/PIIX, sd and ext4)
+        profile: "default", or "boot-fast" to mask non-essential systemd
+            units, drop unused kernel modules and firmware and skip the boot
+            prompt
+        compress_level: zstd level for btrfs/f2fs roots and compressed
+            outputs (qcow2 clusters, .img.zst frames)
+        size_headroom: Free space kept by "auto" sizing and shrink, as a
+            fraction of the content
+        shrink: Shrink the finished ext root to its content plus headroom and
+            truncate the image to match (direct and stream backends)
+        output_format: "raw" (.img), "qcow2", "vmdk", "vhdx" or "zst" (seekable
+            zstd, .img.zst), or a list of them, all written from one read of
+            the finished raw image
+        compress_output: zstd-compress the clusters of qcow2 output (at
+            compress_level, except overlays written by qemu-img); zst output
+            is compressed regardless
+        backing_base: Base image reference (registry source, ext roots); the
+            base is converted once into a shared qcow2 and the output is a
+            qcow2 overlay on it holding only the application layers
+        archive_image: For the archive source, the image whose layers were
+            uploaded to the layer cache: {"digest": config digest, "layers":
+            [{digest, size, mediaType}, ...]} (docker2img.archive.read_archive)
     
     Returns:
         dict: Contains status, file path, and conversion details
     """
+    return _convert_image(
+        docker_image, output_filename, disk_size_mb, filesystem_type, keep_tar,
+        sparse, assembly_backend, image_source, platform, use_cache, apt_offline,
+        initramfs, initramfs_compression, initramfs_modules, profile, compress_level,
+        size_headroom, shrink, output_format, compress_output, backing_base, archive_image
+    )
+
+
+@app.cls(
+    image=docker_converter_image,
+    cpu=4,
+    memory=8192,
+    timeout=3600,
+    volumes={"/tmp/conversion": conversion_volume},
+    scaledown_window=15 * 60  # Keep warm workers around between batch jobs
+)
+@modal.concurrent(max_inputs=CONVERSION_CONCURRENCY)
+class ConverterWorker:
+    """
+    Long-lived converter: the Docker daemon, caches, tool lookup and loop
+    devices are set up once per container and reused by every conversion;
+    up to CONVERSION_CONCURRENCY conversions run at once, each in its own
+    job workspace
+    """
     
-    logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger(__name__)
-    
-    try:
-        # Step 1: Start Docker daemon
-        logger.info("Starting Docker daemon...")
-        subprocess.run(["dockerd", "--host=unix:///var/run/docker.sock"], 
-                      check=False, timeout=10, capture_output=True)
-        
-        # Step 2: Pull the Docker image
-        logger.info(f"Pulling Docker image: {docker_image}")
-        result = subprocess.run(
-            ["docker", "pull", docker_image], 
-            capture_output=True, text=True, check=True
-        )
+    @modal.enter()
+    def start(self):
+        logging.basicConfig(level=logging.INFO)
+        logger = logging.getLogger(__name__)
+        started = time.monotonic()
         
-        # Step 3: Create a container from the image  
-        logger.info("Creating container from image...")
-        container_result = subprocess.run(
-            ["docker", "create", docker_image], 
-            capture_output=True, text=True, check=True
-        )
-        container_id = container_result.stdout.strip()
+        self.tools = _discover_tools()
+        missing = [tool for tool in REQUIRED_TOOLS if not self.tools[tool]]
+        if missing:
+            logger.warning(f"Missing tools: {', '.join(missing)}")
         
-        # Step 4: Export container filesystem to tar
-        tar_path = f"/tmp/conversion/{docker_image.replace(':', '_').replace('/', '_')}.tar"
-        logger.info(f"Exporting container filesystem to {tar_path}")
-        with open(tar_path, "wb") as tar_file:
-            subprocess.run(
-                ["docker", "export", container_id], 
-                stdout=tar_file, check=True
-            )
+        self.docker_daemon = None
+        if self.tools["dockerd"]:
+            try:
+                self.docker_daemon = _ensure_docker_daemon(logger)
+            except RuntimeError as e:
+                # Only the docker image source needs it; registry pulls still work
+                logger.warning(f"Docker daemon unavailable: {e}")
         
-        # Step 5: Create empty disk image
-        img_path = f"/tmp/conversion/{output_filename}"
-        logger.info(f"Creating {disk_size_mb}MB disk image: {img_path}")
-        subprocess.run([
-            "dd", "if=/dev/zero", f"of={img_path}", 
-            f"bs=1M", f"count={disk_size_mb}"
-        ], check=True, capture_output=True)
+        self.loop_devices = _prepare_loop_devices(max(LOOP_POOL_SIZE, CONVERSION_CONCURRENCY))
+        for cache_dir in (LAYER_CACHE_DIR, RESULT_CACHE_DIR):
+            os.makedirs(cache_dir, exist_ok=True)
         
-        # Step 6: Create partition table and filesystem
-        logger.info("Creating partition table...")
-        fdisk_commands = f"""o
-n
-p
-1
+        self.setup_seconds = time.monotonic() - started
+        self.calls_served = 0
+        self.calls_lock = threading.Lock()
+        logger.info(f"Worker ready in {self.setup_seconds:.2f}s")
+    
+    @modal.exit()
+    def stop(self):
+        if self.docker_daemon:
+            self.docker_daemon.terminate()
+            self.docker_daemon.wait(timeout=30)
+    
+    @modal.method()
+    def convert(self, docker_image: str, **options) -> dict:
+        """
+        Convert on this warm worker; takes the same options as
+        convert_docker_to_bootable_img and adds per-call latency under "worker"
+        """
+        started = time.monotonic()
+        with self.calls_lock:
+            cold = self.calls_served == 0
+            self.calls_served += 1
+            calls_served = self.calls_served
+        result = _convert_image(docker_image, **options)
+        call_seconds = time.monotonic() - started
+        result["worker"] = {
+            "cold": cold,
+            "setup_seconds": round(self.setup_seconds, 3),
+            "call_seconds": round(call_seconds, 3),
+            # The first call on a container also waited for its setup
+            "latency_seconds": round(call_seconds + (self.setup_seconds if cold else 0), 3),
+            "calls_served": calls_served,
+            "loop_devices": len(self.loop_devices),
+        }
+        return result
 
 
-a
-1
-w
-"""
-        subprocess.run(
-            ["fdisk", img_path], 
-            input=fdisk_commands, text=True, check=True, capture_output=True
-        )
-        
-        # Step 7: Set up loop device
-        logger.info("Setting up loop device...")
-        loop_result = subprocess.run(
-            ["losetup", "-P", "--find", "--show", img_path],
-            capture_output=True, text=True, check=True
-        )
-        loop_device = loop_result.stdout.strip()
-        partition_device = f"{loop_device}p1"
-        
+def _synthetic_rootfs_tar(tar_path: str, file_count: int, max_file_size: int, dir_count: int) -> int:
+    """Write a tar of many small random files, like a Python/Node dependency tree"""
+    rng = random.Random(file_count)
+    total = 0
+    with tarfile.open(tar_path, "w") as tar:
+        for i in range(file_count):
+            data = rng.randbytes(rng.randint(0, max_file_size))
+            info = tarfile.TarInfo(f"usr/lib/app/pkg{i % dir_count}/module{i}.py")
+            info.size = len(data)
+            info.mode = 0o644
+            info.mtime = 1700000000
+            tar.addfile(info, io.BytesIO(data))
+            total += len(data)
+    return total
+
+
+@app.function(
+    image=docker_converter_image,
+    cpu=4,
+    memory=8192,
+    timeout=3600
+)
+def benchmark_ext4_writer(
+    file_count: int = 100000,
+    max_file_size: int = 4096,
+    dir_count: int = 500,
+    disk_size_mb: int = 4096
+) -> dict:
+    """
+    Benchmark the streaming tar-to-ext4 writer against mkfs+mount+tar and mke2fs -d
+    
+    All three paths build a filesystem from the same synthetic tar of many
+    small files. Peak disk is the allocated size of everything the path needs
+    besides the input tar (image plus staging directory).
+    
+    Returns:
+        dict: Seconds and peak disk bytes per path, plus the input description
+    """
+    work_dir = tempfile.mkdtemp(prefix="docker2img-bench-")
+    tar_path = os.path.join(work_dir, "rootfs.tar")
+    size_bytes = disk_size_mb * 1024 * 1024
+    inode_count = file_count + file_count // 4 + dir_count + 1024
+    payload = _synthetic_rootfs_tar(tar_path, file_count, max_file_size, dir_count)
+    results = {
+        "file_count": file_count,
+        "payload_bytes": payload,
+        "tar_bytes": os.path.getsize(tar_path),
+        "paths": {}
+    }
+    
+    def du(path: str) -> int:
+        output = subprocess.run(["du", "-s", "-B1", path], capture_output=True, text=True, check=True)
+        return int(output.stdout.split()[0])
+    
+    try:
+        # mkfs + loop mount + tar -x (the loop backend)
+        img = os.path.join(work_dir, "loop.img")
+        mount_point = os.path.join(work_dir, "mnt")
+        os.makedirs(mount_point)
+        start = time.monotonic()
+        _create_disk_image(img, disk_size_mb)
+        loop_device = subprocess.run(
+            ["losetup", "--find", "--show", img], capture_output=True, text=True, check=True
+        ).stdout.strip()
         try:
-            # Step 8: Create filesystem on partition
-            logger.info(f"Creating {filesystem_type} filesystem...")
-            subprocess.run([
-                f"mkfs.{filesystem_type}", partition_device
-            ], check=True, capture_output=True)
-            
-            # Step 9: Mount the partition
-            mount_point = "/tmp/conversion/mnt"
-            os.makedirs(mount_point, exist_ok=True)
-            subprocess.run([
-                "mount", partition_device, mount_point
-            ], check=True)
-            
+            subprocess.run(["mkfs.ext4", "-q", "-N", str(inode_count), loop_device], check=True, capture_output=True)
+            subprocess.run(["mount", loop_device, mount_point], check=True)
             try:
-                # Step 10: Extract container filesystem
-                logger.info("Extracting container filesystem to mounted partition...")
-                subprocess.run([
-                    "tar", "-xf", tar_path, "-C", mount_point
-                ], check=True)
-                
-                # Step 11: Install kernel (for Debian/Ubuntu-based images)
-                logger.info("Installing kernel and bootloader components...")
-                
-                # Check if it's a Debian/Ubuntu-based system
-                if os.path.exists(f"{mount_point}/etc/apt/sources.list") or os.path.exists(f"{mount_point}/etc/debian_version"):
-                    # Set up chroot environment
-                    subprocess.run(["mount", "--bind", "/dev", f"{mount_point}/dev"], check=False)
-                    subprocess.run(["mount", "--bind", "/proc", f"{mount_point}/proc"], check=False)
-                    subprocess.run(["mount", "--bind", "/sys", f"{mount_point}/sys"], check=False)
-                    
-                    # Install kernel in chroot
-                    chroot_script = f"""#!/bin/bash
-export DEBIAN_FRONTEND=noninteractive
-apt-get update
-apt-get install -y linux-image-generic systemd-sysv
-apt-get install -y extlinux syslinux-common
-"""
-                    script_path = f"{mount_point}/install_kernel.sh"
-                    with open(script_path, "w") as f:
-                        f.write(chroot_script)
-                    os.chmod(script_path, 0o755)
-                    
-                    subprocess.run([
-                        "chroot", mount_point, "/install_kernel.sh"
-                    ], check=False, capture_output=True)
-                
-                # Step 12: Install bootloader
-                logger.info("Installing EXTLINUX bootloader...")
-                boot_dir = f"{mount_point}/boot"
-                os.makedirs(f"{boot_dir}/extlinux", exist_ok=True)
-                
-                # Install EXTLINUX
-                subprocess.run([
-                    "extlinux", "--install", f"{boot_dir}/extlinux"
-                ], check=True, capture_output=True)
-                
-                # Create bootloader configuration
-                extlinux_conf = f"""DEFAULT linux
-TIMEOUT 30
-PROMPT 1
-
-LABEL linux
-    MENU LABEL Boot Linux
-    LINUX /vmlinuz
-    INITRD /initrd.img
-    APPEND root=/dev/sda1 rw console=tty0 console=ttyS0,115200n8
-"""
-                
-                config_path = f"{boot_dir}/extlinux/extlinux.conf"
-                with open(config_path, "w") as f:
-                    f.write(extlinux_conf)
-                
-                # Step 13: Create basic init system (if systemd not available)
-                if not os.path.exists(f"{mount_point}/sbin/init"):
-                    logger.info("Creating basic init script...")
-                    init_script = """#!/bin/sh
-mount -t proc proc /proc
-mount -t sysfs sysfs /sys
-mount -t devtmpfs devtmpfs /dev
-echo "Container-based Linux system booted successfully!"
-/bin/sh
-"""
-                    with open(f"{mount_point}/sbin/init", "w") as f:
-                        f.write(init_script)
-                    os.chmod(f"{mount_point}/sbin/init", 0o755)
-                
+                subprocess.run(["tar", "-xf", tar_path, "-C", mount_point], check=True)
             finally:
-                # Cleanup: Unmount filesystems
-                logger.info("Unmounting filesystems...")
-                subprocess.run(["umount", f"{mount_point}/dev"], check=False, capture_output=True)
-                subprocess.run(["umount", f"{mount_point}/proc"], check=False, capture_output=True) 
-                subprocess.run(["umount", f"{mount_point}/sys"], check=False, capture_output=True)
                 subprocess.run(["umount", mount_point], check=False, capture_output=True)
-                
         finally:
-            # Cleanup: Detach loop device
             subprocess.run(["losetup", "-d", loop_device], check=False, capture_output=True)
+        results["paths"]["mkfs_mount_tar"] = {
+            "seconds": round(time.monotonic() - start, 3), "peak_disk_bytes": du(img)
+        }
+        os.remove(img)
         
-        # Step 14: Install MBR bootloader
-        logger.info("Installing MBR bootloader...")
+        # tar -x into staging + mke2fs -d (the direct backend)
+        img = os.path.join(work_dir, "direct.img")
+        staging = os.path.join(work_dir, "staging")
+        os.makedirs(staging)
+        start = time.monotonic()
+        subprocess.run(["tar", "-xf", tar_path, "-C", staging], check=True)
+        _create_disk_image(img, disk_size_mb)
         subprocess.run([
-            "dd", "bs=440", "count=1", "conv=notrunc",
-            "if=/usr/lib/syslinux/mbr.bin", f"of={img_path}"
+            "mke2fs", "-q", "-F", "-t", "ext4", "-N", str(inode_count), "-d", staging, img
         ], check=True, capture_output=True)
-        
-        # Step 15: Cleanup temporary files
-        if os.path.exists(tar_path):
-            os.remove(tar_path)
-        
-        # Clean up Docker container
-        subprocess.run(["docker", "rm", container_id], check=False, capture_output=True)
-        
-        # Get file size
-        file_size = os.path.getsize(img_path)
-        
-        logger.info(f"Conversion completed successfully! Output: {img_path}")
-        
-        return {
-            "status": "success",
-            "output_file": img_path,
-            "file_size_mb": file_size // (1024 * 1024),
-            "docker_image": docker_image,
-            "disk_size_mb": disk_size_mb,
-            "filesystem_type": filesystem_type,
-            "message": f"Successfully converted {docker_image} to bootable {output_filename}"
+        results["paths"]["mke2fs_d"] = {
+            "seconds": round(time.monotonic() - start, 3), "peak_disk_bytes": du(img) + du(staging)
         }
+        shutil.rmtree(staging)
+        os.remove(img)
         
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Command failed: {e.cmd}")
-        logger.error(f"Error output: {e.stderr}")
-        return {
-            "status": "error",
-            "error": str(e),
-            "command": e.cmd,
-            "stderr": e.stderr if hasattr(e, 'stderr') else None
+        # Streaming tar-to-ext4 writer (the stream backend)
+        img = os.path.join(work_dir, "stream.img")
+        start = time.monotonic()
+        _create_disk_image(img, disk_size_mb)
+        writer = Ext4Writer(img, size=size_bytes)
+        with open(tar_path, "rb") as source:
+            writer.add_tar_stream(source, hasher=hashlib.sha256())
+        writer.close()
+        results["paths"]["tar2ext4"] = {
+            "seconds": round(time.monotonic() - start, 3), "peak_disk_bytes": du(img)
         }
-    except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
-        return {
-            "status": "error", 
-            "error": str(e)
+        fsck = subprocess.run(["e2fsck", "-fn", img], capture_output=True, text=True)
+        results["paths"]["tar2ext4"]["fsck_clean"] = fsck.returncode == 0
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    return results
+
+
+@app.function(
+    image=docker_converter_image,
+    cpu=2,
+    memory=4096,
+    timeout=3600,
+    volumes={"/tmp/conversion": conversion_volume}
+)
+def benchmark_boot(
+    filename: str,
+    ready_marker: str = DEFAULT_READY_MARKER,
+    runs: int = 1,
+    timeout: int = 300,
+    memory_mb: int = 512,
+    arch: str = "amd64",
+    baseline: Optional[str] = None
+) -> dict:
+    """
+    Boot a converted image under QEMU (TCG) and time each boot stage
+    
+    Stages come from the serial console: bootloader banner, "Linux version",
+    the first "Run ... as init process" and ready_marker (see
+    docker2img.bootbench). The image is booted with snapshot=on, so the file
+    on the volume is never modified.
+    
+    Args:
+        filename: .img file on the conversion volume
+        ready_marker: Console text that marks the system as booted
+        runs: Number of boots; the summary is the median per stage
+        timeout: Seconds to wait for ready_marker per boot
+        memory_mb: Guest memory
+        arch: Guest architecture (amd64 or 386)
+        baseline: Another .img on the volume (e.g. the default profile) to boot
+            the same way; the result then includes the seconds saved per stage
+    
+    Returns:
+        dict: Per-run stage times in seconds since QEMU started, their
+            medians, and the image and converter version they describe
+    """
+    img_path = os.path.join("/tmp/conversion", os.path.basename(filename))
+    baseline_path = os.path.join("/tmp/conversion", os.path.basename(baseline)) if baseline else None
+    for path in (img_path, baseline_path):
+        if path and not os.path.exists(path):
+            return {"status": "error", "error": f"{os.path.basename(path)} not found on the conversion volume"}
+    try:
+        results = [
+            boot_once(img_path, ready_marker, timeout, arch, memory_mb)
+            for _ in range(max(1, runs))
+        ]
+        baseline_results = [
+            boot_once(baseline_path, ready_marker, timeout, arch, memory_mb)
+            for _ in range(max(1, runs))
+        ] if baseline_path else None
+    except (OSError, ValueError) as e:
+        return {"status": "error", "error": str(e)}
+    usage = _file_usage(img_path)
+    comparison = {}
+    if baseline_results:
+        median, baseline_median = summarize(results), summarize(baseline_results)
+        baseline_usage = _file_usage(baseline_path)
+        comparison = {
+            "baseline": {
+                "image": os.path.basename(baseline_path),
+                "allocated_bytes": baseline_usage["allocated_bytes"],
+                "runs": baseline_results,
+                "median_seconds": baseline_median,
+            },
+            "saved_seconds": {
+                stage: round(baseline_median[stage] - median[stage], 3)
+                if median[stage] is not None and baseline_median[stage] is not None else None
+                for stage in median
+            },
+            "saved_allocated_bytes": baseline_usage["allocated_bytes"] - usage["allocated_bytes"],
         }
+    return {
+        "status": "success",
+        "image": os.path.basename(img_path),
+        "size_bytes": usage["apparent_bytes"],
+        "allocated_bytes": usage["allocated_bytes"],
+        "converter_version": CONVERTER_VERSION,
+        "accelerator": "tcg",
+        "ready_marker": ready_marker,
+        "runs": results,
+        "median_seconds": summarize(results),
+        **comparison,
+    }
+
 
 @app.function(
     image=docker_converter_image,
     cpu=2,
-    memory=4096
+    memory=4096,
+    volumes={"/tmp/conversion": conversion_volume}
 )
 def list_conversion_files() -> list:
-    """List all converted .img files in the volume"""
+    """List all converted images (.img, .qcow2, .vmdk, .vhdx, .img.zst) in the volume"""
     conversion_dir = "/tmp/conversion"
+    # Pick up images committed by converters since this container started
+    conversion_volume.reload()
     if os.path.exists(conversion_dir):
         files = []
         for file in os.listdir(conversion_dir):
-            if file.endswith('.img'):
+            if file.endswith(tuple(f".{ext}" for ext in FORMAT_EXTENSIONS.values())):
                 file_path = os.path.join(conversion_dir, file)
-                file_size = os.path.getsize(file_path)
+                usage = _file_usage(file_path)
                 files.append({
                     "filename": file,
                     "path": file_path,
-                    "size_mb": file_size // (1024 * 1024)
+                    "size_mb": usage["apparent_bytes"] // (1024 * 1024),
+                    "allocated_mb": usage["allocated_bytes"] // (1024 * 1024)
                 })
         return files
     return []
@@ -304,18 +2647,217 @@ def list_conversion_files() -> list:
 @app.function(
     image=docker_converter_image,
     cpu=1,
-    memory=2048
+    memory=2048,
+    volumes={"/tmp/conversion": conversion_volume}
 )
 def cleanup_conversion_files() -> dict:
     """Clean up all conversion files from the volume"""
     conversion_dir = "/tmp/conversion"
-    if os.path.exists(conversion_dir):
-        shutil.rmtree(conversion_dir)
-        os.makedirs(conversion_dir, exist_ok=True)
+    conversion_volume.reload()
+    entries = os.listdir(conversion_dir) if os.path.exists(conversion_dir) else []
+    if entries:
+        # The directory is the volume mount, so only its contents are removed
+        for entry in entries:
+            path = os.path.join(conversion_dir, entry)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        conversion_volume.commit()
         return {"status": "success", "message": "All conversion files cleaned up"}
     return {"status": "info", "message": "No files to clean up"}
 
+@app.function(
+    image=docker_converter_image,
+    cpu=1,
+    memory=2048,
+    volumes={"/tmp/conversion": conversion_volume}
+)
+def list_kernel_bundles() -> list:
+    """List the prebuilt kernel bundles in the volume's bundle store"""
+    return KernelBundleStore(KERNEL_STORE_DIR).list()
+
+# Range reads and writes are small and I/O bound, so one container serves
+# many at once
+TRANSFER_CONCURRENCY = 16
+
+
+def _volume_image_path(filename: str) -> Optional[str]:
+    """Path of an output image on the conversion volume, or None if there is none by that name"""
+    path = os.path.join("/tmp/conversion", os.path.basename(filename))
+    if not path.endswith(tuple(f".{ext}" for ext in FORMAT_EXTENSIONS.values())) or not os.path.isfile(path):
+        return None
+    return path
+
+
+@app.function(
+    image=docker_converter_image,
+    cpu=1,
+    memory=2048,
+    volumes={"/tmp/conversion": conversion_volume}
+)
+def plan_image_download(filename: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict:
+    """
+    Split an image on the volume into the ranges a download fetches
+    
+    Ranges are chunk_size-aligned and those entirely in holes are left out
+    (see docker2img.transfer).
+    
+    Returns:
+        dict: The image name, its size and mtime, and the [offset, length]
+            ranges that hold data
+    """
+    img_path = _volume_image_path(filename)
+    if img_path is None:
+        return {"status": "error", "error": f"{os.path.basename(filename)} not found on the conversion volume"}
+    return {"status": "success", "image": os.path.basename(img_path), **plan_ranges(img_path, chunk_size)}
+
+
+@app.function(
+    image=docker_converter_image,
+    cpu=1,
+    memory=2048,
+    volumes={"/tmp/conversion": conversion_volume}
+)
+@modal.concurrent(max_inputs=TRANSFER_CONCURRENCY)
+def read_image_range(filename: str, offset: int, length: int) -> dict:
+    """Read one range of an image on the volume, with its sha256"""
+    img_path = _volume_image_path(filename)
+    if img_path is None:
+        raise FileNotFoundError(f"{os.path.basename(filename)} not found on the conversion volume")
+    return read_range(img_path, offset, length)
+
+# Ranges of archive layers being uploaded, one directory per upload, until
+# their blobs are assembled into the layer cache
+UPLOAD_DIR = "/tmp/conversion/cache/uploads"
+
+
+@app.function(
+    image=docker_converter_image,
+    cpu=1,
+    memory=2048,
+    volumes={"/tmp/conversion": conversion_volume}
+)
+def find_cached_layers(digests: List[str]) -> List[str]:
+    """
+    Return the layer digests already in the layer cache
+    
+    The blobs found are touched so eviction keeps them until a conversion
+    started right after the upload leases them.
+    """
+    conversion_volume.reload()
+    cache = BlobCache(LAYER_CACHE_DIR, LAYER_CACHE_MAX_MB * 1024 * 1024)
+    cached = [digest for digest in digests if cache.touch(digest)]
+    conversion_volume.commit()
+    return cached
+
+
+@app.function(
+    image=docker_converter_image,
+    cpu=1,
+    memory=2048,
+    volumes={"/tmp/conversion": conversion_volume}
+)
+@modal.concurrent(max_inputs=TRANSFER_CONCURRENCY)
+def upload_layer_range(upload_id: str, digest: str, offset: int, data: bytes, sha256: str) -> None:
+    """Store one range of an uploaded layer after checking its sha256"""
+    write_part(os.path.join(UPLOAD_DIR, os.path.basename(upload_id)), digest, offset, data, sha256)
+    conversion_volume.commit()
+
+
+@app.function(
+    image=docker_converter_image,
+    cpu=2,
+    memory=2048,
+    timeout=3600,
+    volumes={"/tmp/conversion": conversion_volume}
+)
+def import_uploaded_layers(upload_id: str, layers: List[Dict[str, Any]]) -> dict:
+    """
+    Assemble uploaded layers from their ranges into the layer cache
+    
+    Each blob is verified against its digest before it is cached; the
+    upload's ranges are removed either way.
+    
+    Returns:
+        dict: status, and the number of layers and bytes imported
+    """
+    conversion_volume.reload()
+    upload_dir = os.path.join(UPLOAD_DIR, os.path.basename(upload_id))
+    cache = BlobCache(LAYER_CACHE_DIR, LAYER_CACHE_MAX_MB * 1024 * 1024)
+    try:
+        for layer in layers:
+            cache.acquire(layer["digest"], lambda dest, l=layer: assemble_blob(upload_dir, l["digest"], l["size"], dest))
+    except (ArchiveError, OSError) as e:
+        return {"status": "error", "error": str(e)}
+    finally:
+        cache.release()
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        conversion_volume.commit()
+    return {"status": "success", "layers": len(layers), "bytes": cache.stats["bytes_fetched"]}
+
+
+def _upload_archive(path: str, reference: Optional[str], platform: str, concurrency: int,
+                    chunk_size: int = DEFAULT_CHUNK_SIZE) -> Dict[str, Any]:
+    """
+    Upload the layers of a local archive that the layer cache does not have
+    
+    Returns:
+        dict: The read_archive image (the archive_image conversion input)
+            plus an "upload" summary
+    """
+    image = read_archive(path, reference, platform)
+    layers = [dict(layer) for layer in {layer["digest"]: layer for layer in image["layers"]}.values()]
+    cached = set(find_cached_layers.remote([layer["digest"] for layer in layers]))
+    missing = [layer for layer in layers if layer["digest"] not in cached]
+    missing_bytes = sum(layer["size"] for layer in missing)
+    click.echo(f"Archive image {image['name'] or image['digest']}: {len(layers)} layers, "
+               f"{len(cached)} already on the volume, uploading {len(missing)} "
+               f"({missing_bytes // (1024 * 1024)}MB)")
+    
+    if missing:
+        upload_id = uuid.uuid4().hex
+        
+        def send(digest, offset, data, sha256):
+            upload_layer_range.remote(upload_id=upload_id, digest=digest, offset=offset, data=data, sha256=sha256)
+        
+        with click.progressbar(length=missing_bytes, label='Uploading') as bar:
+            shown = 0
+            
+            def progress(done, total):
+                nonlocal shown
+                bar.update(done - shown)
+                shown = done
+            
+            upload_layers(path, missing, send, chunk_size, concurrency, progress)
+        result = import_uploaded_layers.remote(
+            upload_id=upload_id,
+            layers=[{"digest": layer["digest"], "size": layer["size"]} for layer in missing]
+        )
+        if result["status"] != "success":
+            raise ArchiveError(result["error"])
+    image["upload"] = {"layers": len(layers), "cached_layers": len(cached), "uploaded_bytes": missing_bytes}
+    return image
+
 # CLI Interface using Click
+def _parse_formats(ctx, param, value):
+    """--format: a comma-separated list of output formats"""
+    formats = [fmt.strip() for fmt in value.split(',') if fmt.strip()]
+    unknown = [fmt for fmt in formats if fmt not in OUTPUT_FORMATS]
+    if unknown or not formats:
+        raise click.BadParameter(f"choose from {', '.join(OUTPUT_FORMATS)}")
+    return formats
+
+
+def _parse_disk_size(ctx, param, value):
+    """--size: a number of MB or auto"""
+    if value == 'auto':
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise click.BadParameter("must be a number of MB or 'auto'")
+
 @click.group()
 @click.option('--verbose', '-v', is_flag=True, help='Enable verbose output')
 @click.pass_context
@@ -327,52 +2869,216 @@ def cli(ctx, verbose):
         click.echo("Verbose mode enabled")
 
 @cli.command()
-@click.argument('docker_image')
+@click.argument('docker_image', required=False)
 @click.option('--output', '-o', default='bootable_system.img', 
               help='Output filename for the .img file')
-@click.option('--size', '-s', default=2048, type=int,
-              help='Disk size in MB (default: 2048)')
+@click.option('--size', '-s', default='2048', callback=_parse_disk_size,
+              help="Disk size in MB, or 'auto' to size it from the rootfs plus headroom (default: 2048)")
+@click.option('--headroom', default=DEFAULT_SIZE_HEADROOM, type=click.FloatRange(0),
+              help=f'Free space kept by --size auto and --shrink, as a fraction of the content '
+                   f'(default: {DEFAULT_SIZE_HEADROOM})')
+@click.option('--shrink', is_flag=True,
+              help='Shrink the finished ext root filesystem and the image to the content plus headroom '
+                   '(direct and stream backends)')
 @click.option('--filesystem', '-f', default='ext4', 
-              type=click.Choice(['ext4', 'ext3', 'ext2']),
-              help='Filesystem type (default: ext4)')
+              type=click.Choice(['ext4', 'ext3', 'ext2', 'squashfs', 'erofs', 'btrfs', 'f2fs']),
+              help='Filesystem type; squashfs/erofs build a compressed read-only root '
+                   'under a tmpfs overlay, sized from content; btrfs/f2fs are writable '
+                   'with zstd compression (default: ext4)')
+@click.option('--compress-level', default=DEFAULT_COMPRESS_LEVEL, type=click.IntRange(1, 15),
+              help=f'zstd level for btrfs/f2fs roots, compressed qcow2 clusters (--compress) and '
+                   f'.img.zst frames (default: {DEFAULT_COMPRESS_LEVEL})')
+@click.option('--format', 'output_format', default='raw', callback=_parse_formats,
+              help='Comma-separated output formats: raw, qcow2, vmdk, vhdx, zst (seekable zstd '
+                   '.img.zst); all are written from '
+                   'one read of the built image (default: raw)')
+@click.option('--compress', 'compress_output', is_flag=True,
+              help='zstd-compress the clusters of qcow2 outputs, including --backing-base overlays '
+                   'and their base; qemu-img writes overlays at its default level (zst output is '
+                   'always compressed; raw, vmdk and vhdx never are)')
+@click.option('--backing-base', default=None, metavar='IMAGE',
+              help='Write a qcow2 overlay on a shared, once-converted base image the Docker '
+                   'image is built on (e.g. debian:bookworm); needs --backend loop')
 @click.option('--wait/--no-wait', default=True,
               help='Wait for conversion to complete (default: wait)')
+@click.option('--keep-tar', is_flag=True,
+              help='Keep the intermediate export tar on the volume for debugging')
+@click.option('--sparse/--no-sparse', default=True,
+              help='Create the image as a sparse file (default: sparse)')
+@click.option('--backend', default='direct',
+              type=click.Choice(['direct', 'stream', 'loop']),
+              help='Image assembly backend: direct (no loop device/mount), stream '
+                   '(ext4 written straight from the export) or loop (default: direct)')
+@click.option('--source', 'image_source', default='registry',
+              type=click.Choice(['registry', 'docker']),
+              help='Fetch layers from the registry directly or pull through dockerd '
+                   '(default: registry)')
+@click.option('--from-archive', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Convert a local docker save or OCI layout tar instead of pulling; its layers are '
+                   'uploaded to the volume in parallel ranges, skipping those already there '
+                   '(DOCKER_IMAGE then picks a tag if the archive holds several images)')
+@click.option('--upload-concurrency', default=DEFAULT_CONCURRENCY, type=click.IntRange(1, 64),
+              help=f'Archive ranges uploaded at once (default: {DEFAULT_CONCURRENCY})')
+@click.option('--platform', default='linux/amd64',
+              help='Platform to select from multi-arch images (default: linux/amd64)')
+@click.option('--no-cache', is_flag=True,
+              help='Always convert, even if an identical result is cached')
+@click.option('--offline', is_flag=True,
+              help='Install kernel packages only from the shared apt cache (no downloads)')
+@click.option('--initramfs', 'initramfs', default='minimal',
+              type=click.Choice(['minimal', 'distro']),
+              help='Boot a generated initramfs with only the needed drivers, or keep '
+                   'the distribution initrd (default: minimal)')
+@click.option('--initramfs-compression', default='lz4',
+              type=click.Choice(['lz4', 'zstd', 'none']),
+              help='Minimal initramfs compression (default: lz4)')
+@click.option('--initramfs-modules', default=None,
+              help='Comma-separated drivers for the minimal initramfs '
+                   '(default: virtio, AHCI/PIIX, sd_mod and ext4)')
+@click.option('--profile', default='default',
+              type=click.Choice(['default', 'boot-fast']),
+              help='Image profile: boot-fast masks non-essential systemd units, removes unused '
+                   'kernel modules and firmware and skips the boot prompt (default: default)')
 @click.pass_context
-def convert(ctx, docker_image, output, size, filesystem, wait):
-    """Convert a Docker image to a bootable .img file"""
+def convert(ctx, docker_image, output, size, headroom, shrink, filesystem, wait, keep_tar, sparse, backend,
+            image_source, platform, no_cache, offline, initramfs, initramfs_compression,
+            initramfs_modules, profile, compress_level, output_format, compress_output, backing_base,
+            from_archive, upload_concurrency):
+    """Convert a Docker image (or a local image archive) to a bootable .img file"""
     verbose = ctx.obj['verbose']
     
+    if from_archive:
+        image_source = 'archive'
+    elif not docker_image:
+        raise click.UsageError("Give a DOCKER_IMAGE or --from-archive PATH")
     if verbose:
-        click.echo(f"Converting {docker_image} to {output}")
-        click.echo(f"Disk size: {size}MB, Filesystem: {filesystem}")
+        click.echo(f"Converting {docker_image or from_archive} to {output}")
+        click.echo(f"Disk size: {size}MB, Filesystem: {filesystem}, Backend: {backend}")
+        click.echo(f"Source: {image_source}, Platform: {platform}")
+    if backing_base and backend != 'loop':
+        raise click.UsageError("--backing-base applies layers to the mounted base root; use it with --backend loop")
+    if initramfs_modules:
+        initramfs_modules = [m.strip() for m in initramfs_modules.split(',') if m.strip()]
     
     try:
+        archive_image = None
+        if from_archive:
+            # Send the layers the volume does not have yet; the conversion
+            # then reads them from the layer cache
+            archive_image = _upload_archive(from_archive, docker_image, platform, upload_concurrency)
+            docker_image = archive_image.pop('name') or os.path.basename(from_archive)
+            upload = archive_image.pop('upload')
+            if verbose:
+                click.echo(f"Upload: {upload['cached_layers']} of {upload['layers']} layers deduplicated, "
+                           f"{upload['uploaded_bytes'] // (1024 * 1024)}MB sent")
+        
         click.echo(f"Starting conversion of {docker_image}...")
         
         if wait:
             # Synchronous call - wait for result
-            result = convert_docker_to_bootable_img.remote(
+            result = ConverterWorker().convert.remote(
                 docker_image=docker_image,
                 output_filename=output,
                 disk_size_mb=size,
-                filesystem_type=filesystem
+                filesystem_type=filesystem,
+                keep_tar=keep_tar,
+                sparse=sparse,
+                assembly_backend=backend,
+                image_source=image_source,
+                platform=platform,
+                use_cache=not no_cache,
+                apt_offline=offline,
+                initramfs=initramfs,
+                initramfs_compression=initramfs_compression,
+                initramfs_modules=initramfs_modules,
+                profile=profile,
+                compress_level=compress_level,
+                size_headroom=headroom,
+                shrink=shrink,
+                output_format=output_format,
+                compress_output=compress_output,
+                backing_base=backing_base,
+                archive_image=archive_image
             )
             
             if result['status'] == 'success':
                 click.echo(click.style("✓ Conversion completed successfully!", fg='green'))
                 click.echo(f"Output file: {result['output_file']}")
-                click.echo(f"File size: {result['file_size_mb']}MB")
+                click.echo(f"File size: {result['file_size_mb']}MB ({result['allocated_mb']}MB allocated)")
+                for output in result['outputs'][1:]:
+                    click.echo(f"Also written: {output['path']} ({output['size_bytes'] // (1024 * 1024)}MB)")
+                if result.get('backing'):
+                    backing = result['backing']
+                    click.echo(f"Overlay on {backing['base_image']} ({backing['base_size_mb']}MB base, "
+                               f"{'converted' if backing['base_built'] else 'reused'}): {backing['base_file']}")
+                if result.get('shrink') and result['shrink']['after_mb'] < result['shrink']['before_mb']:
+                    click.echo(f"Shrunk from {result['shrink']['before_mb']}MB to {result['shrink']['after_mb']}MB")
+                if result.get('result_cache') == 'hit':
+                    click.echo("Reused a cached conversion (use --no-cache to rebuild)")
+                if result.get('root_usage_bytes'):
+                    usage = result['root_usage_bytes']
+                    click.echo(f"Root filesystem: {usage['logical'] // (1024 * 1024)}MB of files in "
+                               f"{usage['physical'] // (1024 * 1024)}MB on disk")
+                if result.get('profile', {}).get('pruned'):
+                    pruned = result['profile']
+                    click.echo(f"boot-fast: removed {pruned['removed_bytes'] // (1024 * 1024)}MB "
+                               f"({pruned['removed_modules']} modules), "
+                               f"masked {len(pruned['masked_units'])} units")
+                if verbose:
+                    click.echo(f"Export: {result['export_bytes']} bytes, sha256 {result['export_sha256']}")
+                    for output in result['outputs']:
+                        click.echo(f"{output['format']}: sha256 {output['sha256']}")
+                    if result.get('manifest_digest'):
+                        click.echo(f"Manifest: {result['manifest_digest']}")
+                    if result.get('layer_cache'):
+                        cache = result['layer_cache']
+                        click.echo(f"Layer cache: {cache['hits']} hits, {cache['misses']} misses, "
+                                   f"{cache['bytes_saved'] // (1024 * 1024)}MB saved")
+                    if result.get('filesystem_tuning'):
+                        tuning = result['filesystem_tuning']
+                        click.echo(f"Filesystem: {tuning['inodes']} inodes for {tuning['scan']['files']} files, "
+                                   f"{tuning['block_size']}-byte blocks, {tuning['journal_mb']}MB journal, "
+                                   f"{tuning['reserved_percent']}% reserved")
+                    if result.get('initramfs'):
+                        info = result['initramfs']
+                        click.echo(f"Initramfs: {info['size_bytes'] // 1024}KB {info['compression']}"
+                                   f"{' (cached)' if info['cached'] else ''}")
+                    if result.get('worker'):
+                        worker = result['worker']
+                        click.echo(f"Worker: {'cold' if worker['cold'] else 'warm'}, "
+                                   f"{worker['latency_seconds']}s latency "
+                                   f"(setup {worker['setup_seconds']}s, call {worker['call_seconds']}s)")
+                if result.get('tar_path'):
+                    click.echo(f"Export tar kept at: {result['tar_path']}")
             else:
                 click.echo(click.style("✗ Conversion failed!", fg='red'))
                 click.echo(f"Error: {result.get('error', 'Unknown error')}")
                 sys.exit(1)
         else:
             # Asynchronous call - spawn and return immediately
-            function_call = convert_docker_to_bootable_img.spawn(
+            function_call = ConverterWorker().convert.spawn(
                 docker_image=docker_image,
                 output_filename=output,
                 disk_size_mb=size,
-                filesystem_type=filesystem
+                filesystem_type=filesystem,
+                keep_tar=keep_tar,
+                sparse=sparse,
+                assembly_backend=backend,
+                image_source=image_source,
+                platform=platform,
+                use_cache=not no_cache,
+                apt_offline=offline,
+                initramfs=initramfs,
+                initramfs_compression=initramfs_compression,
+                initramfs_modules=initramfs_modules,
+                profile=profile,
+                compress_level=compress_level,
+                size_headroom=headroom,
+                shrink=shrink,
+                output_format=output_format,
+                compress_output=compress_output,
+                backing_base=backing_base,
+                archive_image=archive_image
             )
             click.echo(f"Conversion started asynchronously")
             click.echo(f"Function call ID: {function_call.object_id}")
@@ -385,28 +3091,85 @@ def convert(ctx, docker_image, output, size, filesystem, wait):
 @cli.command()
 @click.pass_context  
 def list(ctx):
-    """List all converted .img files"""
+    """List all converted images"""
     verbose = ctx.obj['verbose']
     
     try:
         files = list_conversion_files.remote()
         
         if not files:
-            click.echo("No .img files found")
+            click.echo("No image files found")
             return
             
-        click.echo(f"Found {len(files)} .img file(s):")
+        click.echo(f"Found {len(files)} image file(s):")
         click.echo()
         
         # Table header
-        click.echo(f"{'Filename':<30} {'Size (MB)':<12} {'Path'}")
-        click.echo("-" * 70)
+        click.echo(f"{'Filename':<30} {'Size (MB)':<12} {'Alloc (MB)':<12} {'Path'}")
+        click.echo("-" * 82)
         
         for file_info in files:
-            click.echo(f"{file_info['filename']:<30} {file_info['size_mb']:<12} {file_info['path']}")
+            click.echo(
+                f"{file_info['filename']:<30} {file_info['size_mb']:<12} "
+                f"{file_info['allocated_mb']:<12} {file_info['path']}"
+            )
+            
+    except Exception as e:
+        click.echo(click.style(f"✗ Error: {str(e)}", fg='red'))
+        sys.exit(1)
+
+@cli.command()
+@click.argument('filename')
+@click.option('--output', '-o', default=None,
+              help='Local file to write (default: FILENAME in the current directory)')
+@click.option('--concurrency', '-j', default=DEFAULT_CONCURRENCY, type=click.IntRange(1, 64),
+              help=f'Ranges fetched at once (default: {DEFAULT_CONCURRENCY})')
+@click.option('--chunk-size', default=DEFAULT_CHUNK_SIZE // (1024 * 1024), type=click.IntRange(1, 64),
+              help=f'Range size in MB (default: {DEFAULT_CHUNK_SIZE // (1024 * 1024)})')
+@click.pass_context
+def download(ctx, filename, output, concurrency, chunk_size):
+    """Download a converted image in parallel ranges, resuming if interrupted"""
+    verbose = ctx.obj['verbose']
+    output = output or os.path.basename(filename)
+    
+    try:
+        plan = plan_image_download.remote(filename=filename, chunk_size=chunk_size * 1024 * 1024)
+        if plan.pop('status') != 'success':
+            click.echo(click.style(f"✗ Error: {plan['error']}", fg='red'))
+            sys.exit(1)
+        
+        data_bytes = sum(length for _, length in plan['ranges'])
+        click.echo(f"Downloading {plan['image']} to {output}: {plan['size'] // (1024 * 1024)}MB image, "
+                   f"{data_bytes // (1024 * 1024)}MB in {len(plan['ranges'])} ranges, {concurrency} at a time")
+        
+        def fetch(offset, length):
+            return read_image_range.remote(filename=plan['image'], offset=offset, length=length)
+        
+        with click.progressbar(length=data_bytes, label='Downloading') as bar:
+            shown = 0
+            
+            def progress(done, total):
+                nonlocal shown
+                bar.update(done - shown)
+                shown = done
+            
+            start = time.time()
+            result = download_image(plan, fetch, output, concurrency=concurrency, progress=progress)
+        
+        elapsed = time.time() - start
+        fetched = result['bytes'] - result['resumed_bytes']
+        click.echo(click.style(f"✓ Downloaded {output}", fg='green'))
+        if result['resumed_ranges']:
+            click.echo(f"Resumed: {result['resumed_ranges']} ranges ({result['resumed_bytes'] // (1024 * 1024)}MB) "
+                       f"already on disk")
+        if verbose:
+            click.echo(f"Fetched {fetched // (1024 * 1024)}MB in {elapsed:.1f}s "
+                       f"({fetched / max(elapsed, 0.001) / (1024 * 1024):.1f}MB/s), "
+                       f"{result['retries']} ranges re-fetched after a checksum mismatch")
             
     except Exception as e:
         click.echo(click.style(f"✗ Error: {str(e)}", fg='red'))
+        click.echo("Run the same command again to resume")
         sys.exit(1)
 
 @cli.command()
@@ -428,6 +3191,27 @@ def cleanup(ctx):
         click.echo(click.style(f"✗ Error: {str(e)}", fg='red'))
         sys.exit(1)
 
+@cli.command()
+@click.pass_context
+def kernels(ctx):
+    """List prebuilt kernel bundles"""
+    try:
+        bundles = list_kernel_bundles.remote()
+        
+        if not bundles:
+            click.echo("No kernel bundles stored yet (a Debian/Ubuntu conversion adds one)")
+            return
+        
+        click.echo(f"{'Family':<10} {'Arch':<8} {'Version':<28} {'Size (MB)':>10}")
+        click.echo("-" * 59)
+        for bundle in bundles:
+            click.echo(f"{bundle['family']:<10} {bundle['arch']:<8} {bundle['version']:<28} "
+                       f"{bundle['size_bytes'] // (1024 * 1024):>10}")
+            
+    except Exception as e:
+        click.echo(click.style(f"✗ Error: {str(e)}", fg='red'))
+        sys.exit(1)
+
 @cli.command()
 @click.argument('function_call_id')
 @click.pass_context
@@ -459,6 +3243,62 @@ def status(ctx, function_call_id):
         click.echo(click.style(f"✗ Error: {str(e)}", fg='red'))
         sys.exit(1)
 
+@cli.command('bench-ext4')
+@click.option('--files', default=100000, type=int,
+              help='Number of small files in the synthetic rootfs (default: 100000)')
+@click.option('--max-file-size', default=4096, type=int,
+              help='Largest synthetic file in bytes (default: 4096)')
+@click.pass_context
+def bench_ext4(ctx, files, max_file_size):
+    """Benchmark the streaming ext4 writer against mkfs+mount+tar"""
+    try:
+        click.echo(f"Benchmarking filesystem build paths with {files} files...")
+        result = benchmark_ext4_writer.remote(file_count=files, max_file_size=max_file_size)
+        click.echo(json.dumps(result, indent=2))
+    except Exception as e:
+        click.echo(click.style(f"✗ Error: {str(e)}", fg='red'))
+        sys.exit(1)
+
+@cli.command('bench-boot')
+@click.argument('filename')
+@click.option('--ready-marker', default=DEFAULT_READY_MARKER,
+              help='Serial console text that marks the system as booted '
+                   '(default: the basic init banner)')
+@click.option('--runs', default=1, type=int, help='Number of boots to take the median of (default: 1)')
+@click.option('--timeout', default=300, type=int, help='Seconds to wait per boot (default: 300)')
+@click.option('--memory', default=512, type=int, help='Guest memory in MB (default: 512)')
+@click.option('--baseline', default=None,
+              help='Another image on the volume to boot for comparison (reports seconds saved)')
+@click.option('--json-output', type=click.Path(dir_okay=False, writable=True),
+              help='Also write the JSON result to this local file')
+@click.pass_context
+def bench_boot(ctx, filename, ready_marker, runs, timeout, memory, baseline, json_output):
+    """Boot a converted image under QEMU and time each boot stage"""
+    try:
+        click.echo(f"Booting {filename} under QEMU (TCG), {runs} run(s)...")
+        result = benchmark_boot.remote(
+            filename=filename, ready_marker=ready_marker, runs=runs,
+            timeout=timeout, memory_mb=memory, baseline=baseline
+        )
+        if result['status'] != 'success':
+            click.echo(click.style(f"✗ Error: {result['error']}", fg='red'))
+            sys.exit(1)
+        all_runs = result['runs'] + result.get('baseline', {}).get('runs', [])
+        if not ctx.obj['verbose']:
+            for run in all_runs:
+                run.pop('console')
+        output = json.dumps(result, indent=2)
+        click.echo(output)
+        if json_output:
+            with open(json_output, 'w') as f:
+                f.write(output + "\n")
+        if not all(run['ready'] for run in all_runs):
+            click.echo(click.style("✗ Ready marker not seen in every run", fg='red'))
+            sys.exit(1)
+    except Exception as e:
+        click.echo(click.style(f"✗ Error: {str(e)}", fg='red'))
+        sys.exit(1)
+
 @cli.command()
 @click.pass_context
 def examples(ctx):
@@ -472,6 +3312,9 @@ Basic conversion:
 Custom output filename and size:
   python docker_converter.py convert ubuntu:20.04 --output ubuntu-dev.img --size 4096
 
+Size the disk from the content and shrink it to fit afterwards:
+  python docker_converter.py convert ubuntu:20.04 --size auto --shrink
+
 Different filesystem:
   python docker_converter.py convert nginx:alpine --filesystem ext3 --size 1024
 
@@ -481,6 +3324,9 @@ Asynchronous conversion (don't wait):
 List all generated files:
   python docker_converter.py list
 
+Download an image in parallel ranges (rerun to resume after an interruption):
+  python docker_converter.py download bootable_system.img --concurrency 16
+
 Clean up all files:
   python docker_converter.py cleanup
 
@@ -489,6 +3335,37 @@ Check status of async conversion:
 
 Verbose mode:
   python docker_converter.py --verbose convert alpine:latest
+
+Write ext4 straight from the export (no staging directory):
+  python docker_converter.py convert alpine:latest --backend stream
+
+Rebuild even if an identical conversion is cached:
+  python docker_converter.py convert alpine:latest --no-cache
+
+Pull through the Docker daemon instead of the registry API:
+  python docker_converter.py convert alpine:latest --source docker
+
+Convert the arm64 variant of a multi-arch image:
+  python docker_converter.py convert alpine:latest --platform linux/arm64
+
+Benchmark the ext4 writer against mkfs+mount+tar:
+  python docker_converter.py bench-ext4 --files 100000
+
+Time a converted image's boot under QEMU:
+  python docker_converter.py bench-boot alpine_system.img --runs 3 --json-output boot.json
+
+Build a boot-optimized image and compare it against the default profile:
+  python docker_converter.py convert debian:bookworm --output fast.img --profile boot-fast
+  python docker_converter.py bench-boot fast.img --baseline bootable_system.img
+
+Compressed qcow2, every format from one build, and a thin overlay on a shared base image:
+  python docker_converter.py convert alpine:latest --format qcow2 --compress
+  python docker_converter.py convert alpine:latest --format raw,qcow2,vmdk,vhdx
+  python docker_converter.py convert alpine:latest --format zst
+  python docker_converter.py convert myapp:latest --backing-base debian:bookworm --backend loop
+
+Convert an image built locally or in air-gapped CI (docker save myapp:latest -o myapp.tar):
+  python docker_converter.py convert --from-archive myapp.tar --upload-concurrency 16
 """
     click.echo(examples_text)
 
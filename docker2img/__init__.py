@@ -0,0 +1,6 @@
+"""
+Helper modules for the Docker to bootable .img converter
+
+These modules have no Modal dependency so they can be imported both by the
+Modal functions in docker-to-bootable-modal.py and by local tooling.
+"""
@@ -0,0 +1,202 @@
+"""
+Shared apt (and apk) download cache for chroot package installs
+
+Downloaded .deb files and package lists are kept on the volume per release
+and architecture ("debian-bookworm-amd64"), and bind-mounted over the
+chroot's /var/cache/apt/archives and /var/lib/apt/lists. Within a release a
+.deb is identified by its file name (name_version_arch.deb), so the archive
+directory is a content-keyed pool shared by every conversion of that release.
+
+apt's own fcntl locks do not work across containers sharing a network
+volume, so updates and downloads are serialized with VolumeLock (an atomic
+mkdir) and installs read the cache outside the lock. Packages an install is
+about to use are touched first, and eviction only removes files that have
+not been touched for longer than a conversion can run.
+
+The same layout serves Alpine's apk cache (package_suffix=".apk"), whose
+"archives" directory is passed to `apk --cache-dir`.
+"""
+
+import os
+import re
+import shutil
+import time
+import uuid
+from typing import Dict, Iterable, List
+
+DEFAULT_GRACE = 2 * 60 * 60  # Longer than the conversion function timeout
+
+_SIMULATE_LINE = re.compile(r"^Inst (\S+) (?:\[[^\]]*\] )?\((\S+) .*\[([^\]]+)\]\)")
+
+
+class AptCacheError(Exception):
+    """Raised when the cache cannot satisfy an install (e.g. offline misses)"""
+
+
+class VolumeLock:
+    """
+    Cross-container lock: a directory created with mkdir, which is atomic
+
+    Locks older than stale_after are assumed to belong to a crashed container
+    and are broken.
+    """
+
+    def __init__(self, path: str, timeout: float = 15 * 60, stale_after: float = DEFAULT_GRACE):
+        self.path = path
+        self.timeout = timeout
+        self.stale_after = stale_after
+
+    def __enter__(self) -> "VolumeLock":
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                os.mkdir(self.path)
+                return self
+            except FileExistsError:
+                pass
+            try:
+                if time.time() - os.path.getmtime(self.path) > self.stale_after:
+                    # Rename first so only one waiter breaks the stale lock
+                    stale_path = f"{self.path}.stale-{uuid.uuid4().hex}"
+                    os.rename(self.path, stale_path)
+                    os.rmdir(stale_path)
+                    continue
+            except OSError:
+                continue
+            if time.monotonic() > deadline:
+                raise AptCacheError(f"Timed out waiting for {self.path}")
+            time.sleep(1)
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            os.rmdir(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class AptCache:
+    """
+    Per-release apt archives and lists with size-bounded eviction
+
+    Args:
+        root: Cache directory, typically on the shared volume
+        max_bytes: Size the archives are trimmed to by evict()
+        grace: Files touched more recently than this are never evicted
+        package_suffix: Extension of the package files evict() considers
+    """
+
+    def __init__(self, root: str, max_bytes: int, grace: float = DEFAULT_GRACE,
+                 package_suffix: str = ".deb"):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self.package_suffix = package_suffix
+
+    @staticmethod
+    def release_key(os_release: Dict[str, str], arch: str) -> str:
+        distro = os_release.get("id", "debian")
+        release = os_release.get("version_codename") or os_release.get("version_id") or "unknown"
+        return re.sub(r"[^A-Za-z0-9._-]", "_", f"{distro}-{release}-{arch}")
+
+    def archives_dir(self, key: str) -> str:
+        path = os.path.join(self.root, key, "archives")
+        os.makedirs(os.path.join(path, "partial"), exist_ok=True)
+        return path
+
+    def lists_dir(self, key: str) -> str:
+        path = os.path.join(self.root, key, "lists")
+        os.makedirs(os.path.join(path, "partial"), exist_ok=True)
+        return path
+
+    def has_lists(self, key: str) -> bool:
+        lists = self.lists_dir(key)
+        return any(name.endswith(("_Packages", "_Packages.lz4", "_Packages.gz")) for name in os.listdir(lists))
+
+    def lock(self, key: str) -> VolumeLock:
+        os.makedirs(os.path.join(self.root, key), exist_ok=True)
+        return VolumeLock(os.path.join(self.root, key, ".lock"), stale_after=self.grace)
+
+    @staticmethod
+    def planned_files(simulate_output: str) -> List[str]:
+        """Archive file names for the packages in `apt-get install -s` output"""
+        files = []
+        for line in simulate_output.splitlines():
+            match = _SIMULATE_LINE.match(line)
+            if match:
+                name, version, arch = match.groups()
+                # apt escapes the epoch colon in archive file names
+                files.append(f"{name.split(':')[0]}_{version.replace(':', '%3a')}_{arch}.deb")
+        return files
+
+    def missing(self, key: str, files: Iterable[str]) -> List[str]:
+        archives = self.archives_dir(key)
+        return [name for name in files if not os.path.exists(os.path.join(archives, name))]
+
+    def touch(self, key: str, files: Iterable[str]) -> None:
+        """Mark files as in use so a concurrent eviction leaves them alone"""
+        archives = self.archives_dir(key)
+        for name in files:
+            try:
+                os.utime(os.path.join(archives, name))
+            except FileNotFoundError:
+                pass
+
+    def evict(self) -> Dict[str, int]:
+        """Trim every release's archives to max_bytes in total, oldest first"""
+        entries = []
+        total = 0
+        if not os.path.isdir(self.root):
+            return {"total_bytes": 0, "evicted_files": 0, "evicted_bytes": 0}
+        for key in os.listdir(self.root):
+            archives = os.path.join(self.root, key, "archives")
+            if not os.path.isdir(archives):
+                continue
+            for name in os.listdir(archives):
+                if not name.endswith(self.package_suffix):
+                    continue
+                path = os.path.join(archives, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, key, path))
+                total += st.st_size
+
+        evicted_files = evicted_bytes = 0
+        now = time.time()
+        entries.sort()
+        for mtime, size, key, path in entries:
+            if total <= self.max_bytes or now - mtime < self.grace:
+                break
+            with self.lock(key):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+            total -= size
+            evicted_files += 1
+            evicted_bytes += size
+        return {"total_bytes": total, "evicted_files": evicted_files, "evicted_bytes": evicted_bytes}
+
+
+def suspend_docker_clean(root: str, stash_dir: str) -> List[str]:
+    """
+    Move Docker's apt cleanup hooks out of a root for the duration of an
+    install: their DPkg::Post-Invoke deletes every .deb in the archive
+    directory, which would empty the shared cache. Returns the moved names.
+    """
+    conf_dir = os.path.join(root, "etc", "apt", "apt.conf.d")
+    moved = []
+    for name in ("docker-clean",):
+        path = os.path.join(conf_dir, name)
+        if os.path.isfile(path):
+            os.makedirs(stash_dir, exist_ok=True)
+            shutil.move(path, os.path.join(stash_dir, name))
+            moved.append(name)
+    return moved
+
+
+def restore_docker_clean(root: str, stash_dir: str, moved: List[str]) -> None:
+    conf_dir = os.path.join(root, "etc", "apt", "apt.conf.d")
+    for name in moved:
+        shutil.move(os.path.join(stash_dir, name), os.path.join(conf_dir, name))
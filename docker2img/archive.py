@@ -0,0 +1,296 @@
+"""
+Image archives (docker save / OCI layout tars) as conversion input
+
+read_archive finds the image in an uncompressed archive and lists its layer
+blobs by digest, with the offset of each inside the archive:
+
+- docker save: manifest.json names the config and the layer files; layers
+  stored as blobs/sha256/<hex> (Docker 25+) carry their digest in the path,
+  older <id>/layer.tar layers are identified by the config's diff_ids (the
+  sha256 of the uncompressed tar, which is what the file holds);
+- OCI layout: index.json points at manifests (or nested indexes, filtered by
+  platform) whose layers are blobs/sha256/<hex>.
+
+Upload goes through the layer blob cache on the volume. Layers whose digest
+is already cached are not sent at all; the others are cut into ranges that
+are read straight from the archive at their offset and sent concurrently.
+Each range is checked against its sha256 and stored as its own part file
+(containers do not share writes to one file on the volume), and
+assemble_blob joins the parts and verifies the layer digest before the blob
+enters the cache.
+"""
+
+import hashlib
+import json
+import os
+import posixpath
+import tarfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from docker2img.blobcache import BlobCache
+
+DOCKER_LAYER_MEDIA_TYPE = "application/vnd.docker.image.rootfs.diff.tar"
+
+
+class ArchiveError(Exception):
+    """Raised for archives that hold no usable image and for failed uploads"""
+
+
+def _hex(digest: str) -> str:
+    return BlobCache._hex(digest)
+
+
+class _Archive:
+    """Member lookup in a tar, following symlinks and hard links"""
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            self._tar = tarfile.open(path, "r:")
+        except tarfile.ReadError as e:
+            raise ArchiveError(f"{path} is not an uncompressed tar (decompress docker save output first): {e}")
+        self.members = {posixpath.normpath(m.name).lstrip("/"): m for m in self._tar.getmembers()}
+
+    def member(self, name: str) -> tarfile.TarInfo:
+        name = posixpath.normpath(name).lstrip("/")
+        for _ in range(8):
+            member = self.members.get(name)
+            if member is None:
+                raise ArchiveError(f"{self.path} has no {name}")
+            if member.issym():
+                name = posixpath.normpath(posixpath.join(posixpath.dirname(name), member.linkname))
+            elif member.islnk():
+                name = posixpath.normpath(member.linkname).lstrip("/")
+            else:
+                return member
+        raise ArchiveError(f"Too many links resolving {name} in {self.path}")
+
+    def read(self, name: str) -> bytes:
+        return self._tar.extractfile(self.member(name)).read()
+
+    def read_json(self, name: str) -> Any:
+        return json.loads(self.read(name))
+
+    def close(self) -> None:
+        self._tar.close()
+
+
+def _blob_digest(name: str) -> Optional[str]:
+    """Digest of a blobs/<algorithm>/<hex> path"""
+    parts = posixpath.normpath(name).split("/")
+    if len(parts) == 3 and parts[0] == "blobs":
+        return f"{parts[1]}:{parts[2]}"
+    return None
+
+
+def _check_platform(config: Dict[str, Any], platform: str, path: str) -> None:
+    os_name, architecture, *rest = platform.split("/")
+    found = f"{config.get('os')}/{config.get('architecture')}"
+    if found != f"{os_name}/{architecture}" or (rest and config.get("variant") not in (None, rest[0])):
+        raise ArchiveError(f"{path} holds a {found} image, not {platform}")
+
+
+def _from_docker_manifest(archive: _Archive, reference: Optional[str], platform: str) -> Dict[str, Any]:
+    entries = archive.read_json("manifest.json")
+    if reference:
+        entries = [e for e in entries if reference in (e.get("RepoTags") or [])]
+    if len(entries) != 1:
+        tags = [tag for e in archive.read_json("manifest.json") for tag in e.get("RepoTags") or []]
+        raise ArchiveError(
+            f"{archive.path} holds {len(entries)} matching images; pick one of: {', '.join(tags) or 'untagged images'}"
+        )
+    entry = entries[0]
+    config_bytes = archive.read(entry["Config"])
+    config = json.loads(config_bytes)
+    _check_platform(config, platform, archive.path)
+    diff_ids = config.get("rootfs", {}).get("diff_ids", [])
+    if len(diff_ids) != len(entry["Layers"]):
+        raise ArchiveError(f"{archive.path}: {len(entry['Layers'])} layers but {len(diff_ids)} diff_ids")
+    layers = []
+    for name, diff_id in zip(entry["Layers"], diff_ids):
+        member = archive.member(name)
+        layers.append({
+            "digest": _blob_digest(name) or diff_id,
+            "size": member.size,
+            "mediaType": DOCKER_LAYER_MEDIA_TYPE,
+            "offset": member.offset_data,
+        })
+    tags = entry.get("RepoTags") or []
+    return {
+        "name": reference or (tags[0] if tags else None),
+        "digest": f"sha256:{hashlib.sha256(config_bytes).hexdigest()}",
+        "layers": layers,
+    }
+
+
+def _ref_name(descriptor: Dict[str, Any]) -> Optional[str]:
+    annotations = descriptor.get("annotations") or {}
+    return annotations.get("io.containerd.image.name") or annotations.get("org.opencontainers.image.ref.name")
+
+
+def _from_oci_index(archive: _Archive, reference: Optional[str], platform: str) -> Dict[str, Any]:
+    os_name, architecture, *rest = platform.split("/")
+    candidates: List[Tuple[Dict[str, Any], Optional[str]]] = []
+
+    def walk(index: Dict[str, Any], name: Optional[str]) -> None:
+        for descriptor in index.get("manifests", []):
+            entry_name = _ref_name(descriptor) or name
+            described = descriptor.get("platform")
+            if described and (described.get("os"), described.get("architecture")) != (os_name, architecture):
+                continue
+            blob = archive.read_json(f"blobs/{descriptor['digest'].replace(':', '/')}")
+            if "manifests" in blob:
+                walk(blob, entry_name)
+            elif "layers" in blob:
+                candidates.append((blob, entry_name))
+
+    walk(archive.read_json("index.json"), None)
+    if reference:
+        candidates = [c for c in candidates if c[1] in (reference, reference.rsplit(":", 1)[-1])]
+    if len(candidates) != 1:
+        raise ArchiveError(f"{archive.path} holds {len(candidates)} {platform} images matching {reference or 'any name'}")
+    manifest, name = candidates[0]
+    config_digest = manifest["config"]["digest"]
+    _check_platform(archive.read_json(f"blobs/{config_digest.replace(':', '/')}"), platform, archive.path)
+    layers = []
+    for layer in manifest["layers"]:
+        member = archive.member(f"blobs/{layer['digest'].replace(':', '/')}")
+        layers.append({
+            "digest": layer["digest"],
+            "size": member.size,
+            "mediaType": layer.get("mediaType", ""),
+            "offset": member.offset_data,
+        })
+    return {"name": reference or name, "digest": config_digest, "layers": layers}
+
+
+def read_archive(path: str, reference: Optional[str] = None, platform: str = "linux/amd64") -> Dict[str, Any]:
+    """
+    Find an image in a docker save or OCI layout archive
+
+    Args:
+        path: Uncompressed archive
+        reference: Tag to pick when the archive holds several images
+        platform: Platform the image must be for
+
+    Returns:
+        dict: name (the image's tag, if any), digest (of the image config,
+            i.e. the image ID) and layers ({digest, size, mediaType, offset}
+            with the offset of the blob inside the archive), base first
+    """
+    archive = _Archive(path)
+    try:
+        if "manifest.json" in archive.members:
+            image = _from_docker_manifest(archive, reference, platform)
+        elif "index.json" in archive.members:
+            image = _from_oci_index(archive, reference, platform)
+        else:
+            raise ArchiveError(f"{path} has neither manifest.json (docker save) nor index.json (OCI layout)")
+    finally:
+        archive.close()
+    for layer in image["layers"]:
+        _hex(layer["digest"])
+    return image
+
+
+def upload_layers(
+    path: str,
+    layers: List[Dict[str, Any]],
+    send: Callable[[str, int, bytes, str], None],
+    chunk_size: int,
+    concurrency: int,
+    progress: Optional[Callable[[int, int], None]] = None
+) -> int:
+    """
+    Send layer blobs from an archive in concurrent ranges
+
+    Args:
+        path: The archive read_archive described
+        layers: The read_archive layers to send (each digest once)
+        send: Called as send(digest, offset in the blob, data, sha256 of
+            data) from worker threads
+        chunk_size: Range size
+        concurrency: Ranges in flight at once
+        progress: Called with (bytes sent, bytes total) after every range
+
+    Returns:
+        int: Bytes sent
+    """
+    ranges = [
+        (layer, offset, min(chunk_size, layer["size"] - offset))
+        for layer in layers
+        for offset in range(0, max(layer["size"], 1), chunk_size)
+    ]
+    total = sum(length for _, _, length in ranges)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        def transfer(layer: Dict[str, Any], offset: int, length: int) -> int:
+            data = os.pread(fd, length, layer["offset"] + offset)
+            send(layer["digest"], offset, data, hashlib.sha256(data).hexdigest())
+            return length
+
+        sent = 0
+        with ThreadPoolExecutor(max(1, concurrency), thread_name_prefix="upload") as pool:
+            futures = [pool.submit(transfer, *r) for r in ranges]
+            try:
+                for future in as_completed(futures):
+                    sent += future.result()
+                    if progress:
+                        progress(sent, total)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        os.close(fd)
+    return sent
+
+
+def write_part(upload_dir: str, digest: str, offset: int, data: bytes, sha256: str) -> None:
+    """Store one uploaded range as a part file, after checking its sha256"""
+    if hashlib.sha256(data).hexdigest() != sha256:
+        raise ArchiveError(f"Range at {offset} of {digest} arrived corrupted")
+    part_dir = os.path.join(upload_dir, _hex(digest))
+    os.makedirs(part_dir, exist_ok=True)
+    part_path = os.path.join(part_dir, f"{offset:016d}")
+    with open(part_path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(part_path + ".tmp", part_path)
+
+
+def assemble_blob(upload_dir: str, digest: str, size: int, dest: str) -> int:
+    """
+    Join the parts of an uploaded blob into dest and verify its digest
+
+    Usable as a BlobCache.acquire fetch callback (with the other arguments
+    bound).
+    """
+    part_dir = os.path.join(upload_dir, _hex(digest))
+    names = sorted(n for n in os.listdir(part_dir) if not n.endswith(".tmp")) if os.path.isdir(part_dir) else []
+    digest_hash = hashlib.sha256()
+    written = 0
+    with open(dest, "wb") as out:
+        for name in names:
+            if int(name) != written:
+                raise ArchiveError(f"Upload of {digest} is missing the range at {written}")
+            with open(os.path.join(part_dir, name), "rb") as f:
+                data = f.read()
+            digest_hash.update(data)
+            out.write(data)
+            written += len(data)
+    if written != size:
+        raise ArchiveError(f"Upload of {digest} has {written} of {size} bytes")
+    if f"sha256:{digest_hash.hexdigest()}" != digest:
+        raise ArchiveError(f"Uploaded blob does not match {digest}")
+    return written
+
+
+def cached_layers(image: Dict[str, Any], cache: BlobCache) -> List[Tuple[str, str]]:
+    """(path, media type) of an uploaded image's layers, leased from the layer cache, base first"""
+    def missing(digest: str) -> Callable[[str], int]:
+        def fetch(dest: str) -> int:
+            raise ArchiveError(f"Layer {digest} is not in the layer cache; upload the archive again")
+        return fetch
+
+    return [(cache.acquire(layer["digest"], missing(layer["digest"])), layer["mediaType"]) for layer in image["layers"]]
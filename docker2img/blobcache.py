@@ -0,0 +1,209 @@
+"""
+Content-addressed layer blob cache
+
+Blobs are stored by digest under a shared directory (the conversion volume),
+so conversions running in different containers reuse the base layers they
+have in common instead of downloading them again.
+
+Layout:
+    <root>/sha256/<hex>               verified blob
+    <root>/leases/<hex>/<lease id>    one file per reader holding the blob
+    <root>/tmp/                       in-flight downloads
+
+Inserts download into tmp/ and are renamed into place only after the digest
+has been verified, so readers never see a partial blob. Leases are files
+rather than a counter so that concurrent containers never have to update the
+same file; a lease left behind by a crashed container expires after
+lease_ttl. Lease directories are only pruned by eviction, once empty and
+stale, so a reader never loses the directory it is creating a lease in.
+Eviction removes the least recently used blobs that have no live lease and
+have not been used within lease_ttl, until the cache fits in max_bytes.
+"""
+
+import os
+import time
+import uuid
+from typing import Callable, Dict, List, Tuple
+
+DEFAULT_LEASE_TTL = 2 * 60 * 60  # Longer than the conversion function timeout
+
+
+class BlobCache:
+    """
+    Digest-keyed blob store with leases and size-bounded LRU eviction
+
+    Args:
+        root: Cache directory, typically on the shared volume
+        max_bytes: Size the cache is trimmed to after inserts
+        lease_ttl: Seconds after which leases and partial downloads are stale
+    """
+
+    def __init__(self, root: str, max_bytes: int, lease_ttl: float = DEFAULT_LEASE_TTL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lease_ttl = lease_ttl
+        self._leases: List[str] = []
+        self.stats: Dict[str, int] = {
+            "hits": 0, "misses": 0, "bytes_saved": 0, "bytes_fetched": 0,
+            "evicted_blobs": 0, "evicted_bytes": 0,
+        }
+        for sub in ("sha256", "leases", "tmp"):
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+
+    @staticmethod
+    def _hex(digest: str) -> str:
+        algorithm, _, value = digest.partition(":")
+        if algorithm != "sha256" or not value or not all(c in "0123456789abcdef" for c in value):
+            raise ValueError(f"Unsupported digest: {digest}")
+        return value
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, "sha256", self._hex(digest))
+
+    def touch(self, digest: str) -> bool:
+        """
+        Refresh a blob's LRU position if it is cached; returns whether it is
+
+        A touched blob is safe from eviction for lease_ttl, long enough for a
+        conversion started now to lease it.
+        """
+        try:
+            os.utime(self.path(digest))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def acquire(self, digest: str, fetch: Callable[[str], int]) -> str:
+        """
+        Return the cached path of a blob, downloading it on a miss
+
+        The lease is taken before the lookup so a concurrent eviction either
+        sees it or has already removed the blob (which is then a miss).
+
+        Args:
+            digest: Blob digest ("sha256:...")
+            fetch: Called with a temporary path to download and verify the
+                blob into; returns the number of bytes written
+        """
+        blob_path = self.path(digest)
+        lease_dir = os.path.join(self.root, "leases", self._hex(digest))
+        lease_path = os.path.join(lease_dir, uuid.uuid4().hex)
+        for attempt in range(3):
+            os.makedirs(lease_dir, exist_ok=True)
+            try:
+                with open(lease_path, "w"):
+                    pass
+                break
+            except FileNotFoundError:
+                # evict() pruned the empty lease directory in between
+                if attempt == 2:
+                    raise
+        self._leases.append(lease_path)
+
+        try:
+            size = os.path.getsize(blob_path)
+        except FileNotFoundError:
+            size = None
+        if size is not None:
+            # Refresh the LRU position; mtime rather than atime, which the
+            # volume may not track
+            os.utime(blob_path)
+            self.stats["hits"] += 1
+            self.stats["bytes_saved"] += size
+            return blob_path
+
+        tmp_path = os.path.join(self.root, "tmp", f"{self._hex(digest)}.{uuid.uuid4().hex}")
+        try:
+            size = fetch(tmp_path)
+            os.replace(tmp_path, blob_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.stats["misses"] += 1
+        self.stats["bytes_fetched"] += size
+        return blob_path
+
+    def release(self) -> None:
+        """
+        Drop every lease taken through this instance
+
+        Lease directories are left in place, since another container may be
+        creating a lease in one; evict() prunes them once they are stale.
+        """
+        for lease_path in self._leases:
+            try:
+                os.remove(lease_path)
+            except FileNotFoundError:
+                pass
+        self._leases = []
+
+    def _live_leases(self, hex_digest: str, now: float) -> bool:
+        lease_dir = os.path.join(self.root, "leases", hex_digest)
+        try:
+            names = os.listdir(lease_dir)
+        except FileNotFoundError:
+            return False
+        live = False
+        for name in names:
+            lease_path = os.path.join(lease_dir, name)
+            try:
+                if now - os.path.getmtime(lease_path) < self.lease_ttl:
+                    live = True
+                else:
+                    os.remove(lease_path)
+            except FileNotFoundError:
+                pass
+        return live
+
+    def evict(self) -> Dict[str, int]:
+        """Trim the cache to max_bytes, least recently used blobs first"""
+        now = time.time()
+        tmp_dir = os.path.join(self.root, "tmp")
+        for name in os.listdir(tmp_dir):
+            tmp_path = os.path.join(tmp_dir, name)
+            try:
+                if now - os.path.getmtime(tmp_path) >= self.lease_ttl:
+                    os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+
+        # Empty lease directories untouched for lease_ttl
+        lease_root = os.path.join(self.root, "leases")
+        for name in os.listdir(lease_root):
+            lease_dir = os.path.join(lease_root, name)
+            try:
+                if now - os.path.getmtime(lease_dir) >= self.lease_ttl:
+                    os.rmdir(lease_dir)
+            except OSError:
+                # Gone already, or holds leases
+                pass
+
+        blobs: List[Tuple[float, int, str]] = []
+        total = 0
+        blob_dir = os.path.join(self.root, "sha256")
+        for name in os.listdir(blob_dir):
+            try:
+                st = os.stat(os.path.join(blob_dir, name))
+            except FileNotFoundError:
+                continue
+            blobs.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        blobs.sort()
+        remaining = len(blobs)
+        for mtime, size, name in blobs:
+            if total <= self.max_bytes:
+                break
+            # Recently used blobs may be leased by a container whose lease
+            # is not visible here yet, so they are never evicted
+            if now - mtime < self.lease_ttl or self._live_leases(name, now):
+                continue
+            try:
+                os.remove(os.path.join(blob_dir, name))
+            except FileNotFoundError:
+                continue
+            total -= size
+            remaining -= 1
+            self.stats["evicted_blobs"] += 1
+            self.stats["evicted_bytes"] += size
+        return {"total_bytes": total, "blobs": remaining}
@@ -0,0 +1,151 @@
+"""
+Headless boot-time measurement under QEMU
+
+Boots a raw disk image with software emulation (TCG, so it runs in
+containers without /dev/kvm), reads the serial console and records when
+each boot stage first shows up, in seconds since QEMU was started:
+
+    bootloader   SYSLINUX/EXTLINUX banner (needs SERIAL in the boot config)
+    kernel       "Linux version ..."
+    init         "Run /init as init process" (initramfs or root init)
+    ready        a caller-chosen marker, e.g. the basic init's banner
+
+Stages that never appear are None. Times are wall clock on the host, so
+they compare images and converter versions on the same machine, not
+absolute boot times on hardware.
+"""
+
+import os
+import re
+import selectors
+import subprocess
+import time
+from typing import Any, Dict, List, Optional
+
+DEFAULT_READY_MARKER = "Container-based Linux system booted successfully!"
+
+STAGE_PATTERNS = [
+    ("bootloader", re.compile(r"(SYSLINUX|EXTLINUX) \d")),
+    ("kernel", re.compile(r"Linux version \d")),
+    ("init", re.compile(r"Run \S+ as init process")),
+]
+
+QEMU_BINARIES = {"amd64": "qemu-system-x86_64", "386": "qemu-system-i386"}
+
+
+class BootTimer:
+    """Match serial console lines against the boot stages as they arrive"""
+
+    def __init__(self, ready_marker: str = DEFAULT_READY_MARKER, start: Optional[float] = None):
+        self.ready_marker = ready_marker
+        self.start = time.monotonic() if start is None else start
+        self.stages: Dict[str, Optional[float]] = {name: None for name, _ in STAGE_PATTERNS}
+        self.stages["ready"] = None
+
+    def feed(self, line: str, now: Optional[float] = None) -> None:
+        elapsed = round((time.monotonic() if now is None else now) - self.start, 3)
+        for name, pattern in STAGE_PATTERNS:
+            if self.stages[name] is None and pattern.search(line):
+                self.stages[name] = elapsed
+        if self.stages["ready"] is None and self.ready_marker in line:
+            self.stages["ready"] = elapsed
+
+    @property
+    def ready(self) -> bool:
+        return self.stages["ready"] is not None
+
+
+def qemu_command(image_path: str, arch: str = "amd64", memory_mb: int = 512, cpus: int = 1) -> List[str]:
+    """QEMU arguments for a headless, throwaway (snapshot=on) boot on the serial console"""
+    if arch not in QEMU_BINARIES:
+        raise ValueError(f"Boot benchmarks support {', '.join(QEMU_BINARIES)}, not {arch}")
+    return [
+        QEMU_BINARIES[arch],
+        "-accel", "tcg",
+        "-m", str(memory_mb),
+        "-smp", str(cpus),
+        "-drive", f"file={image_path},format=raw,snapshot=on",
+        "-boot", "c",
+        "-display", "none",
+        "-monitor", "none",
+        "-serial", "stdio",
+        "-no-reboot",
+    ]
+
+
+def boot_once(
+    image_path: str,
+    ready_marker: str = DEFAULT_READY_MARKER,
+    timeout: float = 300,
+    arch: str = "amd64",
+    memory_mb: int = 512,
+    keep_console: bool = False
+) -> Dict[str, Any]:
+    """
+    Boot an image once and time the stages
+
+    QEMU is killed as soon as the ready marker appears or the timeout
+    expires; the guest is never shut down cleanly (the disk is a snapshot).
+
+    Returns:
+        dict: stages (seconds or None per stage), ready, timed_out, and the
+            console tail (all of it with keep_console)
+    """
+    timer = BootTimer(ready_marker)
+    process = subprocess.Popen(
+        qemu_command(image_path, arch, memory_mb),
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    console: List[str] = []
+    pending = b""
+    timed_out = False
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ)
+    try:
+        while not timer.ready:
+            remaining = timer.start + timeout - time.monotonic()
+            if remaining <= 0:
+                timed_out = True
+                break
+            if not selector.select(min(remaining, 1.0)):
+                continue
+            chunk = os.read(process.stdout.fileno(), 65536)
+            if not chunk:
+                break
+            now = time.monotonic()
+            pending += chunk
+            # The serial console ends lines with \r\n; a partial line is
+            # matched too so a marker without a newline is not missed
+            *lines, pending = re.split(rb"\r?\n", pending)
+            for raw in lines + [pending]:
+                timer.feed(raw.decode(errors="replace"), now)
+            for raw in lines:
+                console.append(raw.decode(errors="replace").rstrip("\r"))
+    finally:
+        selector.close()
+        process.kill()
+        process.wait()
+        process.stdout.close()
+    if pending:
+        console.append(pending.decode(errors="replace"))
+    return {
+        "stages": timer.stages,
+        "ready": timer.ready,
+        "timed_out": timed_out,
+        "exit_code": None if timer.ready or timed_out else process.returncode,
+        "console": console if keep_console else console[-20:],
+    }
+
+
+def summarize(runs: List[Dict[str, Any]]) -> Dict[str, Optional[float]]:
+    """Median seconds per stage over the runs that reached it"""
+    summary: Dict[str, Optional[float]] = {}
+    for name in runs[0]["stages"] if runs else []:
+        times = sorted(run["stages"][name] for run in runs if run["stages"][name] is not None)
+        if not times:
+            summary[name] = None
+        elif len(times) % 2:
+            summary[name] = times[len(times) // 2]
+        else:
+            summary[name] = round((times[len(times) // 2 - 1] + times[len(times) // 2]) / 2, 3)
+    return summary
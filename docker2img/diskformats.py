@@ -0,0 +1,551 @@
+"""
+Single-pass multi-format disk image export
+
+The finished raw image is read once, in 2MB chunks over its data extents
+(holes and all-zero chunks are skipped), and every chunk is handed to one
+writer per requested format. Each writer runs in its own thread behind a
+bounded queue, so all formats are written at the same time:
+
+    raw     sparse copy
+    qcow2   version 3, 64K clusters, optionally zstd-compressed clusters
+    vmdk    monolithic sparse (hosted VMware) with 64K grains
+    vhdx    dynamic, 2MB blocks
+    zst     seekable zstd (.img.zst, docker2img.seekzstd), frames compressed
+            on a thread pool
+
+Writers append data in the order it arrives and lay out their tables once
+all data is written; anything never written reads back as zeros in every
+format. Each output's SHA-256 is computed in its writer thread right after
+it is closed.
+"""
+
+import errno
+import hashlib
+import math
+import os
+import queue
+import struct
+import threading
+import uuid
+from typing import Any, Dict, Iterator, List, Tuple
+
+from docker2img.seekzstd import SeekableZstdWriter
+
+FORMAT_EXTENSIONS = {"raw": "img", "qcow2": "qcow2", "vmdk": "vmdk", "vhdx": "vhdx", "zst": "img.zst"}
+
+READ_CHUNK = 2 * 1024 * 1024
+QUEUE_DEPTH = 8
+HASH_CHUNK = 4 * 1024 * 1024
+MB = 1024 * 1024
+
+_ZEROS = bytes(READ_CHUNK)
+
+
+def _is_zero(data: bytes) -> bool:
+    return _ZEROS.startswith(data)
+
+
+def _align(value: int, alignment: int) -> int:
+    return -(-value // alignment) * alignment
+
+
+class _RawWriter:
+    """Sparse raw copy"""
+
+    def __init__(self, path: str, size: int):
+        self.size = size
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    def write(self, offset: int, data: bytes) -> None:
+        os.pwrite(self._fd, data, offset)
+
+    def close(self) -> None:
+        os.ftruncate(self._fd, self.size)
+        os.close(self._fd)
+
+
+QCOW2_CLUSTER_BITS = 16
+QCOW2_COPIED = 1 << 63
+QCOW2_COMPRESSED = 1 << 62
+QCOW2_COMPRESSION_ZSTD = 1
+QCOW2_INCOMPAT_COMPRESSION = 1 << 3
+
+
+class _Qcow2Writer:
+    """
+    qcow2 v3 without backing file or snapshots: data clusters are appended
+    after the header, then the L2 tables, L1 table and refcounts
+
+    Compressed clusters are zstd frames packed back to back (the
+    compression_type header field makes this incompatible with qemu before
+    5.1); clusters that do not shrink are stored as they are.
+    """
+
+    cluster_size = 1 << QCOW2_CLUSTER_BITS
+
+    def __init__(self, path: str, size: int, compress: bool = False, level: int = 3):
+        self.size = size
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._compressor = None
+        if compress:
+            import zstandard
+            self._compressor = zstandard.ZstdCompressor(level=level)
+        self._l2: Dict[int, int] = {}        # guest cluster -> L2 entry
+        self._refcounts: Dict[int, int] = {}  # host cluster -> references
+        self._cursor = self.cluster_size     # cluster 0 holds the header
+
+    def write(self, offset: int, data: bytes) -> None:
+        cs = self.cluster_size
+        for start in range(0, len(data), cs):
+            cluster = data[start:start + cs]
+            if not _is_zero(cluster):
+                self._add_cluster((offset + start) // cs, cluster.ljust(cs, b"\0"))
+
+    def _add_cluster(self, index: int, cluster: bytes) -> None:
+        cs = self.cluster_size
+        if self._compressor:
+            packed = self._compressor.compress(cluster)
+            if len(packed) < cs:
+                host = self._cursor
+                os.pwrite(self._fd, packed, host)
+                self._cursor += len(packed)
+                end = host + len(packed) - 1
+                # Sectors used beyond the one holding the first byte
+                sectors = (end >> 9) - (host >> 9)
+                shift = 62 - (QCOW2_CLUSTER_BITS - 8)
+                self._l2[index] = QCOW2_COMPRESSED | (sectors << shift) | host
+                for host_cluster in range(host >> QCOW2_CLUSTER_BITS, (end >> QCOW2_CLUSTER_BITS) + 1):
+                    self._refcounts[host_cluster] = self._refcounts.get(host_cluster, 0) + 1
+                return
+        host = _align(self._cursor, cs)
+        os.pwrite(self._fd, cluster, host)
+        self._cursor = host + cs
+        self._refcounts[host >> QCOW2_CLUSTER_BITS] = 1
+        self._l2[index] = QCOW2_COPIED | host
+
+    def close(self) -> None:
+        cs = self.cluster_size
+        entries_per_table = cs // 8
+        l1_size = max(1, math.ceil(math.ceil(self.size / cs) / entries_per_table))
+        next_cluster = _align(self._cursor, cs) // cs
+
+        l2_offsets = {}
+        for table in sorted({index // entries_per_table for index in self._l2}):
+            l2_offsets[table] = next_cluster * cs
+            next_cluster += 1
+        l1_offset = next_cluster * cs
+        next_cluster += math.ceil(l1_size * 8 / cs)
+
+        # The refcount blocks and table count themselves too
+        refcounts_per_block = cs // 2
+        blocks = table_clusters = 1
+        while True:
+            total = next_cluster + blocks + table_clusters
+            needed = math.ceil(total / refcounts_per_block)
+            needed_table = math.ceil(needed * 8 / cs)
+            if needed <= blocks and needed_table <= table_clusters:
+                break
+            blocks, table_clusters = max(blocks, needed), max(table_clusters, needed_table)
+        blocks_start = next_cluster
+        table_offset = (blocks_start + blocks) * cs
+        end_cluster = blocks_start + blocks + table_clusters
+
+        refcounts = dict(self._refcounts)
+        refcounts[0] = 1
+        for cluster in range(_align(self._cursor, cs) // cs, end_cluster):
+            refcounts[cluster] = 1
+
+        for table, table_offset_bytes in l2_offsets.items():
+            buf = bytearray(cs)
+            base = table * entries_per_table
+            for index in range(base, base + entries_per_table):
+                if index in self._l2:
+                    struct.pack_into(">Q", buf, (index - base) * 8, self._l2[index])
+            os.pwrite(self._fd, bytes(buf), table_offset_bytes)
+
+        l1 = bytearray(_align(l1_size * 8, cs))
+        for table, table_offset_bytes in l2_offsets.items():
+            struct.pack_into(">Q", l1, table * 8, QCOW2_COPIED | table_offset_bytes)
+        os.pwrite(self._fd, bytes(l1), l1_offset)
+
+        block_bufs = [bytearray(cs) for _ in range(blocks)]
+        for cluster, count in refcounts.items():
+            block, entry = divmod(cluster, refcounts_per_block)
+            struct.pack_into(">H", block_bufs[block], entry * 2, count)
+        for block, buf in enumerate(block_bufs):
+            os.pwrite(self._fd, bytes(buf), (blocks_start + block) * cs)
+        refcount_table = bytearray(table_clusters * cs)
+        for block in range(blocks):
+            struct.pack_into(">Q", refcount_table, block * 8, (blocks_start + block) * cs)
+        os.pwrite(self._fd, bytes(refcount_table), table_offset)
+
+        incompatible = QCOW2_INCOMPAT_COMPRESSION if self._compressor else 0
+        header = struct.pack(
+            ">4sIQIIQIIQQIIQQQQII",
+            b"QFI\xfb", 3,
+            0, 0,                       # no backing file
+            QCOW2_CLUSTER_BITS, self.size,
+            0,                          # no encryption
+            l1_size, l1_offset,
+            table_offset, table_clusters,
+            0, 0,                       # no snapshots
+            incompatible, 0, 0,
+            4,                          # 16-bit refcounts
+            112,                        # header length, with compression_type
+        )
+        header += struct.pack(">B7x", QCOW2_COMPRESSION_ZSTD if self._compressor else 0)
+        # Followed by the end-of-extensions marker (zeros)
+        os.pwrite(self._fd, header + bytes(8), 0)
+        os.ftruncate(self._fd, end_cluster * cs)
+        os.close(self._fd)
+
+
+VMDK_SECTOR = 512
+VMDK_GRAIN_SECTORS = 128
+VMDK_GTES_PER_GT = 512
+VMDK_DESCRIPTOR_SECTORS = 20
+
+VMDK_DESCRIPTOR = """# Disk DescriptorFile
+version=1
+CID={cid:08x}
+parentCID=ffffffff
+createType="monolithicSparse"
+
+# Extent description
+RW {sectors} SPARSE "{name}"
+
+# The Disk Data Base
+#DDB
+
+ddb.virtualHWVersion = "4"
+ddb.geometry.cylinders = "{cylinders}"
+ddb.geometry.heads = "16"
+ddb.geometry.sectors = "63"
+ddb.adapterType = "ide"
+"""
+
+
+class _VmdkWriter:
+    """
+    Monolithic sparse VMDK: header, descriptor, grain directory and all
+    grain tables up front, then the grains in the order they are written
+    """
+
+    def __init__(self, path: str, size: int):
+        self.size = size
+        self.name = os.path.basename(path)
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.capacity = math.ceil(size / VMDK_SECTOR)
+        grains = math.ceil(self.capacity / VMDK_GRAIN_SECTORS)
+        self.tables = max(1, math.ceil(grains / VMDK_GTES_PER_GT))
+        self.gd_offset = 1 + VMDK_DESCRIPTOR_SECTORS
+        self.gt_offset = self.gd_offset + math.ceil(self.tables * 4 / VMDK_SECTOR)
+        gt_sectors = VMDK_GTES_PER_GT * 4 // VMDK_SECTOR
+        self.overhead = _align(self.gt_offset + self.tables * gt_sectors, VMDK_GRAIN_SECTORS)
+        self._next = self.overhead
+        self._grains: Dict[int, int] = {}   # grain -> sector offset
+
+    def write(self, offset: int, data: bytes) -> None:
+        grain_bytes = VMDK_GRAIN_SECTORS * VMDK_SECTOR
+        for start in range(0, len(data), grain_bytes):
+            grain = data[start:start + grain_bytes]
+            if _is_zero(grain):
+                continue
+            os.pwrite(self._fd, grain.ljust(grain_bytes, b"\0"), self._next * VMDK_SECTOR)
+            self._grains[(offset + start) // grain_bytes] = self._next
+            self._next += VMDK_GRAIN_SECTORS
+
+    def close(self) -> None:
+        gt_sectors = VMDK_GTES_PER_GT * 4 // VMDK_SECTOR
+        header = struct.pack(
+            "<IIIQQQQIQQQB4sH433x",
+            0x564D444B, 1,
+            1,                          # valid newline detection
+            self.capacity, VMDK_GRAIN_SECTORS,
+            1, VMDK_DESCRIPTOR_SECTORS,
+            VMDK_GTES_PER_GT,
+            0,                          # no redundant grain directory
+            self.gd_offset, self.overhead,
+            0, b"\n \r\n", 0,
+        )
+        cylinders = min(self.capacity // (16 * 63), 16383)
+        descriptor = VMDK_DESCRIPTOR.format(
+            cid=uuid.uuid4().int & 0xFFFFFFFF, sectors=self.capacity, name=self.name, cylinders=cylinders
+        ).encode()
+        os.pwrite(self._fd, header + descriptor.ljust(VMDK_DESCRIPTOR_SECTORS * VMDK_SECTOR, b"\0"), 0)
+
+        directory = b"".join(
+            struct.pack("<I", self.gt_offset + table * gt_sectors) for table in range(self.tables)
+        )
+        os.pwrite(self._fd, directory, self.gd_offset * VMDK_SECTOR)
+        tables = bytearray(self.tables * VMDK_GTES_PER_GT * 4)
+        for grain, sector in self._grains.items():
+            struct.pack_into("<I", tables, grain * 4, sector)
+        os.pwrite(self._fd, bytes(tables), self.gt_offset * VMDK_SECTOR)
+        os.ftruncate(self._fd, self._next * VMDK_SECTOR)
+        os.close(self._fd)
+
+
+def _crc32c_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _crc32c_table()
+
+
+def crc32c(data: bytes) -> int:
+    """CRC-32C (Castagnoli), the checksum VHDX headers and region tables use"""
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = _CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+VHDX_BLOCK_SIZE = 2 * MB
+VHDX_LOGICAL_SECTOR = 512
+VHDX_PHYSICAL_SECTOR = 4096
+VHDX_LOG_OFFSET = 1 * MB
+VHDX_LOG_LENGTH = 1 * MB
+VHDX_METADATA_OFFSET = 2 * MB
+VHDX_METADATA_LENGTH = 1 * MB
+VHDX_BAT_OFFSET = 3 * MB
+VHDX_BLOCK_FULLY_PRESENT = 6
+
+VHDX_REGION_BAT = uuid.UUID("2DC27766-F623-4200-9D64-115E9BFD4A08")
+VHDX_REGION_METADATA = uuid.UUID("8B7CA206-4790-4B9A-B8FE-575F050F886E")
+VHDX_FILE_PARAMETERS = uuid.UUID("CAA16737-FA36-4D43-B3B6-33F0AA44E76B")
+VHDX_VIRTUAL_DISK_SIZE = uuid.UUID("2FA54224-CD1B-4876-B211-5DBED83BF4B8")
+VHDX_VIRTUAL_DISK_ID = uuid.UUID("BECA12AB-B2E6-4523-93EF-C309E000C746")
+VHDX_LOGICAL_SECTOR_SIZE = uuid.UUID("8141BF1D-A96F-4709-BA47-F233A8FAAB5F")
+VHDX_PHYSICAL_SECTOR_SIZE = uuid.UUID("CDA348C7-445D-4471-9CC9-E9885251C556")
+
+
+class _VhdxWriter:
+    """
+    Dynamic VHDX: file identifier, two headers, two region tables, an empty
+    log, the metadata region and the BAT in the first MBs, then 2MB payload
+    blocks in the order they are written
+    """
+
+    def __init__(self, path: str, size: int):
+        self.size = _align(size, VHDX_LOGICAL_SECTOR)
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.blocks = math.ceil(self.size / VHDX_BLOCK_SIZE)
+        # One sector bitmap entry follows every chunk_ratio payload entries
+        self.chunk_ratio = (1 << 23) * VHDX_LOGICAL_SECTOR // VHDX_BLOCK_SIZE
+        self.bat_entries = self.blocks + (self.blocks - 1) // self.chunk_ratio
+        self.bat_length = _align(self.bat_entries * 8, MB)
+        self._next = VHDX_BAT_OFFSET + self.bat_length
+        self._bat: Dict[int, int] = {}
+
+    def write(self, offset: int, data: bytes) -> None:
+        for start in range(0, len(data), VHDX_BLOCK_SIZE):
+            block = data[start:start + VHDX_BLOCK_SIZE]
+            if _is_zero(block):
+                continue
+            os.pwrite(self._fd, block.ljust(VHDX_BLOCK_SIZE, b"\0"), self._next)
+            index = (offset + start) // VHDX_BLOCK_SIZE
+            self._bat[index + index // self.chunk_ratio] = (self._next // MB) << 20 | VHDX_BLOCK_FULLY_PRESENT
+            self._next += VHDX_BLOCK_SIZE
+
+    def _header(self, sequence: int, file_guid: uuid.UUID, data_guid: uuid.UUID) -> bytes:
+        def pack(checksum: int) -> bytes:
+            return struct.pack(
+                "<4sIQ16s16s16sHHIQ", b"head", checksum, sequence,
+                file_guid.bytes_le, data_guid.bytes_le, bytes(16),
+                0, 1, VHDX_LOG_LENGTH, VHDX_LOG_OFFSET
+            ).ljust(4096, b"\0")
+        return pack(crc32c(pack(0)))
+
+    def _region_table(self) -> bytes:
+        def pack(checksum: int) -> bytes:
+            table = struct.pack("<4sIII", b"regi", checksum, 2, 0)
+            table += struct.pack("<16sQII", VHDX_REGION_BAT.bytes_le, VHDX_BAT_OFFSET, self.bat_length, 1)
+            table += struct.pack(
+                "<16sQII", VHDX_REGION_METADATA.bytes_le, VHDX_METADATA_OFFSET, VHDX_METADATA_LENGTH, 1
+            )
+            return table.ljust(64 * 1024, b"\0")
+        return pack(crc32c(pack(0)))
+
+    def _metadata(self) -> bytes:
+        required, virtual_disk = 4, 2
+        items = [
+            (VHDX_FILE_PARAMETERS, struct.pack("<II", VHDX_BLOCK_SIZE, 0), required),
+            (VHDX_VIRTUAL_DISK_SIZE, struct.pack("<Q", self.size), required | virtual_disk),
+            (VHDX_VIRTUAL_DISK_ID, uuid.uuid4().bytes_le, required | virtual_disk),
+            (VHDX_LOGICAL_SECTOR_SIZE, struct.pack("<I", VHDX_LOGICAL_SECTOR), required | virtual_disk),
+            (VHDX_PHYSICAL_SECTOR_SIZE, struct.pack("<I", VHDX_PHYSICAL_SECTOR), required | virtual_disk),
+        ]
+        table = struct.pack("<8sHH20x", b"metadata", 0, len(items))
+        data = b""
+        # Item data starts after the 64K table
+        for item_id, value, flags in items:
+            table += struct.pack("<16sIIII", item_id.bytes_le, 64 * 1024 + len(data), len(value), flags, 0)
+            data += value
+        return table.ljust(64 * 1024, b"\0") + data
+
+    def close(self) -> None:
+        file_guid, data_guid = uuid.uuid4(), uuid.uuid4()
+        identifier = b"vhdxfile" + "docker2img".encode("utf-16-le")
+        os.pwrite(self._fd, identifier, 0)
+        os.pwrite(self._fd, self._header(1, file_guid, data_guid), 64 * 1024)
+        os.pwrite(self._fd, self._header(2, file_guid, data_guid), 128 * 1024)
+        region_table = self._region_table()
+        os.pwrite(self._fd, region_table, 192 * 1024)
+        os.pwrite(self._fd, region_table, 256 * 1024)
+        os.pwrite(self._fd, self._metadata(), VHDX_METADATA_OFFSET)
+        bat = bytearray(self.bat_length)
+        for index, entry in self._bat.items():
+            struct.pack_into("<Q", bat, index * 8, entry)
+        os.pwrite(self._fd, bytes(bat), VHDX_BAT_OFFSET)
+        os.ftruncate(self._fd, self._next)
+        os.close(self._fd)
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 of a file's contents; holes are hashed as zeros without being read"""
+    digest = hashlib.sha256()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        offset = 0
+        for start, end in data_extents(fd, size) + [(size, size)]:
+            while offset < start:
+                length = min(READ_CHUNK, start - offset)
+                digest.update(_ZEROS[:length])
+                offset += length
+            while offset < end:
+                data = os.pread(fd, min(HASH_CHUNK, end - offset), offset)
+                digest.update(data)
+                offset += len(data)
+    finally:
+        os.close(fd)
+    return digest.hexdigest()
+
+
+def data_extents(fd: int, size: int) -> List[Tuple[int, int]]:
+    """(start, end) of each data region, or the whole file without hole detection"""
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                # No data past offset (trailing hole)
+                break
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            extents.append((start, end))
+            offset = end
+    except OSError:
+        return [(0, size)]
+    return extents
+
+
+def _chunks(fd: int, size: int, chunk_size: int) -> Iterator[Tuple[int, bytes]]:
+    """Yield (offset, data) for the chunk_size-aligned chunks that overlap data extents"""
+    last = -1
+    for start, end in data_extents(fd, size):
+        for chunk_start in range(start - start % chunk_size, end, chunk_size):
+            if chunk_start <= last:
+                continue
+            last = chunk_start
+            yield chunk_start, os.pread(fd, min(chunk_size, size - chunk_start), chunk_start)
+
+
+def _writer(fmt: str, path: str, size: int, compress: bool, level: int):
+    if fmt == "raw":
+        return _RawWriter(path, size)
+    if fmt == "qcow2":
+        return _Qcow2Writer(path, size, compress, level)
+    if fmt == "vmdk":
+        return _VmdkWriter(path, size)
+    if fmt == "vhdx":
+        return _VhdxWriter(path, size)
+    if fmt == "zst":
+        return SeekableZstdWriter(path, size, level)
+    raise ValueError(f"Unknown output format: {fmt}")
+
+
+def export_formats(
+    raw_path: str,
+    outputs: Dict[str, str],
+    compress: bool = False,
+    level: int = 3,
+    queue_depth: int = QUEUE_DEPTH
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Write a raw image in several formats from one read of it
+
+    Args:
+        raw_path: The finished raw image
+        outputs: Output path per format (raw, qcow2, vmdk, vhdx, zst)
+        compress: zstd-compress qcow2 clusters (other formats ignore it)
+        level: zstd level for compressed qcow2 clusters and zst frames
+        queue_depth: Chunks buffered per writer before the reader waits
+
+    Returns:
+        dict: Per format, path, size_bytes, allocated_bytes and sha256
+    """
+    fd = os.open(raw_path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        writers = {fmt: _writer(fmt, path, size, compress, level) for fmt, path in outputs.items()}
+        queues: Dict[str, queue.Queue] = {fmt: queue.Queue(maxsize=queue_depth) for fmt in writers}
+        errors: Dict[str, BaseException] = {}
+        results: Dict[str, Dict[str, Any]] = {}
+
+        def drain(fmt: str) -> None:
+            chunks = queues[fmt]
+            try:
+                while True:
+                    item = chunks.get()
+                    if item is None:
+                        break
+                    writers[fmt].write(*item)
+                writers[fmt].close()
+                st = os.stat(outputs[fmt])
+                results[fmt] = {
+                    "format": fmt,
+                    "path": outputs[fmt],
+                    "size_bytes": st.st_size,
+                    "allocated_bytes": st.st_blocks * 512,
+                    "sha256": file_sha256(outputs[fmt]),
+                }
+            except BaseException as e:
+                errors[fmt] = e
+                # Keep consuming so the reader never blocks on this queue
+                while item is not None:
+                    item = chunks.get()
+
+        threads = [
+            threading.Thread(target=drain, args=(fmt,), name=f"export-{fmt}", daemon=True)
+            for fmt in writers
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for chunk_start, data in _chunks(fd, size, READ_CHUNK):
+                if _is_zero(data):
+                    continue
+                for chunks in queues.values():
+                    chunks.put((chunk_start, data))
+        finally:
+            for chunks in queues.values():
+                chunks.put(None)
+            for thread in threads:
+                thread.join()
+    finally:
+        os.close(fd)
+    if errors:
+        fmt, error = next(iter(errors.items()))
+        raise RuntimeError(f"Writing the {fmt} image failed: {error}") from error
+    return {fmt: results[fmt] for fmt in outputs}
@@ -0,0 +1,83 @@
+"""
+Bounded copy of a rootfs export stream
+
+A reader thread pulls chunks from the source (the `docker export` pipe or a
+flattened registry rootfs) while the caller hashes them and writes them to
+the sink (`tar -x` or a kept tar file). The queue between them holds at most
+queue_depth chunks, so a slow sink stops the source from being drained
+instead of buffering the whole export in memory.
+
+When the sink fails, the copy stops: the reader gives up on its pending put
+and exits instead of blocking on a full queue nobody reads any more, so a
+long-lived worker does not keep a thread and its buffered chunks per failed
+export.
+"""
+
+import hashlib
+import queue
+import threading
+from typing import Any, BinaryIO, Dict
+
+EXPORT_CHUNK_SIZE = 1024 * 1024
+EXPORT_QUEUE_DEPTH = 16
+PUT_TIMEOUT = 0.5
+
+
+def stream_export(
+    source: BinaryIO,
+    sink: BinaryIO,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+    queue_depth: int = EXPORT_QUEUE_DEPTH
+) -> Dict[str, Any]:
+    """
+    Copy an export stream into a sink through a bounded buffer
+
+    Returns:
+        dict: Number of bytes copied and the sha256 of the stream
+    """
+    chunks: "queue.Queue" = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        """Queue an item unless the copy was stopped; returns whether it was queued"""
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        try:
+            while not stop.is_set():
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                if not put(chunk):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    thread = threading.Thread(target=reader, name="export-reader", daemon=True)
+    thread.start()
+
+    digest = hashlib.sha256()
+    total = 0
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            digest.update(chunk)
+            sink.write(chunk)
+            total += len(chunk)
+    finally:
+        stop.set()
+        thread.join(timeout=5)
+
+    return {"bytes": total, "sha256": digest.hexdigest()}
@@ -0,0 +1,177 @@
+"""
+Content-aware ext2/3/4 tuning
+
+A pre-scan of the rootfs (a staged directory or the export tar stream)
+counts files, directories and other entries and buckets file sizes; the
+mke2fs parameters are derived from that instead of the defaults:
+
+- inode count: at least the entries found plus an allowance for a kernel
+  install and growth, so trees of many tiny files do not run out of inodes,
+  and never fewer than mke2fs's default of one per 16K of filesystem, so
+  packages installed in the booted VM still find free inodes; only large
+  images (8GB+) whose files average 64K or more go down to one per 64K;
+- block size: 1K blocks for small filesystems that are mostly tiny files,
+  4K otherwise;
+- reserved blocks: none below 4GB (there is no root-only recovery space to
+  keep on a VM image), 1% above;
+- journal: sized to the filesystem (4-64MB) and added with tune2fs after the
+  filesystem is populated, so the data is written without journal overhead.
+
+Inode tables are initialized lazily either way (lazy_itable_init), which
+keeps mke2fs from writing them out on a large image.
+
+The same scan sizes disks automatically: estimate_fs_bytes rounds every file
+up to whole blocks and adds directory blocks and inode tables.
+"""
+
+import math
+import os
+import stat
+import tarfile
+from typing import Any, BinaryIO, Dict, List
+
+SIZE_BUCKETS = [1024, 4096, 65536, 1024 * 1024]
+KERNEL_INODE_ALLOWANCE = 8192
+INODE_HEADROOM = 0.25
+MIN_INODES = 8192
+# Bytes per inode: mke2fs's default, and the sparser ratio for large images
+# of large files
+DEFAULT_INODE_RATIO = 16384
+LARGE_FILE_INODE_RATIO = 65536
+LARGE_IMAGE_BYTES = 8 * 1024 ** 3
+
+
+def _new_stats() -> Dict[str, Any]:
+    return {
+        "files": 0,
+        "directories": 0,
+        "symlinks": 0,
+        "other": 0,
+        "file_bytes": 0,
+        # Blocks the files occupy at 4K, i.e. sizes rounded up per file
+        "file_blocks_4k": 0,
+        "kernels": 0,
+        # Files up to each bucket bound, plus one bucket for larger files
+        "size_histogram": [0] * (len(SIZE_BUCKETS) + 1),
+    }
+
+
+def _add_file(stats: Dict[str, Any], size: int) -> None:
+    stats["files"] += 1
+    stats["file_bytes"] += size
+    stats["file_blocks_4k"] += -(-size // 4096)
+    for i, bound in enumerate(SIZE_BUCKETS):
+        if size <= bound:
+            stats["size_histogram"][i] += 1
+            return
+    stats["size_histogram"][-1] += 1
+
+
+def scan_tree(root: str) -> Dict[str, Any]:
+    """Count entries and bucket file sizes under a directory (symlinks not followed)"""
+    stats = _new_stats()
+    boot_dir = os.path.join(root, "boot")
+    for dirpath, dirnames, filenames in os.walk(root):
+        stats["directories"] += 1
+        for name in dirnames:
+            # os.walk lists symlinks to directories as directories, but
+            # does not descend into (and count) them
+            if os.path.islink(os.path.join(dirpath, name)):
+                stats["symlinks"] += 1
+        for name in filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            if stat.S_ISREG(st.st_mode):
+                _add_file(stats, st.st_size)
+                if dirpath == boot_dir and name.startswith("vmlinuz"):
+                    stats["kernels"] += 1
+            elif stat.S_ISLNK(st.st_mode):
+                stats["symlinks"] += 1
+            else:
+                stats["other"] += 1
+    return stats
+
+
+def scan_tar(stream: BinaryIO) -> Dict[str, Any]:
+    """Count entries and bucket file sizes in a tar stream, reading it to the end"""
+    stats = _new_stats()
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            if member.isreg():
+                _add_file(stats, member.size)
+                if os.path.normpath(member.name).lstrip("/").startswith("boot/vmlinuz"):
+                    stats["kernels"] += 1
+            elif member.isdir():
+                stats["directories"] += 1
+            elif member.issym() or member.islnk():
+                stats["symlinks"] += 1
+            else:
+                stats["other"] += 1
+    # Drain the end-of-archive padding so the producer is not cut off
+    while stream.read(1024 * 1024):
+        pass
+    return stats
+
+
+def entry_count(stats: Dict[str, Any]) -> int:
+    return stats["files"] + stats["directories"] + stats["symlinks"] + stats["other"]
+
+
+def estimate_fs_bytes(stats: Dict[str, Any], inode_size: int = 256) -> int:
+    """Space the scanned tree needs on a 4K-block ext filesystem, before headroom"""
+    return (stats["file_blocks_4k"] + stats["directories"]) * 4096 + entry_count(stats) * inode_size
+
+
+def ext_tuning(stats: Dict[str, Any], fs_bytes: int, filesystem_type: str,
+               kernel_allowance: int = KERNEL_INODE_ALLOWANCE) -> Dict[str, Any]:
+    """
+    Derive mke2fs parameters from a rootfs scan
+
+    Args:
+        stats: scan_tree/scan_tar result
+        fs_bytes: Size of the filesystem to create
+        filesystem_type: ext2, ext3 or ext4
+        kernel_allowance: Inodes to keep for files added after the scan
+            (0 when the scan already includes the kernel)
+
+    Returns:
+        dict: block_size, inodes, reserved_percent, journal_mb (0 for ext2),
+            mkfs_args, the matching mke2fs arguments (journal left out), and
+            extended_options for -E (mke2fs honours only one -E, so callers
+            append their own options to it)
+    """
+    gb = 1024 ** 3
+    tiny = stats["size_histogram"][0]
+    block_size = 1024 if fs_bytes <= gb and stats["files"] and tiny / stats["files"] > 0.5 else 4096
+    content_inodes = math.ceil((entry_count(stats) + kernel_allowance) * (1 + INODE_HEADROOM))
+    large_files = stats["files"] and stats["file_bytes"] / stats["files"] >= LARGE_FILE_INODE_RATIO
+    inode_ratio = LARGE_FILE_INODE_RATIO if fs_bytes >= LARGE_IMAGE_BYTES and large_files else DEFAULT_INODE_RATIO
+    inodes = max(MIN_INODES, content_inodes, fs_bytes // inode_ratio)
+    # More inodes than blocks could never be used
+    inodes = min(inodes, fs_bytes // block_size)
+    reserved_percent = 0 if fs_bytes < 4 * gb else 1
+    journal_mb = 0
+    if filesystem_type != "ext2":
+        journal_mb = max(4, min(64, fs_bytes // (64 * 1024 * 1024)))
+
+    mkfs_args: List[str] = [
+        "-b", str(block_size),
+        "-N", str(inodes),
+        "-m", str(reserved_percent),
+    ]
+    if journal_mb:
+        mkfs_args += ["-O", "^has_journal"]
+    return {
+        "block_size": block_size,
+        "inodes": inodes,
+        "reserved_percent": reserved_percent,
+        "journal_mb": journal_mb,
+        "mkfs_args": mkfs_args,
+        "extended_options": "lazy_itable_init=1",
+    }
+
+
+def journal_args(tuning: Dict[str, Any]) -> List[str]:
+    """tune2fs arguments that add the journal left out at mkfs time"""
+    if not tuning["journal_mb"]:
+        return []
+    return ["-O", "has_journal", "-J", f"size={tuning['journal_mb']}"]
@@ -0,0 +1,195 @@
+"""
+Prebuilt kernel bundle store
+
+A bundle is a kernel harvested from a distro root (vmlinuz, initrd and the
+matching /lib/modules tree) packed as one tar, so injecting it into another
+root of the same distro family and architecture is a single sequential read
+with no package manager, chroot or network access.
+
+Layout:
+    <root>/<family>/<arch>/<kernel version>/bundle.tar
+    <root>/<family>/<arch>/<kernel version>/bundle.json
+
+bundle.tar holds boot/vmlinuz-<ver>, boot/initrd.img-<ver>, lib/modules/<ver>/
+and the Debian-style /vmlinuz and /initrd.img symlinks. It has no entries for
+lib/ or lib/modules/ themselves, so extracting it into a merged-/usr root
+follows the existing lib -> usr/lib symlink instead of replacing it.
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+# Families whose kernels are interchangeable between releases for our purposes
+_FAMILY_ALIASES = {"raspbian": "debian", "linuxmint": "ubuntu", "pop": "ubuntu"}
+
+
+class KernelBundleError(Exception):
+    """Raised when a bundle cannot be harvested or injected"""
+
+
+def parse_os_release(text: str) -> Dict[str, str]:
+    """Parse /etc/os-release into a dict of lower-cased keys"""
+    fields = {}
+    for line in text.splitlines():
+        key, sep, value = line.strip().partition("=")
+        if sep and not key.startswith("#"):
+            fields[key.lower()] = value.strip().strip("'\"")
+    return fields
+
+
+def distro_family(os_release: Dict[str, str]) -> Optional[str]:
+    """Map os-release fields to a bundle family ("debian", "ubuntu", ...)"""
+    distro_id = os_release.get("id", "").lower()
+    if not distro_id:
+        return None
+    if distro_id in _FAMILY_ALIASES:
+        return _FAMILY_ALIASES[distro_id]
+    if distro_id in ("debian", "ubuntu"):
+        return distro_id
+    like = os_release.get("id_like", "").lower().split()
+    if "ubuntu" in like:
+        return "ubuntu"
+    if "debian" in like:
+        return "debian"
+    return distro_id
+
+
+def platform_arch(platform: str) -> str:
+    """"linux/arm64/v8" -> "arm64" """
+    parts = platform.split("/")
+    return parts[1] if len(parts) > 1 else parts[0]
+
+
+def _version_key(version: str) -> List[Any]:
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", version)]
+
+
+class KernelBundleStore:
+    """
+    Kernel bundles on shared storage, keyed by family, architecture and version
+
+    Args:
+        root: Store directory, typically on the shared volume
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def lookup(self, family: str, arch: str, version: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Find a bundle, the newest version unless one is given
+
+        Returns:
+            dict: The bundle metadata plus "path" to its tar, or None
+        """
+        arch_dir = os.path.join(self.root, family, arch)
+        if version is None:
+            try:
+                versions = [v for v in os.listdir(arch_dir) if not v.startswith(".")]
+            except FileNotFoundError:
+                return None
+            versions = [v for v in versions if os.path.exists(os.path.join(arch_dir, v, "bundle.json"))]
+            if not versions:
+                return None
+            version = max(versions, key=_version_key)
+        bundle_dir = os.path.join(arch_dir, version)
+        try:
+            with open(os.path.join(bundle_dir, "bundle.json")) as f:
+                bundle = json.load(f)
+        except FileNotFoundError:
+            return None
+        bundle["path"] = os.path.join(bundle_dir, "bundle.tar")
+        return bundle
+
+    def list(self) -> List[Dict[str, Any]]:
+        bundles = []
+        if not os.path.isdir(self.root):
+            return bundles
+        for family in sorted(os.listdir(self.root)):
+            family_dir = os.path.join(self.root, family)
+            if family.startswith(".") or not os.path.isdir(family_dir):
+                continue
+            for arch in sorted(os.listdir(family_dir)):
+                arch_dir = os.path.join(family_dir, arch)
+                for version in sorted(os.listdir(arch_dir), key=_version_key):
+                    bundle = self.lookup(family, arch, version)
+                    if bundle:
+                        bundles.append(bundle)
+        return bundles
+
+    def add_from_root(self, root_dir: str, family: str, arch: str) -> Optional[Dict[str, Any]]:
+        """
+        Harvest the newest kernel installed in root_dir into the store
+
+        Returns:
+            dict: The stored bundle (as lookup returns it), or None if the
+                root has no complete kernel (vmlinuz, initrd and modules)
+        """
+        boot_dir = os.path.join(root_dir, "boot")
+        versions = []
+        if os.path.isdir(boot_dir):
+            for name in os.listdir(boot_dir):
+                if name.startswith("vmlinuz-"):
+                    version = name[len("vmlinuz-"):]
+                    if (os.path.exists(os.path.join(boot_dir, f"initrd.img-{version}"))
+                            and os.path.isdir(os.path.join(root_dir, "lib", "modules", version))):
+                        versions.append(version)
+        if not versions:
+            return None
+        version = max(versions, key=_version_key)
+        if self.lookup(family, arch, version):
+            return self.lookup(family, arch, version)
+
+        arch_dir = os.path.join(self.root, family, arch)
+        os.makedirs(arch_dir, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=arch_dir)
+        try:
+            tar_path = os.path.join(staging_dir, "bundle.tar")
+            with tarfile.open(tar_path, "w", format=tarfile.PAX_FORMAT) as tar:
+                for name in (f"vmlinuz-{version}", f"initrd.img-{version}"):
+                    tar.add(os.path.join(boot_dir, name), arcname=f"boot/{name}")
+                tar.add(os.path.join(root_dir, "lib", "modules", version), arcname=f"lib/modules/{version}")
+                for link, target in (("vmlinuz", f"boot/vmlinuz-{version}"),
+                                     ("initrd.img", f"boot/initrd.img-{version}")):
+                    info = tarfile.TarInfo(link)
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = target
+                    info.mtime = int(time.time())
+                    tar.addfile(info)
+            bundle = {
+                "family": family,
+                "arch": arch,
+                "version": version,
+                "size_bytes": os.path.getsize(tar_path),
+                "created": int(time.time()),
+            }
+            with open(os.path.join(staging_dir, "bundle.json"), "w") as f:
+                json.dump(bundle, f)
+            os.rename(staging_dir, os.path.join(arch_dir, version))
+        except OSError:
+            # Another container may have stored the same version first
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        return self.lookup(family, arch, version)
+
+    @staticmethod
+    def inject(bundle: Dict[str, Any], root_dir: str) -> None:
+        """Extract a bundle into a root directory"""
+        try:
+            subprocess.run([
+                "tar", "-xf", bundle["path"], "-C", root_dir, "--keep-directory-symlink"
+            ], check=True, capture_output=True, text=True)
+        except subprocess.CalledProcessError as e:
+            raise KernelBundleError(f"Injecting kernel {bundle['version']} failed: {e.stderr}") from e
+
+    @staticmethod
+    def inject_stream(bundle: Dict[str, Any], add_tar_stream: Callable[[Any], Any]) -> None:
+        """Feed a bundle to a tar consumer, e.g. Ext4Writer.add_tar_stream"""
+        with open(bundle["path"], "rb", buffering=0) as source:
+            add_tar_stream(source)
@@ -0,0 +1,173 @@
+"""
+Boot-optimized image profile ("boot-fast")
+
+Trims a staged root for VM boots:
+
+- masks systemd units that only matter on long-lived or physical machines
+  (timers for apt/man-db/fstrim, modem and wait-online services, ...) by
+  linking them to /dev/null in /etc/systemd/system, the same way
+  `systemctl mask` does;
+- removes kernel modules outside the subtrees a VM disk/console boot uses
+  (filesystems, virtio, block/SCSI/ATA/NVMe, crypto and library helpers),
+  keeping anything those depend on, then regenerates modules.dep;
+- removes /lib/firmware, which no emulated device loads.
+
+Every function returns what it removed so the conversion can report the
+savings. Nothing here needs a chroot; depmod runs with -b against the root.
+"""
+
+import os
+import shutil
+import subprocess
+from typing import Dict, Iterable, List, Set
+
+PROFILES = ("default", "boot-fast")
+
+MASKED_UNITS = [
+    "apt-daily.timer",
+    "apt-daily-upgrade.timer",
+    "man-db.timer",
+    "e2scrub_all.timer",
+    "e2scrub_reap.service",
+    "fstrim.timer",
+    "motd-news.timer",
+    "dpkg-db-backup.timer",
+    "logrotate.timer",
+    "unattended-upgrades.service",
+    "ModemManager.service",
+    "networkd-dispatcher.service",
+    "systemd-networkd-wait-online.service",
+    "NetworkManager-wait-online.service",
+    "systemd-pstore.service",
+    "systemd-firstboot.service",
+    "snapd.service",
+    "snapd.seeded.service",
+    "multipathd.service",
+    "lvm2-monitor.service",
+    "plymouth-start.service",
+]
+
+KEEP_MODULE_PREFIXES = (
+    "kernel/fs/",
+    "kernel/lib/",
+    "kernel/crypto/",
+    "kernel/arch/",
+    "kernel/drivers/virtio/",
+    "kernel/drivers/block/",
+    "kernel/drivers/scsi/",
+    "kernel/drivers/ata/",
+    "kernel/drivers/nvme/",
+    "kernel/drivers/md/",
+    "kernel/drivers/char/",
+    "kernel/drivers/tty/",
+    "kernel/drivers/net/virtio_net",
+    "kernel/drivers/net/net_failover",
+    "kernel/net/core/",
+)
+
+
+def _tree_size(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def mask_units(etc_systemd_dir: str, unit_dirs: Iterable[str], units: Iterable[str] = MASKED_UNITS) -> List[str]:
+    """
+    Mask the listed units that the root actually ships
+
+    Args:
+        etc_systemd_dir: The root's /etc/systemd/system
+        unit_dirs: The root's unit directories (lib/systemd/system, ...)
+
+    Returns:
+        list: Names of the units masked
+    """
+    unit_dirs = [d for d in unit_dirs if os.path.isdir(d)]
+    masked = []
+    for unit in units:
+        if not any(os.path.lexists(os.path.join(d, unit)) for d in unit_dirs):
+            continue
+        link = os.path.join(etc_systemd_dir, unit)
+        os.makedirs(etc_systemd_dir, exist_ok=True)
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink("/dev/null", link)
+        masked.append(unit)
+    return masked
+
+
+def _module_deps(modules_dir: str) -> Dict[str, List[str]]:
+    deps = {}
+    with open(os.path.join(modules_dir, "modules.dep")) as f:
+        for line in f:
+            path, _, rest = line.strip().partition(":")
+            if path:
+                deps[path] = rest.split()
+    return deps
+
+
+def prune_modules(root: str, modules_dir: str, version: str,
+                  keep_prefixes: Iterable[str] = KEEP_MODULE_PREFIXES) -> Dict[str, int]:
+    """
+    Remove kernel modules outside keep_prefixes (and not needed by a kept one)
+
+    Args:
+        root: The root directory depmod is pointed at
+        modules_dir: The root's lib/modules/<version>, symlinks resolved
+        version: Kernel version
+
+    Returns:
+        dict: removed_modules and removed_bytes
+    """
+    if not os.path.exists(os.path.join(modules_dir, "modules.dep")):
+        return {"removed_modules": 0, "removed_bytes": 0}
+    deps = _module_deps(modules_dir)
+    keep_prefixes = tuple(keep_prefixes)
+    kept: Set[str] = set()
+    pending = [path for path in deps if path.startswith(keep_prefixes)]
+    while pending:
+        path = pending.pop()
+        if path not in kept:
+            kept.add(path)
+            pending.extend(deps.get(path, []))
+
+    removed = removed_bytes = 0
+    for path in deps:
+        if path in kept:
+            continue
+        full_path = os.path.join(modules_dir, path)
+        try:
+            removed_bytes += os.lstat(full_path).st_size
+            os.remove(full_path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    # Drop the directories the removal emptied
+    for dirpath, _, _ in sorted(os.walk(os.path.join(modules_dir, "kernel")), reverse=True):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            pass
+    if removed:
+        subprocess.run(["depmod", "-b", root, version], check=True, capture_output=True)
+    return {"removed_modules": removed, "removed_bytes": removed_bytes}
+
+
+def remove_firmware(firmware_dir: str) -> int:
+    """Empty the root's firmware directory; returns the bytes removed"""
+    if not os.path.isdir(firmware_dir):
+        return 0
+    removed_bytes = _tree_size(firmware_dir)
+    for name in os.listdir(firmware_dir):
+        path = os.path.join(firmware_dir, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    return removed_bytes
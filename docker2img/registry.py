@@ -0,0 +1,521 @@
+"""
+Daemonless OCI image fetcher
+
+Resolves an image reference against an OCI distribution (Docker Registry v2)
+endpoint, downloads the layer blobs for one platform and flattens them into a
+single rootfs tar stream, the same thing `docker pull` + `docker create` +
+`docker export` produce, without a Docker daemon.
+
+Registries on localhost (or listed in DOCKER2IMG_INSECURE_REGISTRIES) are
+spoken to over plain HTTP, so a local registry stand-in can be used offline.
+"""
+
+import base64
+import copy
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import subprocess
+import tarfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
+
+from docker2img.blobcache import BlobCache
+
+DOCKER_HUB_REGISTRY = "registry-1.docker.io"
+
+MEDIA_OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+MEDIA_OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+MEDIA_DOCKER_LIST = "application/vnd.docker.distribution.manifest.list.v2+json"
+MEDIA_DOCKER_MANIFEST = "application/vnd.docker.distribution.manifest.v2+json"
+MANIFEST_ACCEPT = ", ".join([MEDIA_OCI_INDEX, MEDIA_OCI_MANIFEST, MEDIA_DOCKER_LIST, MEDIA_DOCKER_MANIFEST])
+INDEX_MEDIA_TYPES = (MEDIA_OCI_INDEX, MEDIA_DOCKER_LIST)
+
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class RegistryError(Exception):
+    """Raised when an image cannot be resolved or fetched from a registry"""
+
+
+def parse_reference(reference: str) -> Tuple[str, str, str]:
+    """
+    Split an image reference into registry, repository and tag or digest
+
+    "alpine" -> ("registry-1.docker.io", "library/alpine", "latest")
+    "localhost:5000/app@sha256:ab.." -> ("localhost:5000", "app", "sha256:ab..")
+    """
+    name, digest = reference, None
+    if "@" in name:
+        name, digest = name.split("@", 1)
+    tag = None
+    last = name.rsplit("/", 1)[-1]
+    if ":" in last:
+        name, tag = name.rsplit(":", 1)
+    parts = name.split("/", 1)
+    if len(parts) == 2 and ("." in parts[0] or ":" in parts[0] or parts[0] == "localhost"):
+        registry, repository = parts
+    else:
+        registry, repository = DOCKER_HUB_REGISTRY, name
+    if registry in ("docker.io", "index.docker.io"):
+        registry = DOCKER_HUB_REGISTRY
+    if registry == DOCKER_HUB_REGISTRY and "/" not in repository:
+        repository = f"library/{repository}"
+    return registry, repository, digest or tag or "latest"
+
+
+def _insecure(registry: str) -> bool:
+    host = registry.split(":", 1)[0]
+    extra = [r.strip() for r in os.environ.get("DOCKER2IMG_INSECURE_REGISTRIES", "").split(",") if r.strip()]
+    return host in ("localhost", "127.0.0.1", "::1") or registry in extra
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class RegistryClient:
+    """
+    Minimal OCI distribution client with anonymous or basic token auth
+
+    Args:
+        registry: Registry host[:port]
+        username: Optional user for token/basic auth
+        password: Optional password or token
+        timeout: Socket timeout in seconds
+    """
+
+    def __init__(self, registry: str, username: Optional[str] = None, password: Optional[str] = None,
+                 timeout: float = 60.0):
+        self.registry = registry
+        self.base_url = f"{'http' if _insecure(registry) else 'https'}://{registry}"
+        self._credentials = (username, password) if username else None
+        self._timeout = timeout
+        self._tokens: Dict[str, str] = {}
+        self._opener = urllib.request.build_opener(_NoRedirect)
+
+    def _authenticate(self, challenge: str, scope: str) -> Optional[str]:
+        scheme, _, params = challenge.partition(" ")
+        if scheme.lower() == "basic":
+            if not self._credentials:
+                raise RegistryError(f"{self.registry} requires credentials")
+            raw = f"{self._credentials[0]}:{self._credentials[1]}".encode()
+            return "Basic " + base64.b64encode(raw).decode()
+        fields = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        query = {"service": fields.get("service", ""), "scope": fields.get("scope", scope)}
+        request = urllib.request.Request(f"{fields['realm']}?{urllib.parse.urlencode(query)}")
+        if self._credentials:
+            raw = f"{self._credentials[0]}:{self._credentials[1]}".encode()
+            request.add_header("Authorization", "Basic " + base64.b64encode(raw).decode())
+        try:
+            with urllib.request.urlopen(request, timeout=self._timeout) as response:
+                body = json.load(response)
+        except urllib.error.HTTPError as e:
+            raise RegistryError(f"Token request to {fields['realm']} failed: HTTP {e.code}") from e
+        except urllib.error.URLError as e:
+            raise RegistryError(f"Token request to {fields['realm']} failed: {e.reason}") from e
+        return "Bearer " + (body.get("token") or body["access_token"])
+
+    def _open(self, path: str, repository: str, accept: Optional[str] = None, method: str = "GET"):
+        """Open a registry URL, handling token auth and redirects to blob storage"""
+        scope = f"repository:{repository}:pull"
+        url = self.base_url + path
+        authorized = False
+        redirected = False
+        for _ in range(10):
+            request = urllib.request.Request(url, method=method)
+            if accept:
+                request.add_header("Accept", accept)
+            if not redirected and scope in self._tokens:
+                request.add_header("Authorization", self._tokens[scope])
+            try:
+                return self._opener.open(request, timeout=self._timeout)
+            except urllib.error.HTTPError as e:
+                if e.code == 401 and not authorized and "WWW-Authenticate" in e.headers:
+                    self._tokens[scope] = self._authenticate(e.headers["WWW-Authenticate"], scope)
+                    authorized = True
+                    continue
+                if e.code in (301, 302, 303, 307, 308) and "Location" in e.headers:
+                    # Blob storage (S3, CDN) rejects the registry token; follow unauthenticated
+                    url = urllib.parse.urljoin(url, e.headers["Location"])
+                    redirected = True
+                    continue
+                raise RegistryError(f"{method} {url} failed: HTTP {e.code}") from e
+            except urllib.error.URLError as e:
+                raise RegistryError(f"{method} {url} failed: {e.reason}") from e
+        raise RegistryError(f"Too many redirects for {path}")
+
+    def get_manifest(self, repository: str, reference: str) -> Tuple[Dict[str, Any], str, bytes]:
+        """Return the parsed manifest, its digest and raw bytes"""
+        with self._open(f"/v2/{repository}/manifests/{reference}", repository, accept=MANIFEST_ACCEPT) as response:
+            raw = response.read()
+            digest = response.headers.get("Docker-Content-Digest")
+        computed = "sha256:" + hashlib.sha256(raw).hexdigest()
+        if reference.startswith("sha256:") and computed != reference:
+            raise RegistryError(f"Manifest digest mismatch: expected {reference}, got {computed}")
+        return json.loads(raw), digest or computed, raw
+
+    def fetch_blob(self, repository: str, digest: str, dest_path: str,
+                   progress: Optional[Callable[[int], None]] = None) -> int:
+        """Download a blob to dest_path, verifying its digest; returns its size"""
+        algorithm, _, expected = digest.partition(":")
+        if algorithm != "sha256":
+            raise RegistryError(f"Unsupported digest algorithm: {digest}")
+        hasher = hashlib.sha256()
+        size = 0
+        tmp_path = f"{dest_path}.partial"
+        with self._open(f"/v2/{repository}/blobs/{digest}", repository) as response, open(tmp_path, "wb") as out:
+            while True:
+                chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+                if progress:
+                    progress(len(chunk))
+        if hasher.hexdigest() != expected:
+            os.remove(tmp_path)
+            raise RegistryError(f"Blob digest mismatch for {digest}")
+        os.replace(tmp_path, dest_path)
+        return size
+
+    def fetch_json_blob(self, repository: str, digest: str) -> Dict[str, Any]:
+        with self._open(f"/v2/{repository}/blobs/{digest}", repository) as response:
+            raw = response.read()
+        if "sha256:" + hashlib.sha256(raw).hexdigest() != digest:
+            raise RegistryError(f"Blob digest mismatch for {digest}")
+        return json.loads(raw)
+
+
+def _platform_matches(entry: Dict[str, Any], os_name: str, architecture: str, variant: Optional[str]) -> bool:
+    platform = entry.get("platform", {})
+    if platform.get("os") != os_name or platform.get("architecture") != architecture:
+        return False
+    return variant is None or platform.get("variant") in (None, variant)
+
+
+def resolve_image(client: RegistryClient, repository: str, reference: str,
+                  platform: str = "linux/amd64") -> Dict[str, Any]:
+    """
+    Resolve a reference to a single-platform image manifest
+
+    Returns:
+        dict: digest (of the platform manifest), index_digest (if the reference
+            was a multi-platform index), config (parsed image config) and
+            layers (list of {digest, size, mediaType}) ordered base first
+    """
+    os_name, architecture, *rest = platform.split("/")
+    variant = rest[0] if rest else None
+    manifest, digest, _ = client.get_manifest(repository, reference)
+    index_digest = None
+    media_type = manifest.get("mediaType")
+    if media_type in INDEX_MEDIA_TYPES or (media_type is None and "manifests" in manifest):
+        index_digest = digest
+        candidates = [m for m in manifest["manifests"] if _platform_matches(m, os_name, architecture, variant)]
+        if not candidates:
+            raise RegistryError(f"No {platform} image in {repository}:{reference}")
+        manifest, digest, _ = client.get_manifest(repository, candidates[0]["digest"])
+    if "layers" not in manifest:
+        raise RegistryError(f"Unsupported manifest type {manifest.get('mediaType')} for {repository}:{reference}")
+    config = client.fetch_json_blob(repository, manifest["config"]["digest"])
+    return {
+        "digest": digest,
+        "index_digest": index_digest,
+        "config": config,
+        "layers": [
+            {"digest": layer["digest"], "size": layer.get("size", 0), "mediaType": layer.get("mediaType", "")}
+            for layer in manifest["layers"]
+        ]
+    }
+
+
+def open_layer(path: str, media_type: str) -> BinaryIO:
+    """Open a downloaded layer blob as an uncompressed tar stream"""
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic[:2] == b"\x1f\x8b":
+        return gzip.open(path, "rb")
+    if magic == b"\x28\xb5\x2f\xfd":
+        try:
+            import zstandard
+        except ImportError:
+            process = subprocess.Popen(["zstd", "-dc", path], stdout=subprocess.PIPE)
+            return process.stdout
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return open(path, "rb")
+
+
+def _clean_path(name: str) -> str:
+    """Normalize a tar member name to a root-relative path ("" for the root)"""
+    return posixpath.normpath("/" + name).lstrip("/")
+
+
+def _materialize_hardlinks(blob_path: str, media_type: str, pending: Dict[str, List[tarfile.TarInfo]],
+                           merged: tarfile.TarFile) -> int:
+    """
+    Emit hardlinks whose target in the same layer was shadowed or whited out
+
+    The layer is read a second time for the targets' content: the first link
+    to a target becomes a regular file with it (a hardlink shares its
+    target's inode, so it keeps this layer's content and metadata), and the
+    other links to the same target are linked to that file.
+
+    Returns:
+        int: Entries written
+    """
+    written = 0
+    stream = open_layer(blob_path, media_type)
+    try:
+        with tarfile.open(fileobj=stream, mode="r|*") as layer:
+            for member in layer:
+                path = _clean_path(member.name)
+                links = pending.pop(path, None) if member.isreg() else None
+                if not links:
+                    continue
+                first = copy.copy(member)
+                first.name = links[0].name
+                merged.addfile(first, layer.extractfile(member))
+                for link in links[1:]:
+                    link.linkname = first.name
+                    merged.addfile(link)
+                written += len(links)
+                if not pending:
+                    break
+    finally:
+        stream.close()
+    return written
+
+
+def flatten_layers(layers: List[Tuple[str, str]], out: BinaryIO) -> Dict[str, int]:
+    """
+    Apply layer tars (base first) and write the merged filesystem as one tar
+
+    Layers are read top-down: an entry is emitted from the highest layer that
+    has it, and lower entries are dropped when an upper layer replaced them,
+    whited them out (.wh.<name>) or made their directory opaque
+    (.wh..wh..opq). Hardlinks are resolved within the layer that defines
+    them: a link whose target is emitted from the same layer is written as a
+    link right away (the target precedes it); one whose target that layer
+    lost to an upper layer is written as a regular file with the layer's
+    content once the layer has been read (see _materialize_hardlinks).
+
+    Args:
+        layers: (blob path, media type) pairs ordered base layer first
+        out: Writable binary stream for the merged tar
+
+    Returns:
+        dict: Entries written and entries dropped by whiteouts or shadowing
+    """
+    emitted: Dict[str, bool] = {}   # path -> is directory
+    removed = set()                 # paths whited out by upper layers
+    opaque = set()                  # directories made opaque by upper layers
+    stats = {"entries": 0, "dropped": 0}
+
+    def hidden(path: str) -> bool:
+        if path in removed:
+            return True
+        parent = posixpath.dirname(path)
+        while parent:
+            if parent in removed or parent in opaque or emitted.get(parent) is False:
+                return True
+            parent = posixpath.dirname(parent)
+        return "" in opaque and path != ""
+
+    with tarfile.open(fileobj=out, mode="w|", format=tarfile.PAX_FORMAT) as merged:
+        for blob_path, media_type in reversed(layers):
+            layer_removed = set()
+            layer_opaque = set()
+            # Regular files of this layer, by whether they were emitted, and
+            # this layer's hardlinks resolved to the file they share
+            layer_files: Dict[str, bool] = {}
+            layer_links: Dict[str, str] = {}
+            pending: Dict[str, List[tarfile.TarInfo]] = {}
+            stream = open_layer(blob_path, media_type)
+            try:
+                with tarfile.open(fileobj=stream, mode="r|*") as layer:
+                    for member in layer:
+                        path = _clean_path(member.name)
+                        base = posixpath.basename(path)
+                        if base == OPAQUE_WHITEOUT:
+                            layer_opaque.add(posixpath.dirname(path))
+                            continue
+                        if base.startswith(WHITEOUT_PREFIX):
+                            layer_removed.add(posixpath.join(posixpath.dirname(path), base[len(WHITEOUT_PREFIX):]))
+                            continue
+                        if member.islnk():
+                            target = _clean_path(member.linkname)
+                            target = layer_links.get(target, target)
+                            layer_links[path] = target
+                        if path in emitted or hidden(path):
+                            if member.isreg():
+                                layer_files[path] = False
+                            stats["dropped"] += 1
+                            continue
+                        emitted[path] = member.isdir()
+                        member.name = path or "."
+                        if member.islnk():
+                            member.linkname = target
+                            if layer_files.get(target):
+                                merged.addfile(member)
+                                stats["entries"] += 1
+                            elif target in layer_files:
+                                pending.setdefault(target, []).append(member)
+                            elif emitted.get(target) is False:
+                                # Not in this layer (not produced by docker):
+                                # link to whatever an upper layer provides
+                                merged.addfile(member)
+                                stats["entries"] += 1
+                            else:
+                                stats["dropped"] += 1
+                            continue
+                        if member.isreg():
+                            layer_files[path] = True
+                        merged.addfile(member, layer.extractfile(member) if member.isreg() else None)
+                        stats["entries"] += 1
+            finally:
+                stream.close()
+            if pending:
+                stats["entries"] += _materialize_hardlinks(blob_path, media_type, pending, merged)
+            removed |= layer_removed
+            opaque |= layer_opaque
+    return stats
+
+
+def layer_changes(layers: List[Tuple[str, str]]) -> Dict[str, set]:
+    """
+    Summarize what layer tars (base first) change in a root they are applied
+    to in place, for the entries flatten_layers cannot express: deletions
+    of lower content and directories replaced by other entry types
+
+    Returns:
+        dict: removed (whited-out paths), opaque (directories whose lower
+            contents are hidden) and replaced (paths whose topmost entry is
+            not a directory)
+    """
+    removed = set()
+    opaque = set()
+    topmost: Dict[str, bool] = {}   # path -> is directory, highest layer first
+    for blob_path, media_type in reversed(layers):
+        stream = open_layer(blob_path, media_type)
+        try:
+            with tarfile.open(fileobj=stream, mode="r|*") as layer:
+                for member in layer:
+                    path = _clean_path(member.name)
+                    base = posixpath.basename(path)
+                    if base == OPAQUE_WHITEOUT:
+                        opaque.add(posixpath.dirname(path))
+                    elif base.startswith(WHITEOUT_PREFIX):
+                        removed.add(posixpath.join(posixpath.dirname(path), base[len(WHITEOUT_PREFIX):]))
+                    elif path not in topmost:
+                        topmost[path] = member.isdir()
+        finally:
+            stream.close()
+    replaced = {path for path, is_dir in topmost.items() if not is_dir}
+    return {"removed": removed, "opaque": opaque, "replaced": replaced}
+
+
+class RootfsStream:
+    """
+    Flattened rootfs of a fetched image, exposed as a readable pipe
+
+    The flattening runs in a background thread that writes into the pipe, so
+    consumers (tar -x, the ext4 writer) read it exactly like `docker export`
+    output, with the pipe providing backpressure.
+    """
+
+    def __init__(self, layers: List[Tuple[str, str]]):
+        read_fd, write_fd = os.pipe()
+        self.stream = os.fdopen(read_fd, "rb", buffering=0)
+        self._writer = os.fdopen(write_fd, "wb")
+        self._error: Optional[BaseException] = None
+        self.stats: Dict[str, int] = {}
+        self._thread = threading.Thread(target=self._run, args=(layers,), name="rootfs-flatten", daemon=True)
+        self._thread.start()
+
+    def _run(self, layers: List[Tuple[str, str]]) -> None:
+        try:
+            self.stats = flatten_layers(layers, self._writer)
+        except BrokenPipeError:
+            pass
+        except BaseException as e:
+            self._error = e
+        finally:
+            try:
+                self._writer.close()
+            except BrokenPipeError:
+                pass
+
+    def close(self) -> Dict[str, int]:
+        """Wait for flattening to finish and re-raise any error it hit"""
+        self.stream.close()
+        self._thread.join()
+        if self._error is not None:
+            raise RegistryError(f"Flattening layers failed: {self._error}") from self._error
+        return self.stats
+
+
+def resolve_reference(reference: str, platform: str = "linux/amd64", username: Optional[str] = None,
+                      password: Optional[str] = None) -> Tuple[RegistryClient, Dict[str, Any]]:
+    """
+    Resolve a reference to its platform manifest without fetching any layers
+
+    Returns:
+        tuple: The authenticated client and the resolve_image result plus
+            registry and repository
+    """
+    registry, repository, ref = parse_reference(reference)
+    client = RegistryClient(registry, username=username, password=password)
+    image = resolve_image(client, repository, ref, platform)
+    image.update({"registry": registry, "repository": repository})
+    return client, image
+
+
+def fetch_layers(client: RegistryClient, image: Dict[str, Any], blob_dir: str,
+                 cache: Optional[BlobCache] = None) -> List[Tuple[str, str]]:
+    """
+    Download the layer blobs of a resolved image into blob_dir
+
+    With a cache, layers are looked up (and leased) there first and only
+    misses are downloaded; blob_dir is then unused.
+
+    Returns:
+        list: (path, media type) pairs, base layer first
+    """
+    repository = image["repository"]
+    os.makedirs(blob_dir, exist_ok=True)
+    layer_paths = []
+    for layer in image["layers"]:
+        digest = layer["digest"]
+        if cache is not None:
+            path = cache.acquire(digest, lambda dest, d=digest: client.fetch_blob(repository, d, dest))
+        else:
+            path = os.path.join(blob_dir, digest.replace(":", "_"))
+            if not os.path.exists(path):
+                client.fetch_blob(repository, digest, path)
+        layer_paths.append((path, layer["mediaType"]))
+    return layer_paths
+
+
+def pull_image(reference: str, blob_dir: str, platform: str = "linux/amd64",
+               username: Optional[str] = None, password: Optional[str] = None,
+               cache: Optional[BlobCache] = None) -> Dict[str, Any]:
+    """
+    Resolve a reference and download its layer blobs into blob_dir
+
+    Returns:
+        dict: The resolve_image result plus registry, repository and
+            layer_paths ((path, media type) pairs, base first)
+    """
+    client, image = resolve_reference(reference, platform, username, password)
+    image["layer_paths"] = fetch_layers(client, image, blob_dir, cache)
+    return image
@@ -0,0 +1,230 @@
+"""
+Seekable zstd images (.img.zst)
+
+The image is cut into fixed-size frames (2MB of image data each) that are
+compressed independently, on a thread pool, and written in order. A seek
+table in a trailing skippable frame records each frame's compressed and
+decompressed size, in the layout of zstd's contrib/seekable_format:
+
+    frame 0 | frame 1 | ... | skippable frame: entries + footer
+
+    entry:  compressed size (u32 LE), decompressed size (u32 LE)
+    footer: number of frames (u32 LE), descriptor (u8, no checksums),
+            seekable magic 0x8F92EAB1 (u32 LE)
+
+Every frame carries its content size and checksum, so the file also
+decompresses with plain `zstd -d`. SeekableZstdReader reads any byte range
+by decompressing only the frames it covers.
+"""
+
+import bisect
+import collections
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+FRAME_SIZE = 2 * 1024 * 1024
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+FOOTER_SIZE = 9
+CHECKSUM_FLAG = 0x80
+
+
+class SeekableZstdError(Exception):
+    """Raised when a file is not a readable seekable zstd archive"""
+
+
+class SeekableZstdWriter:
+    """
+    Write image data as a seekable zstd file
+
+    write() takes data in increasing offset order; gaps (holes in the
+    source) are written as zero frames, whose compressed form is computed
+    once per length.
+
+    Args:
+        path: Output file
+        size: Image size; close() pads the data with zeros up to it
+        level: zstd level
+        threads: Compression threads (default: one per CPU)
+    """
+
+    def __init__(self, path: str, size: int, level: int = 3, threads: Optional[int] = None):
+        import zstandard
+        self._zstandard = zstandard
+        self.size = size
+        self.level = level
+        self._file = open(path, "wb")
+        threads = threads or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(threads, thread_name_prefix="zst-frame")
+        # Frames compressed but not yet written, bounded so the reader is
+        # throttled instead of buffering the whole image
+        self._pending: collections.deque = collections.deque()
+        self._max_pending = threads * 2
+        self._local = threading.local()
+        self._zero_frames: Dict[int, bytes] = {}
+        self._frames: List[tuple] = []
+        # Data of the frame being filled; _position counts it too
+        self._buffer = bytearray()
+        self._position = 0
+
+    def _compress(self, data: bytes) -> bytes:
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = self._zstandard.ZstdCompressor(
+                level=self.level, write_checksum=True, write_content_size=True
+            )
+            self._local.compressor = compressor
+        return compressor.compress(data)
+
+    def _flush(self, keep: int) -> None:
+        """Write finished frames in order until at most keep are pending"""
+        while len(self._pending) > keep:
+            future, length = self._pending.popleft()
+            frame = self._zero_frames[length] if future is None else future.result()
+            self._file.write(frame)
+            self._frames.append((len(frame), length))
+
+    def _submit(self) -> None:
+        """Queue the buffered frame for compression"""
+        data = bytes(self._buffer)
+        self._buffer = bytearray()
+        self._pending.append((self._pool.submit(self._compress, data), len(data)))
+        self._flush(self._max_pending)
+
+    def _append(self, data) -> None:
+        """Add data to the current frame, submitting every frame it completes"""
+        start = 0
+        while start < len(data):
+            length = min(FRAME_SIZE - len(self._buffer), len(data) - start)
+            self._buffer += data[start:start + length]
+            self._position += length
+            start += length
+            if len(self._buffer) == FRAME_SIZE:
+                self._submit()
+
+    def _fill(self, offset: int) -> None:
+        """Zeros up to offset: whole zero frames where a frame starts, buffered zeros otherwise"""
+        if self._buffer:
+            self._append(bytes(min(FRAME_SIZE - len(self._buffer), offset - self._position)))
+        while offset - self._position >= FRAME_SIZE or (offset == self.size and self._position < offset):
+            length = min(FRAME_SIZE, offset - self._position)
+            if length not in self._zero_frames:
+                self._zero_frames[length] = self._compress(bytes(length))
+            # Keep the output in order behind the frames still compressing
+            self._pending.append((None, length))
+            self._position += length
+            self._flush(self._max_pending)
+        self._append(bytes(offset - self._position))
+
+    def write(self, offset: int, data: bytes) -> None:
+        if offset < self._position:
+            raise ValueError(f"Data at {offset} arrived after {self._position}")
+        self._fill(offset)
+        self._append(memoryview(data))
+
+    def close(self) -> None:
+        try:
+            self._fill(self.size)
+            if self._buffer:
+                self._submit()
+            self._flush(0)
+            entries = b"".join(struct.pack("<II", compressed, length) for compressed, length in self._frames)
+            footer = struct.pack("<IBI", len(self._frames), 0, SEEKABLE_MAGIC)
+            self._file.write(struct.pack("<II", SKIPPABLE_MAGIC, len(entries) + len(footer)))
+            self._file.write(entries + footer)
+        finally:
+            self._pool.shutdown(wait=True)
+            self._file.close()
+
+
+class SeekableZstdReader:
+    """
+    Random access to a seekable zstd file
+
+    Only the frames overlapping a requested range are read and
+    decompressed; the most recently decompressed frame is kept, so small
+    sequential reads do not decompress a frame twice.
+
+    Example:
+        with SeekableZstdReader("disk.img.zst") as image:
+            mbr = image.read(0, 512)
+    """
+
+    def __init__(self, path: str):
+        import zstandard
+        self._decompressor = zstandard.ZstdDecompressor()
+        self._file = open(path, "rb")
+        self._cached = (-1, b"")
+        try:
+            self._load_seek_table()
+        except Exception:
+            self._file.close()
+            raise
+
+    def _load_seek_table(self) -> None:
+        file_size = os.fstat(self._file.fileno()).st_size
+        if file_size < FOOTER_SIZE + 8:
+            raise SeekableZstdError("File is too small for a seek table")
+        frames, descriptor, magic = struct.unpack("<IBI", os.pread(self._file.fileno(), FOOTER_SIZE,
+                                                                   file_size - FOOTER_SIZE))
+        if magic != SEEKABLE_MAGIC:
+            raise SeekableZstdError("No seekable zstd footer")
+        entry_size = 12 if descriptor & CHECKSUM_FLAG else 8
+        table_size = frames * entry_size + FOOTER_SIZE
+        header_offset = file_size - table_size - 8
+        skippable, frame_size = struct.unpack("<II", os.pread(self._file.fileno(), 8, header_offset))
+        if skippable != SKIPPABLE_MAGIC or frame_size != table_size:
+            raise SeekableZstdError("Malformed seek table frame")
+        table = os.pread(self._file.fileno(), frames * entry_size, header_offset + 8)
+
+        # Start offsets of every frame, plus the end, in both streams
+        self._compressed = [0]
+        self._decompressed = [0]
+        for index in range(frames):
+            compressed, length = struct.unpack_from("<II", table, index * entry_size)
+            self._compressed.append(self._compressed[-1] + compressed)
+            self._decompressed.append(self._decompressed[-1] + length)
+        if self._compressed[-1] != header_offset:
+            raise SeekableZstdError("Seek table does not match the frames")
+
+    @property
+    def size(self) -> int:
+        """Decompressed size"""
+        return self._decompressed[-1]
+
+    @property
+    def frames(self) -> int:
+        return len(self._decompressed) - 1
+
+    def _frame(self, index: int) -> bytes:
+        if self._cached[0] != index:
+            start = self._compressed[index]
+            compressed = os.pread(self._file.fileno(), self._compressed[index + 1] - start, start)
+            self._cached = (index, self._decompressor.decompress(compressed))
+        return self._cached[1]
+
+    def read(self, offset: int, length: int) -> bytes:
+        """Read length bytes at offset (fewer at the end of the image)"""
+        end = min(offset + length, self.size)
+        parts = []
+        position = offset
+        while position < end:
+            index = bisect.bisect_right(self._decompressed, position) - 1
+            frame = self._frame(index)
+            start = position - self._decompressed[index]
+            chunk = frame[start:start + end - position]
+            parts.append(chunk)
+            position += len(chunk)
+        return b"".join(parts)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "SeekableZstdReader":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
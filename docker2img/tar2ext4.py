@@ -0,0 +1,1019 @@
+"""
+Streaming tar to ext4 writer
+
+Builds an ext4 filesystem image in one pass from a tar stream (for example the
+output of `docker export`) without extracting it to a staging directory or
+mounting anything. File contents are copied into the image as their tar
+entries arrive; directories, extent trees, xattr blocks, inode tables and
+bitmaps are laid out after the data when the writer is closed.
+
+Layout of the filesystem (4 KiB blocks):
+
+    block 0       boot sector and superblock
+    1 .. n        group descriptor table, sized for max_size
+    data          file and symlink contents in tar order
+    metadata      directory blocks, extent leaves, xattr blocks,
+                  inode tables, block bitmaps, inode bitmaps
+    free          the rest of the filesystem
+
+flex_bg lets group metadata live outside its own group and sparse_super2 with
+no backup groups keeps superblock copies out of the data area, so the data is
+one contiguous run. The filesystem is written without a journal; add one
+afterwards with `tune2fs -O has_journal "image?offset=N"` if needed.
+
+The target region must read as zeros before writing (a freshly truncated
+sparse file): unused inode table slots and all-zero file blocks are skipped.
+
+File payloads are moved with os.splice (pipe sources) or os.copy_file_range
+(regular file sources) when the source is an unbuffered file and no stream
+hash is requested, so the data never passes through Python.
+"""
+
+import io
+import os
+import stat
+import struct
+import time
+import uuid as uuid_module
+from typing import Any, BinaryIO, Dict, Iterable, List, Optional, Tuple, Union
+
+BLOCK_SIZE = 4096
+BLOCKS_PER_GROUP = BLOCK_SIZE * 8
+INODE_SIZE = 256
+INODE_EXTRA_ISIZE = 32
+INODES_PER_BLOCK = BLOCK_SIZE // INODE_SIZE
+GROUP_DESC_SIZE = 32
+FIRST_INODE = 11
+ROOT_INODE = 2
+LOST_AND_FOUND_BLOCKS = 4
+MAX_EXTENT_LEN = 32768
+EXTENTS_PER_LEAF = (BLOCK_SIZE - 12) // 12
+DEFAULT_MAX_SIZE = 1 << 40
+COPY_CHUNK_SIZE = 1024 * 1024
+
+EXT4_MAGIC = 0xEF53
+EXTENT_MAGIC = 0xF30A
+XATTR_MAGIC = 0xEA020000
+
+COMPAT_EXT_ATTR = 0x0008
+COMPAT_SPARSE_SUPER2 = 0x0200
+INCOMPAT_FILETYPE = 0x0002
+INCOMPAT_EXTENTS = 0x0040
+INCOMPAT_FLEX_BG = 0x0200
+RO_COMPAT_SPARSE_SUPER = 0x0001
+RO_COMPAT_LARGE_FILE = 0x0002
+RO_COMPAT_DIR_NLINK = 0x0020
+RO_COMPAT_EXTRA_ISIZE = 0x0040
+
+EXTENTS_FL = 0x00080000
+LOG_GROUPS_PER_FLEX = 4
+
+# Directory entry file types, keyed by S_IFMT
+_DIRENT_TYPES = {
+    stat.S_IFREG: 1,
+    stat.S_IFDIR: 2,
+    stat.S_IFCHR: 3,
+    stat.S_IFBLK: 4,
+    stat.S_IFIFO: 5,
+    stat.S_IFSOCK: 6,
+    stat.S_IFLNK: 7,
+}
+
+# Tar type flags
+_TAR_REGULAR = (b"0", b"\0", b"7")
+_TAR_HARDLINK = b"1"
+_TAR_SYMLINK = b"2"
+_TAR_CHAR = b"3"
+_TAR_BLOCK = b"4"
+_TAR_DIR = b"5"
+_TAR_FIFO = b"6"
+_TAR_PAX = b"x"
+_TAR_PAX_GLOBAL = b"g"
+_TAR_GNU_LONGNAME = b"L"
+_TAR_GNU_LONGLINK = b"K"
+
+# Extended attribute name prefixes and their ext4 name indexes. POSIX ACLs are
+# stored by ext4 in its own compact format, so they are not accepted here.
+_XATTR_PREFIXES = (
+    ("user.", 1),
+    ("trusted.", 4),
+    ("security.", 6),
+)
+
+
+class Ext4WriterError(Exception):
+    """Raised when a tar stream cannot be written as an ext4 filesystem"""
+
+
+def _pad4(length: int) -> int:
+    return (length + 3) & ~3
+
+
+def _split_time(seconds: int) -> Tuple[int, int]:
+    """Encode a timestamp as ext4's 32-bit seconds plus epoch bits in the extra field"""
+    low = seconds & 0xFFFFFFFF
+    signed_low = low - (1 << 32) if low >= (1 << 31) else low
+    epoch = ((seconds - signed_low) >> 32) & 0x3
+    return low, epoch
+
+
+def _normalize(path: Union[str, bytes]) -> Tuple[bytes, ...]:
+    """Split a tar or API path into components relative to the filesystem root"""
+    if isinstance(path, str):
+        path = path.encode("utf-8", "surrogateescape")
+    parts = []
+    for part in path.split(b"/"):
+        if part in (b"", b"."):
+            continue
+        if part == b"..":
+            raise Ext4WriterError(f"Path escapes the filesystem root: {path!r}")
+        if len(part) > 255:
+            raise Ext4WriterError(f"File name too long: {part!r}")
+        parts.append(part)
+    return tuple(parts)
+
+
+class _Inode:
+    __slots__ = (
+        "number", "mode", "uid", "gid", "mtime", "size", "links",
+        "extents", "children", "parent", "symlink", "rdev", "xattrs", "min_blocks"
+    )
+
+    def __init__(self, number: int, mode: int, uid: int = 0, gid: int = 0, mtime: int = 0):
+        self.number = number
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.mtime = mtime
+        self.size = 0
+        self.links = 0
+        self.extents: List[Tuple[int, int, int]] = []
+        self.children: Optional[Dict[bytes, "_Inode"]] = {} if stat.S_ISDIR(mode) else None
+        self.parent: Optional["_Inode"] = None
+        self.symlink: Optional[bytes] = None
+        self.rdev = (0, 0)
+        self.xattrs: Dict[str, bytes] = {}
+        self.min_blocks = 1
+
+    @property
+    def is_dir(self) -> bool:
+        return self.children is not None
+
+
+class _TarEntry:
+    __slots__ = ("name", "type", "mode", "uid", "gid", "size", "mtime", "linkname", "devmajor", "devminor",
+                 "xattrs", "remaining")
+
+
+class _TarReader:
+    """Minimal tar stream reader that copies payloads straight into the image"""
+
+    def __init__(self, source: BinaryIO, hasher=None):
+        self._source = source
+        self._hasher = hasher
+        self.bytes_read = 0
+        self._zero_copy = None
+        if hasher is None and isinstance(source, io.FileIO):
+            mode = os.fstat(source.fileno()).st_mode
+            if stat.S_ISFIFO(mode) and hasattr(os, "splice"):
+                self._zero_copy = "splice"
+            elif stat.S_ISREG(mode) and hasattr(os, "copy_file_range"):
+                self._zero_copy = "copy_file_range"
+        if self._zero_copy is None and isinstance(source, io.RawIOBase):
+            # Headers are read 512 bytes at a time; avoid a syscall per header
+            self._source = io.BufferedReader(source, COPY_CHUNK_SIZE)
+
+    def read_exact(self, size: int, allow_eof: bool = False) -> bytes:
+        buf = bytearray(size)
+        view = memoryview(buf)
+        filled = 0
+        while filled < size:
+            count = self._source.readinto(view[filled:])
+            if not count:
+                if allow_eof and filled == 0:
+                    return b""
+                raise Ext4WriterError("Unexpected end of tar stream")
+            filled += count
+        if self._hasher is not None:
+            self._hasher.update(buf)
+        self.bytes_read += size
+        return bytes(buf)
+
+    def skip(self, size: int) -> None:
+        while size > 0:
+            chunk = min(size, COPY_CHUNK_SIZE)
+            self.read_exact(chunk)
+            size -= chunk
+
+    def drain(self) -> None:
+        while True:
+            chunk = self._source.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                return
+            if self._hasher is not None:
+                self._hasher.update(chunk)
+            self.bytes_read += len(chunk)
+
+    def copy_to(self, fd: int, offset: int, size: int) -> None:
+        """Copy size payload bytes to fd at offset, leaving all-zero chunks unwritten"""
+        remaining = size
+        if self._zero_copy is not None:
+            src = self._source.fileno()
+            while remaining > 0:
+                try:
+                    if self._zero_copy == "splice":
+                        count = os.splice(src, fd, remaining, offset_dst=offset)
+                    else:
+                        count = os.copy_file_range(src, fd, remaining, offset_dst=offset)
+                except OSError:
+                    if remaining != size:
+                        raise
+                    # e.g. EINVAL/EXDEV where the kernel or filesystem lacks
+                    # support; nothing was consumed yet, so fall back to reading
+                    self._zero_copy = None
+                    break
+                if count == 0:
+                    raise Ext4WriterError("Unexpected end of tar stream")
+                offset += count
+                remaining -= count
+                self.bytes_read += count
+        while remaining > 0:
+            chunk = self.read_exact(min(remaining, COPY_CHUNK_SIZE))
+            if chunk.count(0) != len(chunk):
+                os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+            remaining -= len(chunk)
+
+    @staticmethod
+    def _number(field: bytes) -> int:
+        if field and field[0] & 0x80:
+            # GNU base-256 encoding for values that do not fit in octal
+            value = int.from_bytes(bytes([field[0] & 0x7F]) + field[1:], "big")
+            if field[0] & 0x40:
+                value -= 1 << (len(field) * 8 - 1)
+            return value
+        text = field.split(b"\0", 1)[0].strip()
+        return int(text, 8) if text else 0
+
+    @staticmethod
+    def _pax_records(data: bytes) -> Dict[str, bytes]:
+        records = {}
+        pos = 0
+        while pos < len(data):
+            space = data.index(b" ", pos)
+            length = int(data[pos:space])
+            key, _, value = data[space + 1:pos + length - 1].partition(b"=")
+            records[key.decode("utf-8", "surrogateescape")] = value
+            pos += length
+        return records
+
+    def entries(self) -> Iterable[_TarEntry]:
+        """Yield entries; the caller must consume each payload before advancing"""
+        pax: Dict[str, bytes] = {}
+        long_name = None
+        long_link = None
+        while True:
+            header = self.read_exact(512, allow_eof=True)
+            if not header or header.count(0) == 512:
+                self.drain()
+                return
+            checksum = self._number(header[148:156])
+            unsigned = sum(header[:148]) + 256 + sum(header[156:])
+            if checksum != unsigned:
+                raise Ext4WriterError("Invalid tar header checksum")
+
+            typeflag = header[156:157]
+            size = self._number(header[124:136])
+            padded = (size + 511) & ~511
+            if typeflag in (_TAR_PAX, _TAR_PAX_GLOBAL, _TAR_GNU_LONGNAME, _TAR_GNU_LONGLINK):
+                data = self.read_exact(padded)[:size]
+                if typeflag == _TAR_PAX:
+                    pax = self._pax_records(data)
+                elif typeflag == _TAR_GNU_LONGNAME:
+                    long_name = data.rstrip(b"\0")
+                elif typeflag == _TAR_GNU_LONGLINK:
+                    long_link = data.rstrip(b"\0")
+                continue
+
+            entry = _TarEntry()
+            name = header[0:100].split(b"\0", 1)[0]
+            if header[257:263] == b"ustar\0":
+                prefix = header[345:500].split(b"\0", 1)[0]
+                if prefix:
+                    name = prefix + b"/" + name
+            entry.name = pax.get("path", long_name or name)
+            entry.linkname = pax.get("linkpath", long_link or header[157:257].split(b"\0", 1)[0])
+            entry.type = typeflag
+            entry.mode = self._number(header[100:108]) & 0o7777
+            entry.uid = int(pax["uid"]) if "uid" in pax else self._number(header[108:116])
+            entry.gid = int(pax["gid"]) if "gid" in pax else self._number(header[116:124])
+            entry.size = int(pax["size"]) if "size" in pax else size
+            entry.mtime = int(float(pax["mtime"])) if "mtime" in pax else self._number(header[136:148])
+            entry.devmajor = self._number(header[329:337])
+            entry.devminor = self._number(header[337:345])
+            entry.remaining = padded
+            entry.xattrs = {
+                key[len("SCHILY.xattr."):]: value
+                for key, value in pax.items() if key.startswith("SCHILY.xattr.")
+            }
+            if any(key.startswith("GNU.sparse.") for key in pax) or typeflag == b"S":
+                raise Ext4WriterError(f"Sparse tar entries are not supported: {entry.name!r}")
+            pax = {}
+            long_name = None
+            long_link = None
+
+            yield entry
+            # Consume whatever the caller did not (padding, payload of skipped entries)
+            if entry.remaining:
+                self.skip(entry.remaining)
+
+
+class Ext4Writer:
+    """
+    Write an ext4 filesystem into a file or partition offset in one pass
+
+    Args:
+        target: Path of the image file, or an open file descriptor
+        offset: Byte offset of the filesystem inside the target (partition start)
+        size: Filesystem size in bytes; None sizes it to fit the content
+        max_size: Largest size the group descriptor table is reserved for
+        inode_ratio: Bytes per inode when size is given (like mke2fs -i)
+        inode_headroom: Spare inodes to add, as a fraction of the inodes used
+        label: Volume label
+        fs_uuid: Filesystem UUID; random when None
+    """
+
+    def __init__(
+        self,
+        target: Union[str, int],
+        offset: int = 0,
+        size: Optional[int] = None,
+        max_size: Optional[int] = None,
+        inode_ratio: int = 16384,
+        inode_headroom: float = 0.1,
+        label: str = "",
+        fs_uuid: Optional[bytes] = None
+    ):
+        if offset % BLOCK_SIZE:
+            raise Ext4WriterError(f"Offset {offset} is not aligned to {BLOCK_SIZE} bytes")
+        if isinstance(target, int):
+            self._fd = target
+            self._owns_fd = False
+        else:
+            self._fd = os.open(target, os.O_RDWR | os.O_CREAT, 0o644)
+            self._owns_fd = True
+        self._offset = offset
+        self._size_blocks = size // BLOCK_SIZE if size is not None else None
+        max_blocks = (max_size or size or DEFAULT_MAX_SIZE) // BLOCK_SIZE
+        max_groups = (max_blocks + BLOCKS_PER_GROUP - 1) // BLOCKS_PER_GROUP
+        self._gdt_blocks = (max_groups * GROUP_DESC_SIZE + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self._next_block = 1 + self._gdt_blocks
+        self._inode_ratio = inode_ratio
+        self._inode_headroom = inode_headroom
+        self._label = label.encode()[:16]
+        self._uuid = fs_uuid or uuid_module.uuid4().bytes
+        self._now = int(time.time())
+        self._next_inode = FIRST_INODE
+        self._inodes: Dict[int, _Inode] = {}
+        self._closed = False
+        self.stats = {"files": 0, "directories": 0, "symlinks": 0, "hardlinks": 0,
+                      "devices": 0, "data_bytes": 0, "skipped_xattrs": 0}
+
+        self._root = _Inode(ROOT_INODE, stat.S_IFDIR | 0o755, mtime=self._now)
+        self._root.parent = self._root
+        self._inodes[ROOT_INODE] = self._root
+        lost_found = self._new_inode(stat.S_IFDIR | 0o700, mtime=self._now)
+        lost_found.min_blocks = LOST_AND_FOUND_BLOCKS
+        self._link(self._root, b"lost+found", lost_found)
+
+    def __enter__(self) -> "Ext4Writer":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        elif self._owns_fd:
+            os.close(self._fd)
+            self._closed = True
+
+    # Namespace -------------------------------------------------------------
+
+    def _new_inode(self, mode: int, uid: int = 0, gid: int = 0, mtime: Optional[int] = None) -> _Inode:
+        inode = _Inode(self._next_inode, mode, uid, gid, self._now if mtime is None else mtime)
+        self._inodes[inode.number] = inode
+        self._next_inode += 1
+        return inode
+
+    def _link(self, parent: _Inode, name: bytes, inode: _Inode) -> None:
+        parent.children[name] = inode
+        inode.links += 1
+        if inode.is_dir:
+            inode.parent = parent
+
+    def _unlink(self, parent: _Inode, name: bytes) -> None:
+        inode = parent.children.pop(name)
+        inode.links -= 1
+        if inode.is_dir:
+            for child_name in list(inode.children):
+                self._unlink(inode, child_name)
+            inode.links = 0
+        if inode.links == 0:
+            del self._inodes[inode.number]
+
+    def _lookup(self, parts: Tuple[bytes, ...], follow: bool = True, depth: int = 0) -> Optional[_Inode]:
+        if depth > 40:
+            raise Ext4WriterError("Too many levels of symbolic links")
+        node = self._root
+        for index, part in enumerate(parts):
+            if not node.is_dir:
+                return None
+            child = node.children.get(part)
+            if child is None:
+                return None
+            last = index == len(parts) - 1
+            if child.symlink is not None and (follow or not last):
+                target = child.symlink
+                base = () if target.startswith(b"/") else parts[:index]
+                child = self._lookup(base + _normalize(target), True, depth + 1)
+                if child is None:
+                    return None
+            node = child
+        return node
+
+    def _parent_dir(self, parts: Tuple[bytes, ...]) -> _Inode:
+        """Return the parent directory of parts, creating missing directories"""
+        node = self._root
+        for part in parts[:-1]:
+            child = node.children.get(part)
+            if child is None:
+                child = self._new_inode(stat.S_IFDIR | 0o755, mtime=self._now)
+                self._link(node, part, child)
+                self.stats["directories"] += 1
+            elif not child.is_dir:
+                resolved = self._lookup(self._path_of(node) + (part,))
+                if resolved is None or not resolved.is_dir:
+                    raise Ext4WriterError(f"Not a directory: {b'/'.join(parts)!r}")
+                child = resolved
+            node = child
+        return node
+
+    def _path_of(self, node: _Inode) -> Tuple[bytes, ...]:
+        parts = []
+        while node is not self._root:
+            parent = node.parent
+            parts.append(next(name for name, child in parent.children.items() if child is node))
+            node = parent
+        return tuple(reversed(parts))
+
+    def _place(self, parts: Tuple[bytes, ...], mode: int, uid: int, gid: int, mtime: Optional[int]) -> _Inode:
+        """Create (or replace) the inode at parts and return it"""
+        if not parts:
+            if not stat.S_ISDIR(mode):
+                raise Ext4WriterError("The root must be a directory")
+            self._root.mode, self._root.uid, self._root.gid = mode, uid, gid
+            self._root.mtime = self._now if mtime is None else mtime
+            return self._root
+        parent = self._parent_dir(parts)
+        existing = parent.children.get(parts[-1])
+        if existing is not None:
+            if existing.is_dir and stat.S_ISDIR(mode):
+                existing.mode, existing.uid, existing.gid = mode, uid, gid
+                existing.mtime = self._now if mtime is None else mtime
+                return existing
+            self._unlink(parent, parts[-1])
+        inode = self._new_inode(mode, uid, gid, mtime)
+        self._link(parent, parts[-1], inode)
+        return inode
+
+    # Data ------------------------------------------------------------------
+
+    def _allocate(self, blocks: int) -> int:
+        start = self._next_block
+        if self._size_blocks is not None and start + blocks > self._size_blocks:
+            raise Ext4WriterError("Filesystem is full")
+        self._next_block += blocks
+        return start
+
+    def _store(self, inode: _Inode, size: int, write) -> None:
+        blocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+        start = self._allocate(blocks)
+        if size:
+            write(self._offset + start * BLOCK_SIZE)
+        inode.size = size
+        inode.extents = [(0, start, blocks)] if blocks else []
+        self.stats["data_bytes"] += size
+
+    def _store_bytes(self, inode: _Inode, data: bytes) -> None:
+        self._store(inode, len(data), lambda pos: os.pwrite(self._fd, data, pos))
+
+    def _read_inode(self, inode: _Inode) -> bytes:
+        data = bytearray()
+        for _, physical, length in inode.extents:
+            data += os.pread(self._fd, length * BLOCK_SIZE, self._offset + physical * BLOCK_SIZE)
+        return bytes(data[:inode.size])
+
+    # Public API ------------------------------------------------------------
+
+    def add_directory(self, path: Union[str, bytes], mode: int = 0o755, uid: int = 0, gid: int = 0,
+                      mtime: Optional[int] = None) -> None:
+        self._place(_normalize(path), stat.S_IFDIR | (mode & 0o7777), uid, gid, mtime)
+        self.stats["directories"] += 1
+
+    def add_file(self, path: Union[str, bytes], data: bytes, mode: int = 0o644, uid: int = 0, gid: int = 0,
+                 mtime: Optional[int] = None) -> None:
+        inode = self._place(_normalize(path), stat.S_IFREG | (mode & 0o7777), uid, gid, mtime)
+        self._store_bytes(inode, data)
+        self.stats["files"] += 1
+
+    def add_symlink(self, path: Union[str, bytes], target: Union[str, bytes], uid: int = 0, gid: int = 0,
+                    mtime: Optional[int] = None) -> None:
+        if isinstance(target, str):
+            target = target.encode("utf-8", "surrogateescape")
+        inode = self._place(_normalize(path), stat.S_IFLNK | 0o777, uid, gid, mtime)
+        inode.symlink = target
+        if len(target) < 60:
+            inode.size = len(target)
+        else:
+            self._store_bytes(inode, target)
+        self.stats["symlinks"] += 1
+
+    def add_hardlink(self, path: Union[str, bytes], target: Union[str, bytes]) -> None:
+        target_inode = self._lookup(_normalize(target), follow=False)
+        if target_inode is None or target_inode.is_dir:
+            raise Ext4WriterError(f"Invalid hard link target: {target!r}")
+        parts = _normalize(path)
+        parent = self._parent_dir(parts)
+        if parts[-1] in parent.children:
+            if parent.children[parts[-1]] is target_inode:
+                return
+            self._unlink(parent, parts[-1])
+        self._link(parent, parts[-1], target_inode)
+        self.stats["hardlinks"] += 1
+
+    def add_device(self, path: Union[str, bytes], file_type: int, major: int = 0, minor: int = 0,
+                   mode: int = 0o644, uid: int = 0, gid: int = 0, mtime: Optional[int] = None) -> None:
+        """Add a character/block device, FIFO or socket (file_type is an S_IF* constant)"""
+        inode = self._place(_normalize(path), file_type | (mode & 0o7777), uid, gid, mtime)
+        inode.rdev = (major, minor)
+        self.stats["devices"] += 1
+
+    def set_xattrs(self, path: Union[str, bytes], xattrs: Dict[str, bytes]) -> None:
+        inode = self._lookup(_normalize(path), follow=False)
+        if inode is None:
+            raise Ext4WriterError(f"No such file: {path!r}")
+        for name, value in xattrs.items():
+            if any(name.startswith(prefix) for prefix, _ in _XATTR_PREFIXES):
+                inode.xattrs[name] = value
+            else:
+                self.stats["skipped_xattrs"] += 1
+
+    def remove(self, path: Union[str, bytes]) -> bool:
+        """Remove a path (recursively for directories); returns False if it did not exist"""
+        parts = _normalize(path)
+        if not parts:
+            raise Ext4WriterError("Cannot remove the root directory")
+        parent = self._lookup(parts[:-1])
+        if parent is None or not parent.is_dir or parts[-1] not in parent.children:
+            return False
+        self._unlink(parent, parts[-1])
+        return True
+
+    def exists(self, path: Union[str, bytes], follow_symlinks: bool = False) -> bool:
+        return self._lookup(_normalize(path), follow=follow_symlinks) is not None
+
+    def read_file(self, path: Union[str, bytes]) -> bytes:
+        """Read back a regular file that has already been written, following symlinks"""
+        inode = self._lookup(_normalize(path))
+        if inode is None or not stat.S_ISREG(inode.mode):
+            raise Ext4WriterError(f"No such regular file: {path!r}")
+        return self._read_inode(inode)
+
+    def add_tar_stream(self, source: BinaryIO, hasher=None) -> Dict[str, Any]:
+        """
+        Write every entry of a tar stream into the filesystem
+
+        Args:
+            source: Readable binary stream positioned at the start of the archive
+            hasher: Optional hashlib object updated with every byte of the stream
+
+        Returns:
+            dict: Number of bytes read from the stream and entries written
+        """
+        reader = _TarReader(source, hasher)
+        count = 0
+        for entry in reader.entries():
+            count += 1
+            parts = _normalize(entry.name)
+            if entry.type in _TAR_REGULAR:
+                inode = self._place(parts, stat.S_IFREG | entry.mode, entry.uid, entry.gid, entry.mtime)
+                self._store(inode, entry.size, lambda pos: reader.copy_to(self._fd, pos, entry.size))
+                entry.remaining -= entry.size
+                self.stats["files"] += 1
+            elif entry.type == _TAR_DIR:
+                self.add_directory(b"/".join(parts), entry.mode, entry.uid, entry.gid, entry.mtime)
+            elif entry.type == _TAR_SYMLINK:
+                self.add_symlink(b"/".join(parts), entry.linkname, entry.uid, entry.gid, entry.mtime)
+            elif entry.type == _TAR_HARDLINK:
+                self.add_hardlink(b"/".join(parts), entry.linkname)
+            elif entry.type in (_TAR_CHAR, _TAR_BLOCK, _TAR_FIFO):
+                file_type = {_TAR_CHAR: stat.S_IFCHR, _TAR_BLOCK: stat.S_IFBLK, _TAR_FIFO: stat.S_IFIFO}[entry.type]
+                self.add_device(b"/".join(parts), file_type, entry.devmajor, entry.devminor,
+                                entry.mode, entry.uid, entry.gid, entry.mtime)
+            else:
+                raise Ext4WriterError(f"Unsupported tar entry type {entry.type!r} for {entry.name!r}")
+            if entry.xattrs:
+                self.set_xattrs(b"/".join(parts), entry.xattrs)
+        return {"bytes": reader.bytes_read, "entries": count}
+
+    # Serialization ---------------------------------------------------------
+
+    @staticmethod
+    def _dir_blocks(inode: _Inode) -> bytes:
+        entries = [(inode.number, b".", 2), (inode.parent.number, b"..", 2)]
+        entries += [
+            (child.number, name, _DIRENT_TYPES[stat.S_IFMT(child.mode)])
+            for name, child in inode.children.items()
+        ]
+        blocks = bytearray()
+        block = bytearray()
+        last = 0
+        for number, name, file_type in entries:
+            rec_len = _pad4(8 + len(name))
+            if len(block) + rec_len > BLOCK_SIZE:
+                struct.pack_into("<H", block, last + 4, BLOCK_SIZE - last)
+                blocks += block.ljust(BLOCK_SIZE, b"\0")
+                block = bytearray()
+            last = len(block)
+            block += struct.pack("<IHBB", number, rec_len, len(name), file_type) + name.ljust(rec_len - 8, b"\0")
+        struct.pack_into("<H", block, last + 4, BLOCK_SIZE - last)
+        blocks += block.ljust(BLOCK_SIZE, b"\0")
+        empty = struct.pack("<IHBB", 0, BLOCK_SIZE, 0, 0).ljust(BLOCK_SIZE, b"\0")
+        while len(blocks) < inode.min_blocks * BLOCK_SIZE:
+            blocks += empty
+        return bytes(blocks)
+
+    @staticmethod
+    def _extent_records(extents: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
+        records = []
+        for logical, physical, length in extents:
+            while length > 0:
+                run = min(length, MAX_EXTENT_LEN)
+                records.append((logical, physical, run))
+                logical += run
+                physical += run
+                length -= run
+        return records
+
+    @staticmethod
+    def _pack_extents(records: List[Tuple[int, int, int]], capacity: int) -> bytes:
+        data = struct.pack("<HHHHI", EXTENT_MAGIC, len(records), capacity, 0, 0)
+        for logical, physical, length in records:
+            data += struct.pack("<IHHI", logical, length, physical >> 32, physical & 0xFFFFFFFF)
+        return data
+
+    @staticmethod
+    def _xattr_entries(xattrs: Dict[str, bytes]) -> List[Tuple[int, bytes, bytes]]:
+        entries = []
+        for name, value in xattrs.items():
+            for prefix, index in _XATTR_PREFIXES:
+                if name.startswith(prefix):
+                    entries.append((index, name[len(prefix):].encode(), value))
+                    break
+        entries.sort(key=lambda e: (e[0], len(e[1]), e[1]))
+        return entries
+
+    @staticmethod
+    def _xattr_hash(name: bytes, value: bytes) -> int:
+        value_hash = 0
+        for char in name:
+            value_hash = ((value_hash << 5) ^ (value_hash >> 27) ^ char) & 0xFFFFFFFF
+        padded = value.ljust(_pad4(len(value)), b"\0")
+        for (word,) in struct.iter_unpack("<I", padded):
+            value_hash = ((value_hash << 16) ^ (value_hash >> 16) ^ word) & 0xFFFFFFFF
+        return value_hash
+
+    def _pack_xattr_region(self, entries, region_size: int, entries_start: int, value_base: int,
+                           hashed: bool) -> Optional[bytearray]:
+        """Lay out entries at entries_start and values at the end of a region of region_size"""
+        needed = entries_start + 4 + sum(16 + _pad4(len(n)) + _pad4(len(v)) for _, n, v in entries)
+        if needed > region_size:
+            return None
+        region = bytearray(region_size)
+        pos = entries_start
+        value_end = region_size
+        for index, name, value in entries:
+            value_offs = 0
+            if value:
+                value_end -= _pad4(len(value))
+                region[value_end:value_end + len(value)] = value
+                value_offs = value_end - value_base
+            entry_hash = self._xattr_hash(name, value) if hashed else 0
+            struct.pack_into("<BBHIII", region, pos, len(name), index, value_offs, 0, len(value), entry_hash)
+            region[pos + 16:pos + 16 + len(name)] = name
+            pos += 16 + _pad4(len(name))
+        return region
+
+    def _pack_inode(self, inode: _Inode, i_block: bytes, blocks: int, xattr_block: int,
+                    in_inode_xattrs: Optional[bytes]) -> bytes:
+        mtime, epoch = _split_time(inode.mtime)
+        flags = EXTENTS_FL if (stat.S_ISREG(inode.mode) or inode.is_dir or
+                               (inode.symlink is not None and inode.extents)) else 0
+        links = inode.links
+        if inode.is_dir:
+            subdirs = sum(1 for child in inode.children.values() if child.is_dir)
+            links = 2 + subdirs if subdirs < 64998 else 1
+        data = bytearray(INODE_SIZE)
+        struct.pack_into(
+            "<HHIIIIIHHII", data, 0,
+            inode.mode & 0xFFFF, inode.uid & 0xFFFF, inode.size & 0xFFFFFFFF,
+            mtime, mtime, mtime, 0, inode.gid & 0xFFFF, links, blocks * (BLOCK_SIZE // 512), flags
+        )
+        data[0x28:0x28 + len(i_block)] = i_block
+        struct.pack_into("<III", data, 0x64, 0, xattr_block & 0xFFFFFFFF, inode.size >> 32)
+        struct.pack_into("<HHHH", data, 0x74, 0, xattr_block >> 32, (inode.uid >> 16) & 0xFFFF,
+                         (inode.gid >> 16) & 0xFFFF)
+        struct.pack_into("<HHIIIII", data, 0x80, INODE_EXTRA_ISIZE, 0, epoch, epoch, epoch, mtime, epoch)
+        if in_inode_xattrs is not None:
+            data[0x80 + INODE_EXTRA_ISIZE:] = in_inode_xattrs
+        return bytes(data)
+
+    @staticmethod
+    def _i_block_for_special(inode: _Inode) -> bytes:
+        if inode.symlink is not None:
+            return inode.symlink
+        major, minor = inode.rdev
+        if major < 256 and minor < 256:
+            return struct.pack("<II", (major << 8) | minor, 0)
+        return struct.pack("<II", 0, (minor & 0xFF) | (major << 8) | ((minor & ~0xFF) << 12))
+
+    @staticmethod
+    def _set_bits(bitmap: bytearray, start: int, count: int) -> None:
+        end = start + count
+        while start < end and start % 8:
+            bitmap[start // 8] |= 1 << (start % 8)
+            start += 1
+        full_end = end - end % 8
+        if start < full_end:
+            bitmap[start // 8:full_end // 8] = b"\xff" * ((full_end - start) // 8)
+            start = full_end
+        while start < end:
+            bitmap[start // 8] |= 1 << (start % 8)
+            start += 1
+
+    def close(self) -> Dict[str, Any]:
+        """
+        Lay out and write all metadata
+
+        Returns:
+            dict: Filesystem geometry and usage (blocks_count, size_bytes,
+                used_blocks, inodes_count, used_inodes, data_end_block)
+        """
+        if self._closed:
+            raise Ext4WriterError("Writer is already closed")
+        self._closed = True
+        try:
+            return self._finish()
+        finally:
+            if self._owns_fd:
+                os.close(self._fd)
+
+    def _finish(self) -> Dict[str, Any]:
+        inodes = sorted(self._inodes.values(), key=lambda i: i.number)
+        data_end = self._next_block
+        cursor = data_end
+
+        # Directories, extent leaves and xattr blocks go right after the data
+        dir_data = {}
+        for inode in inodes:
+            if inode.is_dir:
+                blocks = self._dir_blocks(inode)
+                inode.size = len(blocks)
+                inode.extents = [(0, cursor, len(blocks) // BLOCK_SIZE)]
+                dir_data[cursor] = blocks
+                cursor += len(blocks) // BLOCK_SIZE
+
+        i_blocks: Dict[int, bytes] = {}
+        block_counts: Dict[int, int] = {}
+        leaf_data: Dict[int, bytes] = {}
+        for inode in inodes:
+            if inode.symlink is not None and not inode.extents or stat.S_IFMT(inode.mode) in (
+                    stat.S_IFCHR, stat.S_IFBLK, stat.S_IFIFO, stat.S_IFSOCK):
+                i_blocks[inode.number] = self._i_block_for_special(inode)
+                block_counts[inode.number] = 0
+                continue
+            records = self._extent_records(inode.extents)
+            used = sum(length for _, _, length in inode.extents)
+            if len(records) <= 4:
+                i_blocks[inode.number] = self._pack_extents(records, 4)
+            else:
+                leaves = [records[i:i + EXTENTS_PER_LEAF] for i in range(0, len(records), EXTENTS_PER_LEAF)]
+                if len(leaves) > 4:
+                    raise Ext4WriterError(f"File too fragmented for a depth-1 extent tree (inode {inode.number})")
+                index = struct.pack("<HHHHI", EXTENT_MAGIC, len(leaves), 4, 1, 0)
+                for leaf in leaves:
+                    leaf_data[cursor] = self._pack_extents(leaf, EXTENTS_PER_LEAF).ljust(BLOCK_SIZE, b"\0")
+                    index += struct.pack("<IIHH", leaf[0][0], cursor & 0xFFFFFFFF, cursor >> 32, 0)
+                    cursor += 1
+                i_blocks[inode.number] = index
+                used += len(leaves)
+            block_counts[inode.number] = used
+
+        in_inode_xattrs: Dict[int, bytes] = {}
+        xattr_blocks: Dict[int, int] = {}
+        shared_blocks: Dict[bytes, int] = {}
+        xattr_data: Dict[int, bytearray] = {}
+        refcounts: Dict[int, int] = {}
+        in_inode_size = INODE_SIZE - 0x80 - INODE_EXTRA_ISIZE
+        for inode in inodes:
+            entries = self._xattr_entries(inode.xattrs)
+            if not entries:
+                continue
+            region = self._pack_xattr_region(entries, in_inode_size, 4, 4, hashed=False)
+            if region is not None:
+                struct.pack_into("<I", region, 0, XATTR_MAGIC)
+                in_inode_xattrs[inode.number] = bytes(region)
+                continue
+            block = self._pack_xattr_region(entries, BLOCK_SIZE, 32, 0, hashed=True)
+            if block is None:
+                raise Ext4WriterError(f"Extended attributes too large (inode {inode.number})")
+            block_hash = 0
+            for index, name, value in entries:
+                block_hash = ((block_hash << 16) ^ (block_hash >> 16) ^ self._xattr_hash(name, value)) & 0xFFFFFFFF
+            struct.pack_into("<IIII", block, 0, XATTR_MAGIC, 0, 1, block_hash)
+            key = bytes(block)
+            if key not in shared_blocks:
+                shared_blocks[key] = cursor
+                xattr_data[cursor] = block
+                refcounts[cursor] = 0
+                cursor += 1
+            number = shared_blocks[key]
+            refcounts[number] += 1
+            xattr_blocks[inode.number] = number
+            block_counts[inode.number] += 1
+        for number, block in xattr_data.items():
+            struct.pack_into("<I", block, 4, refcounts[number])
+
+        # Geometry: grow until the group count covers the inode tables and bitmaps
+        used_inodes = self._next_inode - 1
+        wanted_inodes = int(used_inodes * (1 + self._inode_headroom)) + INODES_PER_BLOCK
+        metadata_start = cursor
+        if self._size_blocks is not None:
+            total_blocks = self._size_blocks
+            wanted_inodes = max(wanted_inodes, total_blocks * BLOCK_SIZE // self._inode_ratio)
+        else:
+            total_blocks = metadata_start
+        for _ in range(16):
+            groups = (total_blocks + BLOCKS_PER_GROUP - 1) // BLOCKS_PER_GROUP
+            inodes_per_group = -(-wanted_inodes // groups)
+            inodes_per_group = -(-inodes_per_group // INODES_PER_BLOCK) * INODES_PER_BLOCK
+            inodes_per_group = min(max(inodes_per_group, INODES_PER_BLOCK), BLOCKS_PER_GROUP)
+            table_blocks = inodes_per_group // INODES_PER_BLOCK
+            end = metadata_start + groups * (table_blocks + 2)
+            if self._size_blocks is not None:
+                break
+            if (end + BLOCKS_PER_GROUP - 1) // BLOCKS_PER_GROUP == groups:
+                total_blocks = end
+                break
+            total_blocks = end
+        if inodes_per_group * groups < used_inodes:
+            raise Ext4WriterError("Too many files for the filesystem size")
+        if end > total_blocks:
+            raise Ext4WriterError(
+                f"Content needs {end * BLOCK_SIZE} bytes but the filesystem is {total_blocks * BLOCK_SIZE} bytes"
+            )
+        if groups * GROUP_DESC_SIZE > self._gdt_blocks * BLOCK_SIZE:
+            raise Ext4WriterError("Filesystem larger than max_size")
+
+        table_start = metadata_start
+        block_bitmap_start = table_start + groups * table_blocks
+        inode_bitmap_start = block_bitmap_start + groups
+
+        # Write directories, extent leaves and xattr blocks
+        for start, blocks in list(dir_data.items()) + list(leaf_data.items()) + list(xattr_data.items()):
+            os.pwrite(self._fd, blocks, self._offset + start * BLOCK_SIZE)
+
+        # Inode tables: only blocks holding live inodes are written
+        table_data: Dict[int, bytearray] = {}
+        dirs_per_group = [0] * groups
+        inode_bitmap = bytearray(groups * BLOCK_SIZE)
+        for number in range(1, FIRST_INODE):
+            group, index = divmod(number - 1, inodes_per_group)
+            inode_bitmap[group * BLOCK_SIZE + index // 8] |= 1 << (index % 8)
+        for inode in inodes:
+            group, index = divmod(inode.number - 1, inodes_per_group)
+            block = table_start + group * table_blocks + index // INODES_PER_BLOCK
+            buf = table_data.setdefault(block, bytearray(BLOCK_SIZE))
+            slot = (index % INODES_PER_BLOCK) * INODE_SIZE
+            buf[slot:slot + INODE_SIZE] = self._pack_inode(
+                inode, i_blocks[inode.number], block_counts[inode.number],
+                xattr_blocks.get(inode.number, 0), in_inode_xattrs.get(inode.number)
+            )
+            inode_bitmap[group * BLOCK_SIZE + index // 8] |= 1 << (index % 8)
+            if inode.is_dir:
+                dirs_per_group[group] += 1
+        first_table_block = table_start
+        if first_table_block not in table_data:
+            table_data[first_table_block] = bytearray(BLOCK_SIZE)
+        for block, buf in table_data.items():
+            os.pwrite(self._fd, buf, self._offset + block * BLOCK_SIZE)
+
+        # Block bitmap: derived from everything that is still referenced
+        block_bitmap = bytearray(groups * BLOCK_SIZE)
+        self._set_bits(block_bitmap, 0, 1 + (groups * GROUP_DESC_SIZE + BLOCK_SIZE - 1) // BLOCK_SIZE)
+        for inode in inodes:
+            for _, physical, length in inode.extents:
+                self._set_bits(block_bitmap, physical, length)
+        for start in leaf_data:
+            self._set_bits(block_bitmap, start, 1)
+        for start in xattr_data:
+            self._set_bits(block_bitmap, start, 1)
+        self._set_bits(block_bitmap, table_start, inode_bitmap_start + groups - table_start)
+        self._set_bits(block_bitmap, total_blocks, groups * BLOCKS_PER_GROUP - total_blocks)
+
+        free_blocks = []
+        free_inodes = []
+        for group in range(groups):
+            bits = block_bitmap[group * BLOCK_SIZE:(group + 1) * BLOCK_SIZE]
+            free_blocks.append(BLOCKS_PER_GROUP - int.from_bytes(bits, "little").bit_count())
+            ibits = inode_bitmap[group * BLOCK_SIZE:(group + 1) * BLOCK_SIZE]
+            free_inodes.append(inodes_per_group - int.from_bytes(ibits, "little").bit_count())
+            self._set_bits(inode_bitmap, group * BLOCK_SIZE * 8 + inodes_per_group,
+                           BLOCK_SIZE * 8 - inodes_per_group)
+        os.pwrite(self._fd, bytes(block_bitmap), self._offset + block_bitmap_start * BLOCK_SIZE)
+        os.pwrite(self._fd, bytes(inode_bitmap), self._offset + inode_bitmap_start * BLOCK_SIZE)
+
+        # Group descriptors
+        gdt = bytearray()
+        for group in range(groups):
+            gdt += struct.pack(
+                "<IIIHHHHIHHHH",
+                block_bitmap_start + group, inode_bitmap_start + group,
+                table_start + group * table_blocks,
+                free_blocks[group], free_inodes[group], dirs_per_group[group],
+                0, 0, 0, 0, 0, 0
+            )
+        os.pwrite(self._fd, bytes(gdt), self._offset + BLOCK_SIZE)
+
+        self._write_superblock(total_blocks, groups, inodes_per_group, sum(free_blocks), sum(free_inodes),
+                               bool(in_inode_xattrs or xattr_blocks))
+
+        end_offset = self._offset + total_blocks * BLOCK_SIZE
+        if os.fstat(self._fd).st_size < end_offset:
+            os.ftruncate(self._fd, end_offset)
+
+        return {
+            "blocks_count": total_blocks,
+            "size_bytes": total_blocks * BLOCK_SIZE,
+            "used_blocks": total_blocks - sum(free_blocks),
+            "inodes_count": groups * inodes_per_group,
+            "used_inodes": groups * inodes_per_group - sum(free_inodes),
+            "data_end_block": data_end,
+            **self.stats
+        }
+
+    def _write_superblock(self, total_blocks: int, groups: int, inodes_per_group: int,
+                          free_blocks: int, free_inodes: int, has_xattrs: bool) -> None:
+        sb = bytearray(1024)
+        struct.pack_into(
+            "<IIIIIIIIIIIIIHhHHHHIIIIHHIHHIII", sb, 0,
+            groups * inodes_per_group,      # s_inodes_count
+            total_blocks,                   # s_blocks_count_lo
+            0,                              # s_r_blocks_count_lo
+            free_blocks,                    # s_free_blocks_count_lo
+            free_inodes,                    # s_free_inodes_count
+            0,                              # s_first_data_block
+            2,                              # s_log_block_size (4 KiB)
+            2,                              # s_log_cluster_size
+            BLOCKS_PER_GROUP,               # s_blocks_per_group
+            BLOCKS_PER_GROUP,               # s_clusters_per_group
+            inodes_per_group,               # s_inodes_per_group
+            0,                              # s_mtime
+            self._now,                      # s_wtime
+            0,                              # s_mnt_count
+            -1,                             # s_max_mnt_count
+            EXT4_MAGIC,                     # s_magic
+            1,                              # s_state (clean)
+            1,                              # s_errors (continue)
+            0,                              # s_minor_rev_level
+            self._now,                      # s_lastcheck
+            0,                              # s_checkinterval
+            0,                              # s_creator_os (Linux)
+            1,                              # s_rev_level (dynamic)
+            0,                              # s_def_resuid
+            0,                              # s_def_resgid
+            FIRST_INODE,                    # s_first_ino
+            INODE_SIZE,                     # s_inode_size
+            0,                              # s_block_group_nr
+            COMPAT_SPARSE_SUPER2 | (COMPAT_EXT_ATTR if has_xattrs else 0),
+            INCOMPAT_FILETYPE | INCOMPAT_EXTENTS | INCOMPAT_FLEX_BG,
+            RO_COMPAT_SPARSE_SUPER | RO_COMPAT_LARGE_FILE | RO_COMPAT_DIR_NLINK | RO_COMPAT_EXTRA_ISIZE,
+        )
+        sb[0x68:0x78] = self._uuid
+        sb[0x78:0x78 + len(self._label)] = self._label
+        sb[0xEC:0xFC] = os.urandom(16)             # s_hash_seed
+        struct.pack_into("<B", sb, 0xFC, 1)         # s_def_hash_version (half_md4)
+        struct.pack_into("<I", sb, 0x108, self._now)  # s_mkfs_time
+        struct.pack_into("<HH", sb, 0x15C, INODE_EXTRA_ISIZE, INODE_EXTRA_ISIZE)
+        struct.pack_into("<B", sb, 0x174, LOG_GROUPS_PER_FLEX)
+        struct.pack_into("<II", sb, 0x24C, 0, 0)     # s_backup_bgs: no backups
+        os.pwrite(self._fd, bytes(sb), self._offset + 1024)
@@ -0,0 +1,202 @@
+"""
+Chunked, resumable image downloads
+
+The source side splits an image into chunk_size-aligned ranges and leaves
+out the ranges that lie entirely in holes, so a sparse image only moves its
+data. Every range is read and hashed independently (read_range), which lets
+the receiving side fetch ranges concurrently and in any order, and check
+each one against the sha256 computed where it was read.
+
+Progress is kept in a JSON sidecar next to the destination
+(<dest>.download.json): the source's size and mtime, the chunk size, and the
+sha256 of every range written so far. A restarted download keeps the ranges
+whose local bytes still match their recorded digest and fetches the rest; if
+the source changed in between (size or mtime differ) it starts over.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional
+
+from docker2img.diskformats import data_extents
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_CONCURRENCY = 8
+RANGE_RETRIES = 3
+STATE_SUFFIX = ".download.json"
+
+
+class ChunkChecksumError(Exception):
+    """Raised when a range still fails verification after its retries"""
+
+
+def plan_ranges(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Dict[str, Any]:
+    """
+    Describe an image for a chunked download
+
+    Returns:
+        dict: size, mtime_ns, chunk_size and ranges, the [offset, length] of
+            every chunk that overlaps data
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        st = os.fstat(fd)
+        ranges: List[List[int]] = []
+        next_start = 0
+        for start, end in data_extents(fd, st.st_size):
+            for offset in range(max(start - start % chunk_size, next_start), end, chunk_size):
+                ranges.append([offset, min(chunk_size, st.st_size - offset)])
+                next_start = offset + chunk_size
+    finally:
+        os.close(fd)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "chunk_size": chunk_size, "ranges": ranges}
+
+
+def read_range(path: str, offset: int, length: int) -> Dict[str, Any]:
+    """Read one range and its sha256"""
+    with open(path, "rb") as f:
+        data = os.pread(f.fileno(), length, offset)
+    return {"offset": offset, "data": data, "sha256": hashlib.sha256(data).hexdigest()}
+
+
+class DownloadState:
+    """
+    The sidecar file recording which ranges of a download are written
+
+    Saves are atomic (write and rename), so an interrupted download leaves
+    either the previous or the new state behind.
+    """
+
+    def __init__(self, dest: str):
+        self.path = dest + STATE_SUFFIX
+        self.source: Dict[str, Any] = {}
+        self.done: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def load(self, source: Dict[str, Any]) -> bool:
+        """Pick up a previous run for the same source; returns whether one was found"""
+        self.source = source
+        self.done = {}
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if saved.get("source") != source:
+            return False
+        self.done = {int(offset): digest for offset, digest in saved.get("done", {}).items()}
+        return True
+
+    def mark_done(self, offset: int, digest: str) -> None:
+        with self._lock:
+            self.done[offset] = digest
+            self.save()
+
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"source": self.source, "done": self.done}, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self) -> None:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _local_digest(fd: int, offset: int, length: int) -> str:
+    return hashlib.sha256(os.pread(fd, length, offset)).hexdigest()
+
+
+def download_image(
+    plan: Dict[str, Any],
+    fetch: Callable[[int, int], Dict[str, Any]],
+    dest: str,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    progress: Optional[Callable[[int, int], None]] = None
+) -> Dict[str, Any]:
+    """
+    Fetch the ranges of a planned image into dest, resuming a previous run
+
+    Args:
+        plan: plan_ranges result for the source image (plus any fields that
+            identify it, such as its name; all of them must match to resume)
+        fetch: Called as fetch(offset, length) from worker threads; returns a
+            read_range result
+        dest: Local file; it is created sparse at the source size, so holes
+            stay holes
+        concurrency: Ranges in flight at once
+        progress: Called with (bytes done, bytes total) after every range
+
+    Returns:
+        dict: ranges, bytes, resumed_ranges, resumed_bytes and retries
+
+    Raises:
+        ChunkChecksumError: A range did not match its checksum RANGE_RETRIES
+            times in a row
+    """
+    source = {key: value for key, value in plan.items() if key != "ranges"}
+    state = DownloadState(dest)
+    resumed = state.load(source) and os.path.exists(dest)
+    ranges = [tuple(r) for r in plan["ranges"]]
+    total = sum(length for _, length in ranges)
+
+    fd = os.open(dest, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if not resumed:
+            state.done = {}
+            os.ftruncate(fd, 0)
+        os.ftruncate(fd, plan["size"])
+        state.save()
+
+        # Keep only the ranges whose bytes on disk still match
+        pending = []
+        for offset, length in ranges:
+            digest = state.done.get(offset)
+            if digest is None or _local_digest(fd, offset, length) != digest:
+                state.done.pop(offset, None)
+                pending.append((offset, length))
+        resumed_bytes = total - sum(length for _, length in pending)
+        done_bytes = resumed_bytes
+        retries = 0
+        counter_lock = threading.Lock()
+
+        def transfer(offset: int, length: int) -> int:
+            nonlocal retries
+            for attempt in range(RANGE_RETRIES):
+                chunk = fetch(offset, length)
+                data = chunk["data"]
+                if len(data) == length and hashlib.sha256(data).hexdigest() == chunk["sha256"]:
+                    os.pwrite(fd, data, offset)
+                    state.mark_done(offset, chunk["sha256"])
+                    return length
+                with counter_lock:
+                    retries += 1
+            raise ChunkChecksumError(f"Range at {offset} failed verification {RANGE_RETRIES} times")
+
+        with ThreadPoolExecutor(max(1, concurrency), thread_name_prefix="download") as pool:
+            futures = [pool.submit(transfer, offset, length) for offset, length in pending]
+            try:
+                for future in as_completed(futures):
+                    done_bytes += future.result()
+                    if progress:
+                        progress(done_bytes, total)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    state.remove()
+    return {
+        "ranges": len(ranges),
+        "bytes": total,
+        "resumed_ranges": len(ranges) - len(pending),
+        "resumed_bytes": resumed_bytes,
+        "retries": retries,
+    }
@@ -0,0 +1,6 @@
+"""
+Tests for the docker2img helper modules
+
+They run offline and without Modal: registry code is exercised against the
+in-process distribution stand-in in tests/registry_stub.py.
+"""
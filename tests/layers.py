@@ -0,0 +1,75 @@
+"""
+Builders for the small tar layers and images the tests feed through the
+converter modules
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import tarfile
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# (name, kind, payload): kind is "file" (bytes), "dir", "symlink" or
+# "hardlink" (the target name)
+Entry = Tuple[str, str, object]
+
+
+def layer_tar(entries: Iterable[Entry], mode: int = 0o644) -> bytes:
+    """An uncompressed layer tar holding entries in the given order"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        for name, kind, payload in entries:
+            info = tarfile.TarInfo(name)
+            info.mtime = 1700000000
+            if kind == "file":
+                info.size = len(payload)
+                info.mode = mode
+                tar.addfile(info, io.BytesIO(payload))
+                continue
+            if kind == "dir":
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+            elif kind == "symlink":
+                info.type = tarfile.SYMTYPE
+                info.linkname = payload
+            elif kind == "hardlink":
+                info.type = tarfile.LNKTYPE
+                info.linkname = payload
+            else:
+                raise ValueError(f"Unknown entry kind: {kind}")
+            tar.addfile(info)
+    return buffer.getvalue()
+
+
+def gzip_layer(data: bytes) -> bytes:
+    return gzip.compress(data, mtime=0)
+
+
+def digest(data: bytes) -> str:
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def image_config(diff_ids: List[str], platform: str = "linux/amd64") -> bytes:
+    os_name, architecture, *rest = platform.split("/")
+    config = {
+        "os": os_name,
+        "architecture": architecture,
+        "rootfs": {"type": "layers", "diff_ids": diff_ids},
+        "config": {},
+    }
+    if rest:
+        config["variant"] = rest[0]
+    return json.dumps(config).encode()
+
+
+def extract_members(tar_bytes: bytes) -> Dict[str, tarfile.TarInfo]:
+    with tarfile.open(fileobj=io.BytesIO(tar_bytes)) as tar:
+        return {member.name: member for member in tar.getmembers()}
+
+
+def read_member(tar_bytes: bytes, name: str) -> Optional[bytes]:
+    with tarfile.open(fileobj=io.BytesIO(tar_bytes)) as tar:
+        member = tar.getmember(name)
+        handle = tar.extractfile(member)
+        return handle.read() if handle else None
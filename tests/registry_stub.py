@@ -0,0 +1,241 @@
+"""
+In-process OCI distribution stand-in
+
+Serves manifests, indexes and blobs from memory on 127.0.0.1 (which
+RegistryClient speaks plain HTTP to), with the parts of the protocol the
+client depends on:
+
+- token auth: /v2/ requests without a valid bearer token get a 401 with a
+  Bearer challenge pointing at /token, which checks basic credentials when
+  the stub has any; "basic" auth challenges for credentials directly;
+- blob GETs honour Range (206 with Content-Range) and can be redirected to a
+  /storage/ URL that, like S3, rejects requests carrying an Authorization
+  header;
+- manifests carry Docker-Content-Digest.
+
+Every request is logged as (method, path) in requests.
+"""
+
+import base64
+import hashlib
+import json
+import re
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from tests.layers import digest, gzip_layer, image_config, layer_tar
+
+MEDIA_OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+MEDIA_OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+MEDIA_OCI_CONFIG = "application/vnd.oci.image.config.v1+json"
+MEDIA_OCI_LAYER_GZIP = "application/vnd.oci.image.layer.v1.tar+gzip"
+
+_V2_PATH = re.compile(r"^/v2/(?P<repository>.+)/(?P<kind>manifests|blobs)/(?P<reference>[^/]+)$")
+_RANGE = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+
+class RegistryStub:
+    """
+    Minimal registry serving images pushed with push_image/push_index
+
+    Args:
+        auth: None (anonymous), "bearer" (token auth) or "basic"
+        username: Credentials the token endpoint or basic auth accept
+        password: See username
+        redirect_blobs: Answer blob GETs with a 307 to /storage/
+    """
+
+    def __init__(self, auth: Optional[str] = None, username: Optional[str] = None,
+                 password: Optional[str] = None, redirect_blobs: bool = False):
+        self.auth = auth
+        self.credentials = (username, password) if username else None
+        self.redirect_blobs = redirect_blobs
+        self.blobs: Dict[str, bytes] = {}
+        self.manifests: Dict[Tuple[str, str], Tuple[bytes, str]] = {}
+        self.requests: List[Tuple[str, str]] = []
+        self._tokens = set()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def registry(self) -> str:
+        return f"127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self) -> "RegistryStub":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_blob(self, data: bytes) -> str:
+        blob_digest = digest(data)
+        self.blobs[blob_digest] = data
+        return blob_digest
+
+    def add_manifest(self, repository: str, manifest: Dict[str, Any], tags=()) -> str:
+        raw = json.dumps(manifest).encode()
+        manifest_digest = digest(raw)
+        for reference in (manifest_digest, *tags):
+            self.manifests[(repository, reference)] = (raw, manifest["mediaType"])
+        return manifest_digest
+
+    def push_image(self, repository: str, layers: List[bytes], tags=(), platform: str = "linux/amd64",
+                   compress: bool = True) -> Dict[str, Any]:
+        """
+        Store an image built from uncompressed layer tars
+
+        Returns:
+            dict: digest (of the manifest), layers (the stored blob digests)
+        """
+        blobs = [gzip_layer(layer) if compress else layer for layer in layers]
+        config = image_config([digest(layer) for layer in layers], platform)
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": MEDIA_OCI_MANIFEST,
+            "config": {"mediaType": MEDIA_OCI_CONFIG, "digest": self.add_blob(config), "size": len(config)},
+            "layers": [
+                {"mediaType": MEDIA_OCI_LAYER_GZIP, "digest": self.add_blob(blob), "size": len(blob)}
+                for blob in blobs
+            ],
+        }
+        return {
+            "digest": self.add_manifest(repository, manifest, tags),
+            "layers": [layer["digest"] for layer in manifest["layers"]],
+        }
+
+    def push_index(self, repository: str, images: Dict[str, str], tags=()) -> str:
+        """Store an index over platform manifests ({platform: manifest digest})"""
+        entries = []
+        for platform, manifest_digest in images.items():
+            os_name, architecture, *rest = platform.split("/")
+            described = {"os": os_name, "architecture": architecture}
+            if rest:
+                described["variant"] = rest[0]
+            raw, media_type = self.manifests[(repository, manifest_digest)]
+            entries.append({"mediaType": media_type, "digest": manifest_digest, "size": len(raw),
+                            "platform": described})
+        return self.add_manifest(repository, {"schemaVersion": 2, "mediaType": MEDIA_OCI_INDEX,
+                                              "manifests": entries}, tags)
+
+    def blob_requests(self) -> int:
+        return sum(1 for method, path in self.requests if "/blobs/" in path or path.startswith("/storage/"))
+
+    def _authorized(self, header: Optional[str]) -> bool:
+        if self.auth == "bearer":
+            return bool(header) and header.startswith("Bearer ") and header[7:] in self._tokens
+        if self.auth == "basic":
+            return header == self._basic()
+        return True
+
+    def _basic(self) -> Optional[str]:
+        if not self.credentials:
+            return None
+        return "Basic " + base64.b64encode(":".join(self.credentials).encode()).decode()
+
+    def _issue_token(self) -> str:
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._tokens.add(token)
+        return token
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, code: int, body: bytes = b"", headers: Optional[Dict[str, str]] = None) -> None:
+                self.send_response(code)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests.append((self.command, self.path))
+                path = self.path.split("?", 1)[0]
+                if path == "/token":
+                    return self._token()
+                if path.startswith("/storage/"):
+                    if "Authorization" in self.headers:
+                        return self._send(400, b"storage rejects registry credentials")
+                    return self._blob("sha256:" + path[len("/storage/"):])
+                match = _V2_PATH.match(path)
+                if not match:
+                    return self._send(404)
+                if not stub._authorized(self.headers.get("Authorization")):
+                    repository = match.group("repository")
+                    if stub.auth == "basic":
+                        challenge = 'Basic realm="stub"'
+                    else:
+                        challenge = (f'Bearer realm="http://{stub.registry}/token",service="stub",'
+                                     f'scope="repository:{repository}:pull"')
+                    return self._send(401, b"", {"WWW-Authenticate": challenge})
+                if match.group("kind") == "manifests":
+                    return self._manifest(match.group("repository"), match.group("reference"))
+                if stub.redirect_blobs:
+                    hex_digest = match.group("reference").partition(":")[2]
+                    return self._send(307, b"", {"Location": f"/storage/{hex_digest}"})
+                return self._blob(match.group("reference"))
+
+            def _token(self):
+                if stub.credentials and self.headers.get("Authorization") != stub._basic():
+                    return self._send(401)
+                body = json.dumps({"token": stub._issue_token()}).encode()
+                self._send(200, body, {"Content-Type": "application/json"})
+
+            def _manifest(self, repository: str, reference: str):
+                found = stub.manifests.get((repository, reference))
+                if found is None:
+                    return self._send(404)
+                raw, media_type = found
+                self._send(200, raw, {
+                    "Content-Type": media_type,
+                    "Docker-Content-Digest": "sha256:" + hashlib.sha256(raw).hexdigest(),
+                })
+
+            def _blob(self, blob_digest: str):
+                data = stub.blobs.get(blob_digest)
+                if data is None:
+                    return self._send(404)
+                requested = _RANGE.match(self.headers.get("Range", ""))
+                if not requested:
+                    return self._send(200, data, {"Accept-Ranges": "bytes"})
+                start = int(requested.group(1))
+                end = min(int(requested.group(2) or len(data) - 1), len(data) - 1)
+                if start >= len(data):
+                    return self._send(416, b"", {"Content-Range": f"bytes */{len(data)}"})
+                self._send(206, data[start:end + 1], {"Content-Range": f"bytes {start}-{end}/{len(data)}"})
+
+        return Handler
+
+
+def simple_image(stub: RegistryStub, repository: str = "app", tag: str = "latest") -> Dict[str, Any]:
+    """A two-layer image whose top layer deletes and replaces base content"""
+    base = layer_tar([
+        ("etc", "dir", None),
+        ("etc/hostname", "file", b"base\n"),
+        ("etc/motd", "file", b"welcome\n"),
+        ("usr", "dir", None),
+        ("usr/bin", "dir", None),
+        ("usr/bin/tool", "file", b"#!/bin/sh\n"),
+    ])
+    top = layer_tar([
+        ("etc", "dir", None),
+        ("etc/hostname", "file", b"top\n"),
+        ("etc/.wh.motd", "file", b""),
+    ])
+    return stub.push_image(repository, [base, top], tags=(tag,))
@@ -0,0 +1,122 @@
+import os
+import time
+
+import pytest
+
+from docker2img.aptcache import AptCache, AptCacheError, VolumeLock, restore_docker_clean, suspend_docker_clean
+
+SIMULATE = """\
+NOTE: This is only a simulation!
+Inst libc6 (2.36-9+deb12u4 Debian:12.5/stable [amd64])
+Inst tzdata [2024a-0+deb12u1] (2024a-0+deb12u2 Debian:12.5/stable [all])
+Inst systemd:amd64 (252.22-1~deb12u1 Debian:12.5/stable [amd64])
+Inst perl-base (1:5.36.0-7+deb12u1 Debian:12.5/stable [amd64])
+Conf libc6 (2.36-9+deb12u4 Debian:12.5/stable [amd64])
+"""
+
+
+def package(cache, key, name, size, seconds):
+    path = os.path.join(cache.archives_dir(key), name)
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    age(path, seconds)
+    return path
+
+
+def age(path: str, seconds: float) -> None:
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_planned_files():
+    assert AptCache.planned_files(SIMULATE) == [
+        "libc6_2.36-9+deb12u4_amd64.deb",
+        "tzdata_2024a-0+deb12u2_all.deb",
+        "systemd_252.22-1~deb12u1_amd64.deb",
+        "perl-base_1%3a5.36.0-7+deb12u1_amd64.deb",
+    ]
+
+
+def test_release_key():
+    fields = {"id": "debian", "version_codename": "bookworm", "version_id": "12"}
+    assert AptCache.release_key(fields, "amd64") == "debian-bookworm-amd64"
+    assert AptCache.release_key({"id": "alpine", "version_id": "3.19.1"}, "arm64") == "alpine-3.19.1-arm64"
+    assert AptCache.release_key({"id": "odd/os"}, "amd64") == "odd_os-unknown-amd64"
+
+
+def test_missing_and_touch(tmp_path):
+    cache = AptCache(str(tmp_path), max_bytes=1 << 20)
+    key = "debian-bookworm-amd64"
+    path = package(cache, key, "libc6_2.36_amd64.deb", 10, 3600)
+    assert cache.missing(key, ["libc6_2.36_amd64.deb", "bash_5.2_amd64.deb"]) == ["bash_5.2_amd64.deb"]
+    cache.touch(key, ["libc6_2.36_amd64.deb", "bash_5.2_amd64.deb"])
+    assert time.time() - os.path.getmtime(path) < 60
+    assert not cache.has_lists(key)
+    open(os.path.join(cache.lists_dir(key), "deb.debian.org_debian_dists_bookworm_main_binary-amd64_Packages"), "w").close()
+    assert cache.has_lists(key)
+
+
+def test_eviction_is_oldest_first_across_releases(tmp_path):
+    grace = 60
+    cache = AptCache(str(tmp_path), max_bytes=250, grace=grace)
+    oldest = package(cache, "debian-bookworm-amd64", "a_1_amd64.deb", 100, grace * 10)
+    older = package(cache, "ubuntu-noble-amd64", "b_1_amd64.deb", 100, grace * 9)
+    newer = package(cache, "debian-bookworm-amd64", "c_1_amd64.deb", 100, grace * 8)
+    assert cache.evict() == {"total_bytes": 200, "evicted_files": 1, "evicted_bytes": 100}
+    assert not os.path.exists(oldest)
+    assert os.path.exists(older) and os.path.exists(newer)
+    # The release locks are released again
+    assert not os.path.exists(tmp_path / "debian-bookworm-amd64" / ".lock")
+
+
+def test_recently_used_packages_are_kept(tmp_path):
+    grace = 60
+    cache = AptCache(str(tmp_path), max_bytes=0, grace=grace)
+    stale = package(cache, "debian-bookworm-amd64", "a_1_amd64.deb", 100, grace * 2)
+    fresh = package(cache, "debian-bookworm-amd64", "b_1_amd64.deb", 100, grace / 2)
+    assert cache.evict() == {"total_bytes": 100, "evicted_files": 1, "evicted_bytes": 100}
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
+
+
+def test_eviction_only_considers_package_files(tmp_path):
+    cache = AptCache(str(tmp_path), max_bytes=0, grace=0, package_suffix=".apk")
+    key = "alpine-3.19-amd64"
+    apk = package(cache, key, "busybox-1.36.1-r15.apk", 100, 3600)
+    index = package(cache, key, "APKINDEX.1a2b3c4d.tar.gz", 100, 3600)
+    assert cache.evict()["evicted_files"] == 1
+    assert not os.path.exists(apk)
+    assert os.path.exists(index)
+    assert AptCache(str(tmp_path / "missing"), max_bytes=0).evict()["total_bytes"] == 0
+
+
+def test_volume_lock(tmp_path):
+    path = str(tmp_path / ".lock")
+    with VolumeLock(path):
+        assert os.path.isdir(path)
+        with pytest.raises(AptCacheError, match="Timed out"):
+            with VolumeLock(path, timeout=0):
+                pass
+    assert not os.path.exists(path)
+
+
+def test_stale_volume_lock_is_broken(tmp_path):
+    path = str(tmp_path / ".lock")
+    # A container that crashed while holding the lock
+    os.mkdir(path)
+    age(path, 120)
+    with VolumeLock(path, timeout=0, stale_after=60):
+        assert os.path.isdir(path)
+    assert os.listdir(tmp_path) == []
+
+
+def test_docker_clean_is_suspended_and_restored(tmp_path):
+    conf_dir = tmp_path / "root" / "etc" / "apt" / "apt.conf.d"
+    conf_dir.mkdir(parents=True)
+    (conf_dir / "docker-clean").write_text("DPkg::Post-Invoke { \"rm -f /var/cache/apt/archives/*.deb\"; };\n")
+    stash = str(tmp_path / "stash")
+    moved = suspend_docker_clean(str(tmp_path / "root"), stash)
+    assert moved == ["docker-clean"] and not (conf_dir / "docker-clean").exists()
+    restore_docker_clean(str(tmp_path / "root"), stash, moved)
+    assert (conf_dir / "docker-clean").exists()
+    assert suspend_docker_clean(str(tmp_path / "other"), stash) == []
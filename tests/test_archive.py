@@ -0,0 +1,177 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+import pytest
+
+from docker2img.archive import ArchiveError, assemble_blob, cached_layers, read_archive, upload_layers, write_part
+from docker2img.blobcache import BlobCache
+from docker2img.registry import flatten_layers
+from tests.layers import digest, extract_members, gzip_layer, image_config, layer_tar, read_member
+
+BASE = layer_tar([("etc", "dir", None), ("etc/big", "file", os.urandom(3_000_000))])
+TOP = layer_tar([("etc/hello", "file", b"hi\n")])
+MEDIA_GZIP = "application/vnd.oci.image.layer.v1.tar+gzip"
+
+
+def hexdigest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def add(tar, name, data=None, linkname=None):
+    info = tarfile.TarInfo(name)
+    if linkname is not None:
+        info.type = tarfile.SYMTYPE
+        info.linkname = linkname
+        tar.addfile(info)
+        return
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def docker_save(path, tags=("myapp:latest",), platform="linux/amd64"):
+    """Legacy docker save layout; the third layer repeats the base through a symlink"""
+    config = image_config([digest(BASE), digest(TOP), digest(BASE)], platform)
+    with tarfile.open(path, "w") as tar:
+        add(tar, "aaa/layer.tar", BASE)
+        add(tar, "bbb/layer.tar", TOP)
+        add(tar, "ccc/layer.tar", linkname="../aaa/layer.tar")
+        add(tar, hexdigest(config) + ".json", config)
+        manifest = [{"Config": hexdigest(config) + ".json", "RepoTags": list(tags),
+                     "Layers": ["aaa/layer.tar", "bbb/layer.tar", "ccc/layer.tar"]}]
+        add(tar, "manifest.json", json.dumps(manifest).encode())
+    return config
+
+
+def oci_layout(path):
+    """OCI layout with a nested index naming the image and an arm64 entry"""
+    base = gzip_layer(BASE)
+    config = image_config([digest(BASE)])
+    manifest = json.dumps({
+        "schemaVersion": 2,
+        "config": {"digest": digest(config)},
+        "layers": [{"digest": digest(base), "mediaType": MEDIA_GZIP, "size": len(base)}],
+    }).encode()
+    arm_config = image_config([digest(BASE)], "linux/arm64")
+    arm_manifest = json.dumps({"config": {"digest": digest(arm_config)}, "layers": []}).encode()
+    nested = json.dumps({"manifests": [
+        {"digest": digest(manifest), "platform": {"os": "linux", "architecture": "amd64"}},
+        {"digest": digest(arm_manifest), "platform": {"os": "linux", "architecture": "arm64"}},
+    ]}).encode()
+    index = json.dumps({"manifests": [
+        {"digest": digest(nested), "annotations": {"org.opencontainers.image.ref.name": "v1"}},
+    ]}).encode()
+    with tarfile.open(path, "w") as tar:
+        add(tar, "oci-layout", b'{"imageLayoutVersion": "1.0.0"}')
+        add(tar, "index.json", index)
+        for blob in (base, config, manifest, arm_config, arm_manifest, nested):
+            add(tar, "blobs/sha256/" + hexdigest(blob), blob)
+    return base, config
+
+
+def test_docker_save(tmp_path):
+    path = tmp_path / "image.tar"
+    config = docker_save(path)
+    image = read_archive(str(path))
+    assert image["name"] == "myapp:latest"
+    assert image["digest"] == digest(config)
+    assert [layer["digest"] for layer in image["layers"]] == [digest(BASE), digest(TOP), digest(BASE)]
+    with open(path, "rb") as f:
+        for layer, data in zip(image["layers"], (BASE, TOP, BASE)):
+            f.seek(layer["offset"])
+            assert f.read(layer["size"]) == data
+
+
+def test_docker_save_tag_selection(tmp_path):
+    path = tmp_path / "image.tar"
+    docker_save(path, tags=("a:1", "a:2"))
+    assert read_archive(str(path), reference="a:2")["name"] == "a:2"
+    with pytest.raises(ArchiveError, match="0 matching images"):
+        read_archive(str(path), reference="b:1")
+
+
+def test_docker_save_platform_mismatch(tmp_path):
+    path = tmp_path / "image.tar"
+    docker_save(path, platform="linux/arm64")
+    with pytest.raises(ArchiveError, match="linux/arm64 image, not linux/amd64"):
+        read_archive(str(path))
+
+
+def test_oci_layout(tmp_path):
+    path = tmp_path / "oci.tar"
+    base, config = oci_layout(path)
+    image = read_archive(str(path))
+    assert image["name"] == "v1"
+    assert image["digest"] == digest(config)
+    assert [(layer["digest"], layer["mediaType"]) for layer in image["layers"]] == [(digest(base), MEDIA_GZIP)]
+    assert read_archive(str(path), reference="app:v1")["name"] == "app:v1"
+    with pytest.raises(ArchiveError, match="0 linux/s390x images"):
+        read_archive(str(path), platform="linux/s390x")
+
+
+def test_not_an_image(tmp_path):
+    path = tmp_path / "plain.tar"
+    path.write_bytes(layer_tar([("etc/a", "file", b"a")]))
+    with pytest.raises(ArchiveError, match="neither manifest.json"):
+        read_archive(str(path))
+    compressed = tmp_path / "image.tar.gz"
+    compressed.write_bytes(gzip_layer(path.read_bytes()))
+    with pytest.raises(ArchiveError, match="not an uncompressed tar"):
+        read_archive(str(compressed))
+
+
+def test_upload_and_flatten(tmp_path):
+    path = tmp_path / "image.tar"
+    docker_save(path)
+    image = read_archive(str(path))
+    cache = BlobCache(str(tmp_path / "cache"), 1 << 30)
+    progress = []
+    layers = list({layer["digest"]: layer for layer in image["layers"]}.values())
+    sent = upload_layers(str(path), layers, lambda *part: write_part(str(tmp_path / "up"), *part),
+                         1 << 20, 4, progress=lambda done, total: progress.append(done))
+    assert sent == len(BASE) + len(TOP) == progress[-1]
+    for layer in layers:
+        cache.acquire(layer["digest"], lambda dest, layer=layer: assemble_blob(
+            str(tmp_path / "up"), layer["digest"], layer["size"], dest))
+
+    paths = cached_layers(image, cache)
+    assert [open(p, "rb").read() for p, _ in paths] == [BASE, TOP, BASE]
+    out = io.BytesIO()
+    flatten_layers(paths, out)
+    assert "etc/hello" in extract_members(out.getvalue())
+    assert read_member(out.getvalue(), "etc/hello") == b"hi\n"
+    cache.release()
+
+
+def test_cached_layers_requires_upload(tmp_path):
+    path = tmp_path / "image.tar"
+    docker_save(path)
+    cache = BlobCache(str(tmp_path / "cache"), 1 << 30)
+    with pytest.raises(ArchiveError, match="not in the layer cache"):
+        cached_layers(read_archive(str(path)), cache)
+
+
+def test_corrupted_range_is_rejected(tmp_path):
+    with pytest.raises(ArchiveError, match="arrived corrupted"):
+        write_part(str(tmp_path), digest(TOP), 0, b"data", hexdigest(b"other"))
+    assert not os.listdir(tmp_path)
+
+
+def test_assemble_checks_parts(tmp_path):
+    layer_digest = digest(TOP)
+    half = len(TOP) // 2
+    write_part(str(tmp_path), layer_digest, 0, TOP[:half], hexdigest(TOP[:half]))
+    with pytest.raises(ArchiveError, match=f"has {half} of {len(TOP)} bytes"):
+        assemble_blob(str(tmp_path), layer_digest, len(TOP), str(tmp_path / "blob"))
+
+    with pytest.raises(ArchiveError, match=f"missing the range at {half}"):
+        write_part(str(tmp_path), layer_digest, half + 512, TOP[half + 512:], hexdigest(TOP[half + 512:]))
+        assemble_blob(str(tmp_path), layer_digest, len(TOP), str(tmp_path / "blob"))
+
+    tampered = b"X" + TOP[half + 1:]
+    write_part(str(tmp_path), layer_digest, half, tampered, hexdigest(tampered))
+    os.remove(os.path.join(tmp_path, layer_digest.split(":")[1], f"{half + 512:016d}"))
+    with pytest.raises(ArchiveError, match="does not match"):
+        assemble_blob(str(tmp_path), layer_digest, len(TOP), str(tmp_path / "blob"))
@@ -0,0 +1,109 @@
+import os
+import time
+
+import pytest
+
+from docker2img.blobcache import BlobCache
+from tests.layers import digest
+
+
+def filler(data: bytes):
+    def fetch(dest: str) -> int:
+        with open(dest, "wb") as f:
+            f.write(data)
+        return len(data)
+    return fetch
+
+
+def age(path: str, seconds: float) -> None:
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_hits_and_misses(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=1 << 20)
+    data = b"layer" * 100
+    first = cache.acquire(digest(data), filler(data))
+    second = cache.acquire(digest(data), filler(b"never used"))
+    assert first == second == cache.path(digest(data))
+    assert open(first, "rb").read() == data
+    assert cache.stats["misses"] == 1 and cache.stats["hits"] == 1
+    assert cache.stats["bytes_saved"] == len(data)
+    assert cache.touch(digest(data)) and not cache.touch(digest(b"other"))
+
+
+def test_failed_fetch_leaves_nothing(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=1 << 20)
+
+    def broken(dest: str) -> int:
+        with open(dest, "wb") as f:
+            f.write(b"partial")
+        raise IOError("connection reset")
+
+    with pytest.raises(IOError):
+        cache.acquire(digest(b"x"), broken)
+    assert not os.listdir(tmp_path / "tmp")
+    assert not os.path.exists(cache.path(digest(b"x")))
+
+
+def test_rejects_other_digests(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=1 << 20)
+    with pytest.raises(ValueError):
+        cache.path("sha512:" + "a" * 128)
+    with pytest.raises(ValueError):
+        cache.path("sha256:../../etc")
+
+
+def test_eviction_is_lru_and_spares_leases(tmp_path):
+    ttl = 60
+    cache = BlobCache(str(tmp_path), max_bytes=250, lease_ttl=ttl)
+    blobs = [bytes([n]) * 100 for n in range(4)]
+    for n, data in enumerate(blobs):
+        cache.acquire(digest(data), filler(data))
+        # Oldest first, all past the recent-use grace period
+        age(cache.path(digest(data)), ttl * 10 - n)
+    # Blob 0 (least recently used) stays leased; the others are released
+    lease_dir = tmp_path / "leases" / digest(blobs[0]).split(":")[1]
+    for lease in cache._leases[1:]:
+        os.remove(lease)
+
+    result = cache.evict()
+    assert result == {"total_bytes": 200, "blobs": 2}
+    assert os.path.exists(cache.path(digest(blobs[0])))
+    assert not os.path.exists(cache.path(digest(blobs[1])))
+    assert not os.path.exists(cache.path(digest(blobs[2])))
+    assert os.listdir(lease_dir)
+
+
+def test_recently_used_blobs_are_kept(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=0, lease_ttl=60)
+    data = b"fresh" * 10
+    cache.acquire(digest(data), filler(data))
+    cache.release()
+    assert cache.evict()["blobs"] == 1
+
+
+def test_stale_leases_and_downloads_expire(tmp_path):
+    ttl = 60
+    cache = BlobCache(str(tmp_path), max_bytes=0, lease_ttl=ttl)
+    data = b"crashed" * 10
+    cache.acquire(digest(data), filler(data))
+    # A container that crashed left its lease and a partial download
+    lease_dir = tmp_path / "leases" / digest(data).split(":")[1]
+    for name in os.listdir(lease_dir):
+        age(str(lease_dir / name), ttl * 2)
+    partial = tmp_path / "tmp" / "abandoned"
+    partial.write_bytes(b"partial")
+    age(str(partial), ttl * 2)
+    age(cache.path(digest(data)), ttl * 2)
+
+    assert cache.evict() == {"total_bytes": 0, "blobs": 0}
+    assert not partial.exists()
+    assert not os.listdir(lease_dir)
+    # The emptied lease directory goes once it is stale too
+    age(str(lease_dir), ttl * 2)
+    cache.evict()
+    assert not lease_dir.exists()
+    # and acquiring the blob again recreates it
+    cache.acquire(digest(data), filler(data))
+    assert os.listdir(lease_dir)
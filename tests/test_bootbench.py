@@ -0,0 +1,60 @@
+import pytest
+
+from docker2img.bootbench import BootTimer, qemu_command, summarize
+
+CONSOLE = [
+    (0.4, "SeaBIOS (version 1.16.2-debian-1.16.2-1)"),
+    (0.9, "EXTLINUX 6.04 EDD 20191223 Copyright (C) 1994-2015 H. Peter Anvin et al"),
+    (2.5, "[    0.000000] Linux version 6.1.0-10-amd64 (debian-kernel@lists.debian.org)"),
+    (2.6, "[    0.000000] Command line: BOOT_IMAGE=/vmlinuz root=/dev/sda1 console=ttyS0"),
+    (7.25, "[    3.120000] Run /init as init process"),
+    (9.0, "[    4.800000] Run /sbin/init as init process"),
+    (11.5, "Container-based Linux system booted successfully!"),
+]
+
+
+def run(stages):
+    return {"stages": dict(stages)}
+
+
+def test_stages_from_console():
+    timer = BootTimer(start=0.0)
+    for now, line in CONSOLE:
+        timer.feed(line, now)
+    assert timer.ready
+    # The initramfs /init is the first match; the root's /sbin/init is ignored
+    assert timer.stages == {"bootloader": 0.9, "kernel": 2.5, "init": 7.25, "ready": 11.5}
+
+
+def test_partial_lines():
+    timer = BootTimer(ready_marker="login:", start=10.0)
+    # A chunk ends mid-line: the partial line is fed, then the whole line
+    timer.feed("[    0.000000] Linux vers", 11.0)
+    assert timer.stages["kernel"] is None
+    timer.feed("[    0.000000] Linux version 6.1.0", 11.5)
+    timer.feed("[    0.000000] Linux version 6.1.0-10-amd64 (gcc 12)", 12.0)
+    assert timer.stages["kernel"] == 1.5
+    # A prompt without a trailing newline only ever arrives as a partial line
+    timer.feed("debian login:", 20.0)
+    assert timer.ready and timer.stages["ready"] == 10.0
+    assert timer.stages["bootloader"] is None
+
+
+def test_summarize_medians():
+    runs = [
+        run({"kernel": 2.0, "init": 5.0, "ready": None}),
+        run({"kernel": 3.0, "init": 7.0, "ready": None}),
+        run({"kernel": 1.0, "init": None, "ready": None}),
+    ]
+    assert summarize(runs) == {"kernel": 2.0, "init": 6.0, "ready": None}
+    assert summarize(runs[:2])["kernel"] == 2.5
+    assert summarize([]) == {}
+
+
+def test_qemu_command():
+    command = qemu_command("/tmp/disk.img", memory_mb=256)
+    assert command[0] == "qemu-system-x86_64"
+    assert "file=/tmp/disk.img,format=raw,snapshot=on" in command
+    assert command[command.index("-m") + 1] == "256"
+    with pytest.raises(ValueError, match="not arm64"):
+        qemu_command("/tmp/disk.img", arch="arm64")
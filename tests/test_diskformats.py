@@ -0,0 +1,160 @@
+import hashlib
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from docker2img.diskformats import FORMAT_EXTENSIONS, crc32c, data_extents, export_formats, file_sha256
+
+MB = 1024 * 1024
+SIZE = 24 * MB + 4096
+
+
+def sparse_image(path) -> bytes:
+    """A sparse raw image; returns its full contents"""
+    pieces = {
+        0: b"\xeb\x63\x90" + os.urandom(509),            # boot sector
+        3 * MB + 100: os.urandom(70000),                 # spans a cluster boundary
+        8 * MB: bytes(2 * MB),                           # written, but all zeros
+        12 * MB: os.urandom(5 * MB),                     # several chunks of data
+        SIZE - 10: b"end-marker",                        # last partial cluster
+    }
+    with open(path, "wb") as f:
+        f.truncate(SIZE)
+        for offset, data in pieces.items():
+            f.seek(offset)
+            f.write(data)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def holes_supported(path) -> bool:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return data_extents(fd, os.fstat(fd).st_size) != [(0, os.fstat(fd).st_size)]
+    finally:
+        os.close(fd)
+
+
+def test_crc32c():
+    assert crc32c(b"123456789") == 0xE3069283
+    assert crc32c(b"") == 0
+
+
+def test_data_extents(tmp_path):
+    path = tmp_path / "disk.img"
+    sparse_image(path)
+    if not holes_supported(path):
+        pytest.skip("filesystem does not report holes")
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        extents = data_extents(fd, SIZE)
+    finally:
+        os.close(fd)
+    assert extents[0][0] == 0
+    assert all(start < end for start, end in extents)
+    assert all(a[1] <= b[0] for a, b in zip(extents, extents[1:]))
+    assert extents[-1][1] == SIZE
+    # The hole between the boot sector and the data at 3MB is skipped
+    assert not any(start <= 2 * MB < end for start, end in extents)
+
+
+def test_data_extents_of_empty_and_hole_only_files(tmp_path):
+    path = tmp_path / "empty.img"
+    path.write_bytes(b"")
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        assert data_extents(fd, 0) == []
+    finally:
+        os.close(fd)
+    with open(path, "wb") as f:
+        f.truncate(4 * MB)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        assert data_extents(fd, 4 * MB) in ([], [(0, 4 * MB)])
+    finally:
+        os.close(fd)
+
+
+def test_file_sha256_hashes_holes_as_zeros(tmp_path):
+    path = tmp_path / "disk.img"
+    contents = sparse_image(path)
+    assert file_sha256(str(path)) == hashlib.sha256(contents).hexdigest()
+
+
+def export_all(tmp_path, compress=False, formats=("raw", "qcow2", "vmdk", "vhdx")):
+    raw = tmp_path / "disk.img"
+    contents = sparse_image(raw)
+    outputs = {fmt: str(tmp_path / f"out.{FORMAT_EXTENSIONS[fmt]}") for fmt in formats}
+    return contents, export_formats(str(raw), outputs, compress=compress)
+
+
+def test_export_results(tmp_path):
+    contents, results = export_all(tmp_path)
+    assert list(results) == ["raw", "qcow2", "vmdk", "vhdx"]
+    for fmt, result in results.items():
+        assert result["format"] == fmt
+        assert result["size_bytes"] == os.path.getsize(result["path"])
+        assert result["sha256"] == file_sha256(result["path"])
+    assert open(results["raw"]["path"], "rb").read() == contents
+    with open(results["qcow2"]["path"], "rb") as f:
+        assert f.read(8) == b"QFI\xfb\0\0\0\3"
+    with open(results["vmdk"]["path"], "rb") as f:
+        assert f.read(4) == b"KDMV"
+    with open(results["vhdx"]["path"], "rb") as f:
+        assert f.read(8) == b"vhdxfile"
+    # The sparse outputs skip the holes and the all-zero chunk
+    assert results["qcow2"]["size_bytes"] < 12 * MB
+
+
+def test_unknown_format(tmp_path):
+    raw = tmp_path / "disk.img"
+    raw.write_bytes(b"x")
+    with pytest.raises(ValueError, match="Unknown output format"):
+        export_formats(str(raw), {"vdi": str(tmp_path / "out.vdi")})
+
+
+def read_with_dissect(fmt, path) -> bytes:
+    from dissect.hypervisor import qcow2, vhdx, vmdk
+    fh = open(path, "rb")
+    try:
+        if fmt == "qcow2":
+            stream = qcow2.QCow2(fh).open()
+        elif fmt == "vmdk":
+            # The VMDK stream reads past a capacity that is not a multiple
+            # of its block size; sectors can be read directly
+            return vmdk.VMDK(fh).read_sectors(0, SIZE // 512)
+        else:
+            stream = vhdx.VHDX(fh)
+        stream.seek(0)
+        return stream.read(SIZE)
+    finally:
+        fh.close()
+
+
+@pytest.mark.parametrize("fmt", ["qcow2", "vmdk", "vhdx"])
+def test_formats_read_back(tmp_path, fmt):
+    pytest.importorskip("dissect.hypervisor")
+    contents, results = export_all(tmp_path, formats=(fmt,))
+    assert read_with_dissect(fmt, results[fmt]["path"]) == contents
+
+
+def test_compressed_qcow2_reads_back(tmp_path):
+    pytest.importorskip("zstandard")
+    pytest.importorskip("dissect.hypervisor")
+    contents, results = export_all(tmp_path, compress=True, formats=("qcow2",))
+    assert read_with_dissect("qcow2", results["qcow2"]["path"]) == contents
+
+
+@pytest.mark.skipif(not shutil.which("qemu-img"), reason="qemu-img not installed")
+@pytest.mark.parametrize("fmt, compress", [("qcow2", False), ("qcow2", True), ("vmdk", False), ("vhdx", False)])
+def test_qemu_img_compare(tmp_path, fmt, compress):
+    if compress:
+        pytest.importorskip("zstandard")
+    _, results = export_all(tmp_path, compress=compress, formats=(fmt,))
+    if fmt == "qcow2":
+        # Refcount and table consistency; vmdk and vhdx are not checkable
+        subprocess.run(["qemu-img", "check", results[fmt]["path"]], check=True, capture_output=True)
+    subprocess.run(["qemu-img", "compare", "-f", "raw", "-F", fmt, str(tmp_path / "disk.img"),
+                    results[fmt]["path"]], check=True, capture_output=True)
@@ -0,0 +1,97 @@
+import hashlib
+import io
+import os
+import threading
+import time
+
+import pytest
+
+from docker2img.exportstream import stream_export
+
+
+class Source(io.RawIOBase):
+    """Endless (or bounded) source that counts the chunks read from it"""
+
+    def __init__(self, limit=None, error=None):
+        self.limit = limit
+        self.error = error
+        self.reads = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if self.limit is not None and self.reads >= self.limit:
+            if self.error:
+                raise self.error
+            return b""
+        self.reads += 1
+        return bytes([self.reads % 256]) * size
+
+
+class FailingSink:
+    def __init__(self, fail_after, delay=0.0):
+        self.fail_after = fail_after
+        self.delay = delay
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        time.sleep(self.delay)
+        if self.writes > self.fail_after:
+            raise BrokenPipeError("tar -x exited")
+
+
+def reader_threads():
+    return [t for t in threading.enumerate() if t.name == "export-reader"]
+
+
+def wait_for_readers(deadline=5.0):
+    end = time.monotonic() + deadline
+    while reader_threads() and time.monotonic() < end:
+        time.sleep(0.05)
+    return reader_threads()
+
+
+def test_copies_and_hashes():
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    sink = io.BytesIO()
+    result = stream_export(io.BytesIO(data), sink, chunk_size=64 * 1024, queue_depth=2)
+    assert sink.getvalue() == data
+    assert result == {"bytes": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+
+
+def test_empty_stream():
+    sink = io.BytesIO()
+    assert stream_export(io.BytesIO(b""), sink)["bytes"] == 0
+
+
+def test_source_errors_are_raised():
+    class Broken(io.RawIOBase):
+        def read(self, size=-1):
+            raise OSError("docker export died")
+
+    with pytest.raises(OSError, match="docker export died"):
+        stream_export(Broken(), io.BytesIO())
+    assert not wait_for_readers()
+
+
+def test_failing_sink_does_not_leak_the_reader():
+    # The source outpaces the sink, so the queue is full when the sink fails
+    source = Source()
+    with pytest.raises(BrokenPipeError):
+        stream_export(source, FailingSink(fail_after=3), chunk_size=1024, queue_depth=2)
+    assert not wait_for_readers()
+    reads = source.reads
+    time.sleep(0.2)
+    assert source.reads == reads
+
+
+@pytest.mark.parametrize("error", [None, OSError("docker export died")])
+def test_failing_sink_after_the_source_ends(error):
+    # The slow sink holds the first chunk while the reader fills the queue
+    # and then has the end of stream (or its error) left to queue
+    with pytest.raises(BrokenPipeError):
+        stream_export(Source(limit=3, error=error), FailingSink(fail_after=0, delay=0.3),
+                      chunk_size=1024, queue_depth=2)
+    assert not wait_for_readers()
@@ -0,0 +1,118 @@
+import io
+import os
+
+import pytest
+
+from docker2img.fstune import (
+    DEFAULT_INODE_RATIO,
+    KERNEL_INODE_ALLOWANCE,
+    MIN_INODES,
+    _add_file,
+    _new_stats,
+    entry_count,
+    estimate_fs_bytes,
+    ext_tuning,
+    journal_args,
+    scan_tar,
+    scan_tree,
+)
+from tests.layers import layer_tar
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+
+def stats_for(files: int, size: int, directories: int = 1) -> dict:
+    stats = _new_stats()
+    for _ in range(files):
+        _add_file(stats, size)
+    stats["directories"] = directories
+    return stats
+
+
+def test_scan_tar_counts_entries():
+    tar_bytes = layer_tar([
+        ("boot", "dir", None),
+        ("boot/vmlinuz-6.1", "file", b"k" * 5000),
+        ("etc", "dir", None),
+        ("etc/a", "file", b"a"),
+        ("etc/b", "symlink", "a"),
+        ("etc/c", "hardlink", "etc/a"),
+    ])
+    stream = io.BytesIO(tar_bytes + b"\0" * 8192)
+    stats = scan_tar(stream)
+    assert (stats["files"], stats["directories"], stats["symlinks"]) == (2, 2, 2)
+    assert stats["kernels"] == 1
+    assert stats["file_bytes"] == 5001
+    assert stats["file_blocks_4k"] == 3
+    assert stats["size_histogram"] == [1, 0, 1, 0, 0]
+    assert stream.read() == b""
+
+
+def test_scan_tree(tmp_path):
+    (tmp_path / "boot").mkdir()
+    (tmp_path / "boot" / "vmlinuz-virt").write_bytes(b"k")
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "big").write_bytes(b"x" * (2 * MB))
+    os.symlink("data", tmp_path / "data-link")
+    os.symlink("big", tmp_path / "data" / "big-link")
+    os.mkfifo(tmp_path / "fifo")
+    stats = scan_tree(str(tmp_path))
+    assert (stats["files"], stats["directories"], stats["symlinks"], stats["other"]) == (2, 3, 2, 1)
+    assert stats["kernels"] == 1
+    assert stats["size_histogram"][-1] == 1
+    assert entry_count(stats) == 8
+
+
+def test_estimate_fs_bytes():
+    stats = stats_for(files=10, size=5000, directories=2)
+    assert estimate_fs_bytes(stats) == (20 + 2) * 4096 + 12 * 256
+
+
+def test_inode_floor_follows_image_size():
+    # A small tree on a large image keeps mke2fs's one inode per 16K
+    tuning = ext_tuning(stats_for(files=100, size=1000), 4 * GB, "ext4")
+    assert tuning["inodes"] == 4 * GB // DEFAULT_INODE_RATIO
+
+
+def test_many_small_files_get_enough_inodes():
+    stats = stats_for(files=200000, size=100, directories=5000)
+    tuning = ext_tuning(stats, 1 * GB, "ext4")
+    assert tuning["inodes"] >= entry_count(stats) + KERNEL_INODE_ALLOWANCE
+    assert tuning["block_size"] == 1024
+    assert tuning["inodes"] <= 1 * GB // tuning["block_size"]
+
+
+def test_large_files_on_large_images_use_sparse_ratio():
+    tuning = ext_tuning(stats_for(files=1000, size=10 * MB), 16 * GB, "ext4")
+    assert tuning["inodes"] == 16 * GB // 65536
+    # Below 8GB the default ratio stays
+    assert ext_tuning(stats_for(files=1000, size=10 * MB), 4 * GB, "ext4")["inodes"] == 4 * GB // DEFAULT_INODE_RATIO
+
+
+def test_minimum_inodes():
+    tuning = ext_tuning(stats_for(files=1, size=10 * MB), 64 * MB, "ext4", kernel_allowance=0)
+    assert tuning["inodes"] == MIN_INODES
+
+
+@pytest.mark.parametrize("fs_bytes, reserved", [(1 * GB, 0), (8 * GB, 1)])
+def test_reserved_blocks(fs_bytes, reserved):
+    tuning = ext_tuning(stats_for(files=10, size=10000), fs_bytes, "ext4")
+    assert tuning["reserved_percent"] == reserved
+    assert tuning["mkfs_args"][tuning["mkfs_args"].index("-m") + 1] == str(reserved)
+
+
+def test_journal_is_added_after_mkfs():
+    tuning = ext_tuning(stats_for(files=10, size=10000), 2 * GB, "ext4")
+    assert tuning["journal_mb"] == 32
+    assert "^has_journal" in tuning["mkfs_args"]
+    assert journal_args(tuning) == ["-O", "has_journal", "-J", "size=32"]
+    assert ext_tuning(stats_for(files=10, size=10000), 100 * GB, "ext3")["journal_mb"] == 64
+    assert ext_tuning(stats_for(files=10, size=10000), 64 * MB, "ext4")["journal_mb"] == 4
+
+
+def test_ext2_has_no_journal():
+    tuning = ext_tuning(stats_for(files=10, size=10000), 2 * GB, "ext2")
+    assert tuning["journal_mb"] == 0
+    assert "^has_journal" not in tuning["mkfs_args"]
+    assert journal_args(tuning) == []
@@ -0,0 +1,156 @@
+import gzip
+import io
+import os
+import tarfile
+
+import pytest
+
+from docker2img.initramfs import (
+    BundleModuleTree,
+    InitramfsCache,
+    InitramfsError,
+    ModuleTree,
+    build_initramfs,
+    resolve_modules,
+)
+
+VERSION = "6.1.0-test"
+KERNEL = "kernel/drivers"
+
+MODULES_DEP = f"""\
+{KERNEL}/block/virtio_blk.ko.gz: {KERNEL}/virtio/virtio_ring.ko.gz {KERNEL}/virtio/virtio.ko.gz
+{KERNEL}/virtio/virtio_pci.ko.gz: {KERNEL}/virtio/virtio_ring.ko.gz {KERNEL}/virtio/virtio.ko.gz
+{KERNEL}/virtio/virtio_ring.ko.gz: {KERNEL}/virtio/virtio.ko.gz
+{KERNEL}/virtio/virtio.ko.gz:
+kernel/fs/ext4/ext4.ko.gz: kernel/fs/jbd2/jbd2.ko.gz kernel/lib/crc16.ko.gz
+kernel/fs/jbd2/jbd2.ko.gz:
+kernel/lib/crc16.ko.gz:
+kernel/crypto/crc32c_generic.ko.gz:
+kernel/crypto/crypto-post.ko.gz:
+"""
+
+
+class FakeModules:
+    """resolve_modules only needs exists() and read()"""
+
+    def __init__(self, files):
+        self.files = files
+
+    def exists(self, path):
+        return path in self.files
+
+    def read(self, path):
+        return self.files[path]
+
+
+def tree(**extra):
+    files = {"modules.dep": MODULES_DEP.encode(), "modules.builtin": b"kernel/drivers/ata/ahci.ko\n"}
+    files.update({name.replace("_", "."): data.encode() for name, data in extra.items()})
+    return FakeModules(files)
+
+
+def names(paths):
+    return [os.path.basename(path).split(".ko")[0] for path in paths]
+
+
+def test_dependencies_come_first():
+    paths = resolve_modules(tree(), ["virtio_blk", "virtio-pci"])
+    assert names(paths) == ["virtio", "virtio_ring", "virtio_blk", "virtio_pci"]
+
+
+def test_builtin_modules_are_dropped():
+    assert resolve_modules(tree(), ["ahci", "virtio"]) == [f"{KERNEL}/virtio/virtio.ko.gz"]
+
+
+def test_unknown_modules():
+    with pytest.raises(InitramfsError, match="nvme"):
+        resolve_modules(tree(), ["nvme"])
+    assert names(resolve_modules(tree(), ["nvme", "jbd2"], strict=False)) == ["jbd2"]
+
+
+def test_softdeps_through_aliases():
+    modules = tree(
+        modules_softdep="# comment\nsoftdep ext4 pre: crc32c post: crypto-post\nsoftdep missing pre: virtio\n",
+        modules_alias="alias crc32c crc32c_generic\nalias pci:v*d* virtio_pci\nalias crypto-crc32c crc32c_generic\n",
+    )
+    paths = resolve_modules(modules, ["ext4"])
+    assert names(paths) == ["crc32c_generic", "jbd2", "crc16", "ext4", "crypto-post"]
+
+
+def test_softdeps_the_kernel_lacks_are_skipped():
+    modules = tree(modules_softdep="softdep ext4 pre: crc32c nonexistent\n")
+    assert names(resolve_modules(modules, ["ext4"])) == ["jbd2", "crc16", "ext4"]
+
+
+def test_module_tree_on_disk(tmp_path):
+    base = tmp_path / "lib" / "modules" / VERSION
+    base.mkdir(parents=True)
+    (base / "modules.dep").write_text(MODULES_DEP)
+    modules = ModuleTree(str(tmp_path), VERSION)
+    assert modules.exists("modules.dep") and not modules.exists("modules.builtin")
+    assert names(resolve_modules(modules, ["virtio_ring"])) == ["virtio", "virtio_ring"]
+
+
+def bundle(tmp_path):
+    path = tmp_path / "bundle.tar"
+    with tarfile.open(path, "w") as tar:
+        files = {"modules.dep": MODULES_DEP.encode()}
+        for line in MODULES_DEP.splitlines():
+            files[line.split(":")[0]] = gzip.compress(b"module " + line.split(":")[0].encode())
+        for name, data in files.items():
+            info = tarfile.TarInfo(f"lib/modules/{VERSION}/{name}")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return BundleModuleTree(str(path), VERSION)
+
+
+def cpio_names(data):
+    found = []
+    offset = 0
+    while True:
+        header = data[offset:offset + 110]
+        name_size = int(header[94:102], 16)
+        file_size = int(header[54:62], 16)
+        name = data[offset + 110:offset + 110 + name_size - 1].decode()
+        if name == "TRAILER!!!":
+            return found
+        found.append(name)
+        offset += 110 + name_size
+        offset += -offset % 4 + file_size
+        offset += -offset % 4
+
+
+def test_build_initramfs_from_bundle(tmp_path):
+    busybox = tmp_path / "busybox"
+    busybox.write_bytes(b"\x7fELF busybox")
+    image = build_initramfs(bundle(tmp_path), ["virtio_blk"], str(busybox), compression="none")
+    entries = cpio_names(image)
+    assert "init" in entries and "bin/busybox" in entries and "bin/insmod" in entries
+    assert [e for e in entries if e.startswith("lib/modules/")] == [
+        "lib/modules/virtio.ko", "lib/modules/virtio_ring.ko", "lib/modules/virtio_blk.ko"
+    ]
+    # Modules are stored decompressed, in load order
+    assert b"module kernel/drivers/virtio/virtio.ko.gz" in image
+    assert b"virtio.ko\nvirtio_ring.ko\nvirtio_blk.ko\n" in image
+
+
+def test_unknown_compression(tmp_path):
+    busybox = tmp_path / "busybox"
+    busybox.write_bytes(b"busybox")
+    with pytest.raises(InitramfsError, match="compression"):
+        build_initramfs(bundle(tmp_path), ["virtio"], str(busybox), compression="bzip9")
+
+
+def test_cache_reuses_images(tmp_path):
+    busybox = tmp_path / "busybox"
+    busybox.write_bytes(b"busybox")
+    modules = bundle(tmp_path)
+    cache = InitramfsCache(str(tmp_path / "cache"))
+    first = cache.get_or_build(modules, VERSION, ["virtio_blk"], str(busybox), compression="none")
+    second = cache.get_or_build(modules, VERSION, ["virtio_blk"], str(busybox), compression="none")
+    other = cache.get_or_build(modules, VERSION, ["ext4"], str(busybox), compression="none")
+    assert not first["cached"] and second["cached"] and not other["cached"]
+    assert first["path"] == second["path"] != other["path"]
+    assert sorted(os.listdir(tmp_path / "cache")) == sorted(
+        os.path.basename(p) for p in (first["path"], other["path"])
+    )
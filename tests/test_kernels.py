@@ -0,0 +1,163 @@
+import json
+import os
+import tarfile
+
+import pytest
+
+from docker2img import kernels
+from docker2img.kernels import (
+    KernelBundleError,
+    KernelBundleStore,
+    _version_key,
+    distro_family,
+    parse_os_release,
+    platform_arch,
+)
+
+
+def install_kernel(root, version, complete=True):
+    boot = root / "boot"
+    boot.mkdir(parents=True, exist_ok=True)
+    (boot / f"vmlinuz-{version}").write_bytes(b"kernel " + version.encode())
+    if complete:
+        (boot / f"initrd.img-{version}").write_bytes(b"initrd " + version.encode())
+    modules = root / "lib" / "modules" / version / "kernel" / "fs"
+    modules.mkdir(parents=True, exist_ok=True)
+    (modules / "ext4.ko").write_bytes(b"module")
+    (root / "lib" / "modules" / version / "modules.dep").write_text("kernel/fs/ext4.ko:\n")
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('ID=debian\nVERSION_ID="12"\n', "debian"),
+    ("ID=raspbian\nID_LIKE=debian\n", "debian"),
+    ("ID=pop\nID_LIKE=\"ubuntu debian\"\n", "ubuntu"),
+    ("ID=elementary\nID_LIKE=\"ubuntu debian\"\n", "ubuntu"),
+    ("ID=kali\nID_LIKE=debian\n", "debian"),
+    ("ID=alpine\n", "alpine"),
+    ("# no id\nNAME=Unknown\n", None),
+])
+def test_distro_family(text, expected):
+    assert distro_family(parse_os_release(text)) == expected
+
+
+def test_parse_os_release():
+    fields = parse_os_release("NAME='Debian GNU/Linux'\n# ID=ignored\nID=debian\nBROKEN LINE\n")
+    assert fields == {"name": "Debian GNU/Linux", "id": "debian"}
+
+
+def test_platform_arch():
+    assert platform_arch("linux/arm64/v8") == "arm64"
+    assert platform_arch("linux/amd64") == "amd64"
+    assert platform_arch("amd64") == "amd64"
+
+
+def test_version_key_orders_numerically():
+    versions = ["6.1.0-9-amd64", "6.1.0-10-amd64", "5.15.0-100-generic"]
+    assert max(versions) == "6.1.0-9-amd64"
+    assert max(versions, key=_version_key) == "6.1.0-10-amd64"
+    assert sorted(versions + ["6.10.0-1-amd64"], key=_version_key) == [
+        "5.15.0-100-generic", "6.1.0-9-amd64", "6.1.0-10-amd64", "6.10.0-1-amd64"
+    ]
+
+
+def test_add_from_root_picks_newest_version(tmp_path):
+    root = tmp_path / "root"
+    for version in ("6.1.0-9-amd64", "6.1.0-10-amd64"):
+        install_kernel(root, version)
+    # Newer, but without an initrd, so not a complete kernel
+    install_kernel(root, "6.1.0-11-amd64", complete=False)
+    store = KernelBundleStore(str(tmp_path / "store"))
+    bundle = store.add_from_root(str(root), "debian", "amd64")
+    assert bundle["version"] == "6.1.0-10-amd64"
+    assert bundle["size_bytes"] == os.path.getsize(bundle["path"])
+    assert store.lookup("debian", "amd64")["version"] == "6.1.0-10-amd64"
+    assert store.lookup("debian", "arm64") is None
+    assert store.lookup("ubuntu", "amd64") is None
+
+
+def test_lookup_newest_of_stored_versions(tmp_path):
+    store = KernelBundleStore(str(tmp_path / "store"))
+    for version in ("6.1.0-9-amd64", "6.1.0-10-amd64"):
+        root = tmp_path / version
+        install_kernel(root, version)
+        store.add_from_root(str(root), "debian", "amd64")
+    # A half-written version without metadata is ignored
+    (tmp_path / "store" / "debian" / "amd64" / "6.1.0-99-amd64").mkdir()
+    assert store.lookup("debian", "amd64")["version"] == "6.1.0-10-amd64"
+    assert store.lookup("debian", "amd64", "6.1.0-9-amd64")["version"] == "6.1.0-9-amd64"
+    assert [b["version"] for b in store.list()] == ["6.1.0-9-amd64", "6.1.0-10-amd64"]
+
+
+def test_root_without_kernel(tmp_path):
+    store = KernelBundleStore(str(tmp_path / "store"))
+    (tmp_path / "root" / "etc").mkdir(parents=True)
+    assert store.add_from_root(str(tmp_path / "root"), "debian", "amd64") is None
+    assert store.list() == []
+
+
+def test_bundle_has_no_lib_directory_entries(tmp_path):
+    root = tmp_path / "root"
+    install_kernel(root, "6.1.0-10-amd64")
+    store = KernelBundleStore(str(tmp_path / "store"))
+    bundle = store.add_from_root(str(root), "debian", "amd64")
+    with tarfile.open(bundle["path"]) as tar:
+        names = {member.name: member for member in tar.getmembers()}
+    assert "lib" not in names and "lib/modules" not in names
+    assert "lib/modules/6.1.0-10-amd64/kernel/fs/ext4.ko" in names
+    assert names["vmlinuz"].issym() and names["vmlinuz"].linkname == "boot/vmlinuz-6.1.0-10-amd64"
+    assert names["initrd.img"].linkname == "boot/initrd.img-6.1.0-10-amd64"
+
+
+def test_inject_keeps_merged_usr_symlink(tmp_path):
+    source = tmp_path / "source"
+    install_kernel(source, "6.1.0-10-amd64")
+    store = KernelBundleStore(str(tmp_path / "store"))
+    bundle = store.add_from_root(str(source), "debian", "amd64")
+
+    target = tmp_path / "target"
+    (target / "usr" / "lib").mkdir(parents=True)
+    os.symlink("usr/lib", target / "lib")
+    KernelBundleStore.inject(bundle, str(target))
+    assert os.path.islink(target / "lib")
+    assert (target / "usr" / "lib" / "modules" / "6.1.0-10-amd64" / "modules.dep").exists()
+    assert os.readlink(target / "vmlinuz") == "boot/vmlinuz-6.1.0-10-amd64"
+
+
+def test_inject_failure(tmp_path):
+    bundle = {"path": str(tmp_path / "missing.tar"), "version": "6.1"}
+    with pytest.raises(KernelBundleError, match="Injecting kernel 6.1 failed"):
+        KernelBundleStore.inject(bundle, str(tmp_path))
+
+
+def test_inject_stream(tmp_path):
+    root = tmp_path / "root"
+    install_kernel(root, "6.1.0-10-amd64")
+    bundle = KernelBundleStore(str(tmp_path / "store")).add_from_root(str(root), "debian", "amd64")
+    names = []
+
+    def consume(stream):
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            names.extend(member.name for member in tar)
+
+    KernelBundleStore.inject_stream(bundle, consume)
+    assert "boot/vmlinuz-6.1.0-10-amd64" in names
+
+
+def test_concurrent_store_of_the_same_version(tmp_path, monkeypatch):
+    root = tmp_path / "root"
+    install_kernel(root, "6.1.0-10-amd64")
+    store = KernelBundleStore(str(tmp_path / "store"))
+    rename = os.rename
+
+    def racing_rename(src, dst):
+        # Another container finishes storing the version first
+        os.makedirs(dst)
+        with open(os.path.join(dst, "bundle.json"), "w") as f:
+            json.dump({"version": os.path.basename(dst), "winner": True}, f)
+        rename(src, dst)
+
+    monkeypatch.setattr(kernels.os, "rename", racing_rename)
+    bundle = store.add_from_root(str(root), "debian", "amd64")
+    assert bundle["winner"]
+    arch_dir = tmp_path / "store" / "debian" / "amd64"
+    assert os.listdir(arch_dir) == ["6.1.0-10-amd64"]
@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+from docker2img import profiles
+from docker2img.profiles import mask_units, prune_modules, remove_firmware
+
+VERSION = "6.1.0-10-amd64"
+MODULES = {
+    "kernel/fs/ext4/ext4.ko": ["kernel/fs/mbcache.ko", "kernel/drivers/misc/helper.ko"],
+    "kernel/fs/mbcache.ko": [],
+    "kernel/drivers/misc/helper.ko": [],
+    "kernel/drivers/virtio/virtio_blk.ko": [],
+    "kernel/drivers/gpu/drm/i915/i915.ko": ["kernel/drivers/gpu/drm/drm.ko"],
+    "kernel/drivers/gpu/drm/drm.ko": [],
+    "kernel/sound/core/snd.ko": [],
+}
+
+
+@pytest.fixture
+def depmod(monkeypatch):
+    calls = []
+    monkeypatch.setattr(profiles.subprocess, "run", lambda cmd, **kwargs: calls.append(cmd))
+    return calls
+
+
+def modules_tree(root):
+    modules_dir = root / "lib" / "modules" / VERSION
+    for path in MODULES:
+        (modules_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        (modules_dir / path).write_bytes(b"\0" * 100)
+    (modules_dir / "modules.dep").write_text(
+        "".join(f"{path}: {' '.join(deps)}\n" for path, deps in MODULES.items())
+    )
+    return modules_dir
+
+
+def test_prune_keeps_dependencies_of_kept_modules(tmp_path, depmod):
+    modules_dir = modules_tree(tmp_path)
+    result = prune_modules(str(tmp_path), str(modules_dir), VERSION)
+    assert result == {"removed_modules": 3, "removed_bytes": 300}
+    remaining = {
+        os.path.relpath(os.path.join(dirpath, name), modules_dir)
+        for dirpath, _, names in os.walk(modules_dir) for name in names
+    }
+    assert remaining == {
+        "modules.dep",
+        "kernel/fs/ext4/ext4.ko",
+        "kernel/fs/mbcache.ko",
+        "kernel/drivers/misc/helper.ko",
+        "kernel/drivers/virtio/virtio_blk.ko",
+    }
+    assert depmod == [["depmod", "-b", str(tmp_path), VERSION]]
+
+
+def test_prune_removes_emptied_directories(tmp_path, depmod):
+    modules_dir = modules_tree(tmp_path)
+    prune_modules(str(tmp_path), str(modules_dir), VERSION)
+    assert not (modules_dir / "kernel" / "sound").exists()
+    assert not (modules_dir / "kernel" / "drivers" / "gpu").exists()
+    assert (modules_dir / "kernel" / "drivers" / "misc").is_dir()
+
+
+def test_prune_without_removals_skips_depmod(tmp_path, depmod):
+    modules_dir = modules_tree(tmp_path)
+    result = prune_modules(str(tmp_path), str(modules_dir), VERSION, keep_prefixes=("kernel/",))
+    assert result == {"removed_modules": 0, "removed_bytes": 0}
+    assert depmod == []
+    assert prune_modules(str(tmp_path), str(tmp_path / "missing"), VERSION)["removed_modules"] == 0
+
+
+def test_mask_units_only_masks_shipped_units(tmp_path):
+    lib_units = tmp_path / "lib" / "systemd" / "system"
+    lib_units.mkdir(parents=True)
+    (lib_units / "apt-daily.timer").write_text("[Timer]\n")
+    # A unit that is itself a symlink (an alias) counts as shipped
+    os.symlink("apt-daily.timer", lib_units / "fstrim.timer")
+    etc_systemd = tmp_path / "etc" / "systemd" / "system"
+    etc_systemd.mkdir(parents=True)
+    os.symlink("/lib/systemd/system/apt-daily.timer", etc_systemd / "apt-daily.timer")
+
+    masked = mask_units(str(etc_systemd), [str(lib_units), str(tmp_path / "usr" / "lib" / "systemd" / "system")])
+    assert masked == ["apt-daily.timer", "fstrim.timer"]
+    assert os.readlink(etc_systemd / "apt-daily.timer") == "/dev/null"
+    assert os.readlink(etc_systemd / "fstrim.timer") == "/dev/null"
+    assert not os.path.lexists(etc_systemd / "man-db.timer")
+
+
+def test_mask_units_without_unit_dirs(tmp_path):
+    etc_systemd = tmp_path / "etc" / "systemd" / "system"
+    assert mask_units(str(etc_systemd), [str(tmp_path / "lib" / "systemd" / "system")]) == []
+    assert not etc_systemd.exists()
+
+
+def test_remove_firmware(tmp_path):
+    firmware = tmp_path / "lib" / "firmware"
+    (firmware / "intel").mkdir(parents=True)
+    (firmware / "intel" / "ucode.bin").write_bytes(b"\0" * 300)
+    (firmware / "regulatory.db").write_bytes(b"\0" * 20)
+    assert remove_firmware(str(firmware)) == 320
+    assert firmware.is_dir() and not os.listdir(firmware)
+    assert remove_firmware(str(tmp_path / "missing")) == 0
@@ -0,0 +1,253 @@
+import io
+import os
+import tarfile
+import urllib.request
+
+import pytest
+
+from docker2img.blobcache import BlobCache
+from docker2img.registry import (
+    RegistryError,
+    RootfsStream,
+    fetch_layers,
+    flatten_layers,
+    layer_changes,
+    parse_reference,
+    pull_image,
+    resolve_reference,
+)
+from tests.layers import extract_members, gzip_layer, layer_tar, read_member
+from tests.registry_stub import RegistryStub, simple_image
+
+
+def write_layers(tmp_path, *layers, compress=False):
+    paths = []
+    for number, layer in enumerate(layers):
+        path = tmp_path / f"layer{number}"
+        path.write_bytes(gzip_layer(layer) if compress else layer)
+        paths.append((str(path), ""))
+    return paths
+
+
+def flatten(layer_paths):
+    out = io.BytesIO()
+    stats = flatten_layers(layer_paths, out)
+    return out.getvalue(), stats
+
+
+@pytest.mark.parametrize("reference, expected", [
+    ("alpine", ("registry-1.docker.io", "library/alpine", "latest")),
+    ("docker.io/user/app:1.0", ("registry-1.docker.io", "user/app", "1.0")),
+    ("ghcr.io/org/app/sub:v2", ("ghcr.io", "org/app/sub", "v2")),
+    ("localhost:5000/app", ("localhost:5000", "app", "latest")),
+    ("localhost:5000/app@sha256:" + "a" * 64, ("localhost:5000", "app", "sha256:" + "a" * 64)),
+    ("user/app", ("registry-1.docker.io", "user/app", "latest")),
+])
+def test_parse_reference(reference, expected):
+    assert parse_reference(reference) == expected
+
+
+def test_pull_image_flattens_layers(tmp_path):
+    with RegistryStub() as stub:
+        pushed = simple_image(stub)
+        image = pull_image(f"{stub.registry}/app:latest", str(tmp_path / "blobs"))
+
+    assert image["digest"] == pushed["digest"]
+    assert image["index_digest"] is None
+    assert [layer["digest"] for layer in image["layers"]] == pushed["layers"]
+    rootfs, stats = flatten(image["layer_paths"])
+    members = extract_members(rootfs)
+    assert read_member(rootfs, "etc/hostname") == b"top\n"
+    assert read_member(rootfs, "usr/bin/tool") == b"#!/bin/sh\n"
+    assert "etc/motd" not in members
+    assert not any(".wh." in name for name in members)
+    assert stats["dropped"] == 3   # Lower etc, etc/hostname and etc/motd
+
+
+def test_index_selects_platform(tmp_path):
+    with RegistryStub() as stub:
+        amd64 = stub.push_image("multi", [layer_tar([("arch", "file", b"amd64")])])
+        arm64 = stub.push_image("multi", [layer_tar([("arch", "file", b"arm64")])], platform="linux/arm64/v8")
+        index = stub.push_index("multi", {"linux/amd64": amd64["digest"], "linux/arm64/v8": arm64["digest"]},
+                                tags=("latest",))
+        _, image = resolve_reference(f"{stub.registry}/multi", platform="linux/arm64")
+        assert image["index_digest"] == index
+        assert image["digest"] == arm64["digest"]
+        assert image["config"]["architecture"] == "arm64"
+        with pytest.raises(RegistryError, match="No linux/s390x image"):
+            resolve_reference(f"{stub.registry}/multi", platform="linux/s390x")
+
+
+def test_pull_by_digest(tmp_path):
+    with RegistryStub() as stub:
+        pushed = simple_image(stub)
+        image = pull_image(f"{stub.registry}/app@{pushed['digest']}", str(tmp_path))
+    assert image["digest"] == pushed["digest"]
+
+
+def test_corrupted_blob_is_rejected(tmp_path):
+    with RegistryStub() as stub:
+        pushed = simple_image(stub)
+        stub.blobs[pushed["layers"][1]] = gzip_layer(layer_tar([("evil", "file", b"x")]))
+        with pytest.raises(RegistryError, match="digest mismatch"):
+            pull_image(f"{stub.registry}/app", str(tmp_path))
+    assert not any(name.endswith(".partial") for name in os.listdir(tmp_path))
+
+
+def test_missing_manifest(tmp_path):
+    with RegistryStub() as stub:
+        with pytest.raises(RegistryError, match="HTTP 404"):
+            pull_image(f"{stub.registry}/absent:1", str(tmp_path))
+
+
+def test_token_auth(tmp_path):
+    with RegistryStub(auth="bearer", username="user", password="secret") as stub:
+        simple_image(stub)
+        image = pull_image(f"{stub.registry}/app", str(tmp_path / "ok"), username="user", password="secret")
+        assert len(image["layer_paths"]) == 2
+        # One 401 and token fetch, then the token is reused
+        assert [path for _, path in stub.requests].count("/token?service=stub&scope=repository%3Aapp%3Apull") == 1
+
+        with pytest.raises(RegistryError, match="Token request .* HTTP 401"):
+            pull_image(f"{stub.registry}/app", str(tmp_path / "bad"), username="user", password="wrong")
+
+
+def test_anonymous_token_auth(tmp_path):
+    with RegistryStub(auth="bearer") as stub:
+        simple_image(stub)
+        image = pull_image(f"{stub.registry}/app", str(tmp_path))
+    assert len(image["layer_paths"]) == 2
+
+
+def test_basic_auth(tmp_path):
+    with RegistryStub(auth="basic", username="user", password="secret") as stub:
+        simple_image(stub)
+        image = pull_image(f"{stub.registry}/app", str(tmp_path / "ok"), username="user", password="secret")
+        assert len(image["layer_paths"]) == 2
+        with pytest.raises(RegistryError, match="requires credentials"):
+            pull_image(f"{stub.registry}/app", str(tmp_path / "anonymous"))
+
+
+def test_blob_redirect_drops_credentials(tmp_path):
+    with RegistryStub(auth="bearer", redirect_blobs=True) as stub:
+        simple_image(stub)
+        image = pull_image(f"{stub.registry}/app", str(tmp_path))
+        assert any(path.startswith("/storage/") for _, path in stub.requests)
+    assert len(image["layer_paths"]) == 2
+
+
+def test_stub_serves_ranges():
+    with RegistryStub() as stub:
+        blob = stub.add_blob(bytes(range(256)))
+        request = urllib.request.Request(f"http://{stub.registry}/v2/app/blobs/{blob}",
+                                         headers={"Range": "bytes=10-19"})
+        with urllib.request.urlopen(request) as response:
+            assert response.status == 206
+            assert response.headers["Content-Range"] == "bytes 10-19/256"
+            assert response.read() == bytes(range(10, 20))
+
+
+def test_fetch_layers_through_cache(tmp_path):
+    cache = BlobCache(str(tmp_path / "cache"), max_bytes=1 << 30)
+    with RegistryStub() as stub:
+        simple_image(stub)
+        client, image = resolve_reference(f"{stub.registry}/app")
+        first = fetch_layers(client, image, str(tmp_path / "unused"), cache)
+        fetched = stub.blob_requests()
+        second = fetch_layers(client, image, str(tmp_path / "unused"), cache)
+        assert stub.blob_requests() == fetched
+    assert first == second
+    assert all(path.startswith(str(tmp_path / "cache")) for path, _ in first)
+    assert cache.stats["misses"] == 2 and cache.stats["hits"] == 2
+    cache.release()
+    assert not any(os.listdir(tmp_path / "cache" / "leases" / name) for name in os.listdir(tmp_path / "cache" / "leases"))
+
+
+def test_opaque_directory(tmp_path):
+    base = layer_tar([("opt", "dir", None), ("opt/old", "file", b"old"), ("opt/keep", "dir", None)])
+    top = layer_tar([("opt", "dir", None), ("opt/.wh..wh..opq", "file", b""), ("opt/new", "file", b"new")])
+    rootfs, _ = flatten(write_layers(tmp_path, base, top, compress=True))
+    assert sorted(extract_members(rootfs)) == ["opt", "opt/new"]
+
+
+def test_whiteout_of_directory_hides_children(tmp_path):
+    base = layer_tar([("var", "dir", None), ("var/cache", "dir", None), ("var/cache/a", "file", b"a")])
+    top = layer_tar([("var", "dir", None), ("var/.wh.cache", "file", b"")])
+    rootfs, _ = flatten(write_layers(tmp_path, base, top))
+    assert sorted(extract_members(rootfs)) == ["var"]
+
+
+def test_file_replacing_directory_hides_children(tmp_path):
+    base = layer_tar([("data", "dir", None), ("data/inner", "file", b"x")])
+    top = layer_tar([("data", "symlink", "/elsewhere")])
+    layers = write_layers(tmp_path, base, top)
+    rootfs, _ = flatten(layers)
+    members = extract_members(rootfs)
+    assert sorted(members) == ["data"] and members["data"].issym()
+    assert "data" in layer_changes(layers)["replaced"]
+
+
+def test_hardlink_within_layer(tmp_path):
+    layer = layer_tar([("a", "file", b"shared"), ("b", "hardlink", "a")])
+    rootfs, _ = flatten(write_layers(tmp_path, layer))
+    members = extract_members(rootfs)
+    assert members["b"].islnk() and members["b"].linkname == "a"
+
+
+def test_hardlink_to_shadowed_target(tmp_path):
+    # The upper layer replaces a; b still shares the base layer's inode
+    base = layer_tar([("a", "file", b"base"), ("b", "hardlink", "a"), ("c", "hardlink", "a")])
+    top = layer_tar([("a", "file", b"top")])
+    rootfs, stats = flatten(write_layers(tmp_path, base, top))
+    members = extract_members(rootfs)
+    assert read_member(rootfs, "a") == b"top"
+    assert members["b"].isreg() and read_member(rootfs, "b") == b"base"
+    assert members["c"].islnk() and members["c"].linkname == "b"
+    assert stats["entries"] == 3
+
+
+def test_hardlink_to_whited_out_target(tmp_path):
+    base = layer_tar([("a", "file", b"base"), ("b", "hardlink", "a")])
+    top = layer_tar([(".wh.a", "file", b"")])
+    rootfs, _ = flatten(write_layers(tmp_path, base, top))
+    members = extract_members(rootfs)
+    assert "a" not in members
+    assert members["b"].isreg() and read_member(rootfs, "b") == b"base"
+
+
+def test_shadowed_hardlink_is_dropped(tmp_path):
+    base = layer_tar([("a", "file", b"base"), ("b", "hardlink", "a")])
+    top = layer_tar([("b", "file", b"own")])
+    rootfs, _ = flatten(write_layers(tmp_path, base, top))
+    members = extract_members(rootfs)
+    assert read_member(rootfs, "a") == b"base"
+    assert members["b"].isreg() and read_member(rootfs, "b") == b"own"
+
+
+def test_layer_changes(tmp_path):
+    base = layer_tar([("etc", "dir", None), ("etc/motd", "file", b"hi"), ("opt", "dir", None)])
+    top = layer_tar([("etc/.wh.motd", "file", b""), ("opt/.wh..wh..opq", "file", b"")])
+    changes = layer_changes(write_layers(tmp_path, base, top))
+    assert changes["removed"] == {"etc/motd"}
+    assert changes["opaque"] == {"opt"}
+
+
+def test_rootfs_stream(tmp_path):
+    with RegistryStub() as stub:
+        simple_image(stub)
+        image = pull_image(f"{stub.registry}/app", str(tmp_path))
+    stream = RootfsStream(image["layer_paths"])
+    with tarfile.open(fileobj=stream.stream, mode="r|") as tar:
+        names = [member.name for member in tar]
+    stats = stream.close()
+    assert "etc/hostname" in names and "etc/motd" not in names
+    assert stats["entries"] == len(names)
+
+
+def test_rootfs_stream_reports_errors(tmp_path):
+    broken = tmp_path / "broken"
+    broken.write_bytes(b"\x1f\x8b not really gzip")
+    stream = RootfsStream([(str(broken), "")])
+    stream.stream.read()
+    with pytest.raises(RegistryError, match="Flattening layers failed"):
+        stream.close()
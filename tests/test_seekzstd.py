@@ -0,0 +1,102 @@
+import os
+import random
+import shutil
+import subprocess
+
+import pytest
+
+pytest.importorskip("zstandard")
+
+from docker2img.diskformats import export_formats
+from docker2img.seekzstd import FRAME_SIZE, SeekableZstdError, SeekableZstdReader, SeekableZstdWriter
+
+SIZE = 5 * FRAME_SIZE + 12345
+
+
+def image_bytes() -> bytes:
+    data = bytearray(SIZE)
+    rng = random.Random(7)
+    for offset in (100, FRAME_SIZE - 50, 3 * FRAME_SIZE + 1, SIZE - 1000):
+        data[offset:offset + 1000] = rng.randbytes(1000)
+    return bytes(data[:SIZE])
+
+
+def write_image(path, data: bytes, pieces=None, threads=2) -> None:
+    writer = SeekableZstdWriter(str(path), len(data), level=1, threads=threads)
+    for start, end in pieces or [(0, len(data))]:
+        writer.write(start, data[start:end])
+    writer.close()
+
+
+def test_random_reads(tmp_path):
+    data = image_bytes()
+    path = tmp_path / "disk.img.zst"
+    # Data with gaps (holes) between writes, which become zero frames
+    write_image(path, data, pieces=[(0, 2000), (FRAME_SIZE - 100, FRAME_SIZE + 2000),
+                                    (3 * FRAME_SIZE, 3 * FRAME_SIZE + 2000), (SIZE - 1000, SIZE)])
+    rng = random.Random(1)
+    with SeekableZstdReader(str(path)) as image:
+        assert image.size == SIZE
+        assert image.frames == 6
+        assert image.read(0, SIZE) == data
+        for _ in range(200):
+            offset = rng.randrange(SIZE)
+            length = rng.randrange(1, 3 * FRAME_SIZE)
+            assert image.read(offset, length) == data[offset:offset + length]
+        assert image.read(SIZE - 10, 100) == data[-10:]
+        assert image.read(SIZE, 10) == b""
+
+
+def test_holes_compress_away(tmp_path):
+    path = tmp_path / "zeros.img.zst"
+    write_image(path, bytes(8 * FRAME_SIZE), pieces=[])
+    assert os.path.getsize(path) < 4096
+    with SeekableZstdReader(str(path)) as image:
+        assert image.read(7 * FRAME_SIZE, 10) == bytes(10)
+
+
+def test_out_of_order_writes_are_rejected(tmp_path):
+    writer = SeekableZstdWriter(str(tmp_path / "x.zst"), FRAME_SIZE)
+    writer.write(1000, b"x")
+    with pytest.raises(ValueError):
+        writer.write(0, b"y")
+    writer.close()
+
+
+def test_export_zst(tmp_path):
+    data = image_bytes()
+    raw = tmp_path / "disk.img"
+    raw.write_bytes(data)
+    results = export_formats(str(raw), {"zst": str(tmp_path / "disk.img.zst")}, level=1)
+    with SeekableZstdReader(results["zst"]["path"]) as image:
+        assert image.read(0, SIZE) == data
+
+
+@pytest.mark.skipif(not shutil.which("zstd"), reason="zstd not installed")
+def test_plain_zstd_decompresses(tmp_path):
+    data = image_bytes()
+    path = tmp_path / "disk.img.zst"
+    write_image(path, data)
+    result = subprocess.run(["zstd", "-dc", str(path)], check=True, capture_output=True)
+    assert result.stdout == data
+
+
+def test_rejects_plain_zstd(tmp_path):
+    import zstandard
+    path = tmp_path / "plain.zst"
+    path.write_bytes(zstandard.ZstdCompressor().compress(b"x" * 10000))
+    with pytest.raises(SeekableZstdError, match="footer"):
+        SeekableZstdReader(str(path))
+    path.write_bytes(b"tiny")
+    with pytest.raises(SeekableZstdError, match="too small"):
+        SeekableZstdReader(str(path))
+
+
+def test_rejects_truncated_frames(tmp_path):
+    path = tmp_path / "disk.img.zst"
+    write_image(path, image_bytes())
+    contents = path.read_bytes()
+    # Drop the first frame but keep the seek table
+    path.write_bytes(contents[100:])
+    with pytest.raises(SeekableZstdError):
+        SeekableZstdReader(str(path))
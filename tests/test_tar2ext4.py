@@ -0,0 +1,169 @@
+import hashlib
+import io
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+
+import pytest
+
+from docker2img.tar2ext4 import BLOCK_SIZE, Ext4Writer, Ext4WriterError
+from tests.layers import layer_tar
+
+needs_e2fsprogs = pytest.mark.skipif(
+    not (shutil.which("e2fsck") and shutil.which("debugfs")), reason="e2fsprogs not installed"
+)
+
+BIG = os.urandom(3 * 1024 * 1024 + 123)
+
+
+def sample_tar() -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        def add(name, kind=tarfile.REGTYPE, data=b"", **fields):
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            info.mode = fields.pop("mode", 0o755 if kind == tarfile.DIRTYPE else 0o644)
+            info.mtime = 1700000000
+            for key, value in fields.items():
+                setattr(info, key, value)
+            info.size = len(data) if kind == tarfile.REGTYPE else 0
+            tar.addfile(info, io.BytesIO(data) if kind == tarfile.REGTYPE else None)
+
+        add("etc", tarfile.DIRTYPE)
+        add("etc/hostname", data=b"box\n")
+        add("etc/empty")
+        add("bin", tarfile.DIRTYPE)
+        add("bin/sh", data=b"\x7fELF" + b"\0" * 5000, mode=0o755, uid=0, gid=0)
+        add("bin/ash", tarfile.LNKTYPE, linkname="bin/sh")
+        add("bin/short", tarfile.SYMTYPE, linkname="sh")
+        add("bin/long", tarfile.SYMTYPE, linkname="/" + "x" * 100)
+        add("home/user/big", data=BIG, uid=1000, gid=1000)
+        add("dev", tarfile.DIRTYPE)
+        add("dev/null", tarfile.CHRTYPE, devmajor=1, devminor=3, mode=0o666)
+        add("sparse-zero", data=b"\0" * (BLOCK_SIZE * 3))
+        info = tarfile.TarInfo("usr/bin/ping")
+        info.size = 4
+        info.mode = 0o755
+        info.pax_headers = {"SCHILY.xattr.security.capability": "\x01\x00\x00\x02 \x00\x00\x00"}
+        tar.addfile(info, io.BytesIO(b"ping"))
+    return buffer.getvalue()
+
+
+def debugfs(image: str, command: str) -> bytes:
+    return subprocess.run(["debugfs", "-R", command, image], check=True, capture_output=True).stdout
+
+
+def fsck(image: str) -> None:
+    result = subprocess.run(["e2fsck", "-fn", image], capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+
+
+def build(tmp_path, tar_bytes: bytes, **kwargs):
+    image = str(tmp_path / "fs.img")
+    with open(image, "wb"):
+        pass
+    writer = Ext4Writer(image, **kwargs)
+    result = writer.add_tar_stream(io.BytesIO(tar_bytes))
+    return image, writer, result
+
+
+@needs_e2fsprogs
+def test_tar_stream_round_trip(tmp_path):
+    tar_bytes = sample_tar()
+    image, writer, _ = build(tmp_path, tar_bytes, label="rootfs")
+    geometry = writer.close()
+    fsck(image)
+
+    assert os.path.getsize(image) == geometry["size_bytes"]
+    assert debugfs(image, "cat /etc/hostname") == b"box\n"
+    assert debugfs(image, "cat /etc/empty") == b""
+    assert debugfs(image, "cat /home/user/big") == BIG
+    assert debugfs(image, "cat /sparse-zero") == b"\0" * (BLOCK_SIZE * 3)
+    assert b"Fast link dest: \"sh\"" in debugfs(image, "stat /bin/short")
+    assert debugfs(image, "cat /bin/long") == b"/" + b"x" * 100
+    assert b"Links: 2" in debugfs(image, "stat /bin/ash")
+    assert b"User:  1000   Group:  1000" in debugfs(image, "stat /home/user/big")
+    assert b"security.capability" in debugfs(image, "ea_list /usr/bin/ping")
+    null = debugfs(image, "stat /dev/null")
+    assert b"Type: character special" in null and b"Device major/minor number: 01:03" in null
+    assert b"rootfs" in subprocess.run(["dumpe2fs", "-h", image], capture_output=True).stdout
+
+
+@needs_e2fsprogs
+def test_fixed_size_at_offset(tmp_path):
+    offset = 1024 * 1024
+    size = 64 * 1024 * 1024
+    image = str(tmp_path / "disk.img")
+    with open(image, "wb") as f:
+        f.truncate(offset + size)
+    with Ext4Writer(image, offset=offset, size=size, inode_ratio=16384) as writer:
+        writer.add_tar_stream(io.BytesIO(sample_tar()))
+    geometry = writer.stats
+    fsck(f"{image}?offset={offset}")
+    assert debugfs(f"{image}?offset={offset}", "cat /etc/hostname") == b"box\n"
+    assert geometry["files"] >= 5
+
+
+@needs_e2fsprogs
+def test_fixed_size_inode_count(tmp_path):
+    size = 32 * 1024 * 1024
+    image = str(tmp_path / "fs.img")
+    with open(image, "wb"):
+        pass
+    writer = Ext4Writer(image, size=size, inode_ratio=8192)
+    writer.add_tar_stream(io.BytesIO(sample_tar()))
+    geometry = writer.close()
+    fsck(image)
+    assert geometry["blocks_count"] * BLOCK_SIZE == size
+    assert geometry["inodes_count"] >= size // 8192
+
+
+def test_stream_hash_and_entries(tmp_path):
+    tar_bytes = sample_tar()
+    hasher = hashlib.sha256()
+    image = str(tmp_path / "fs.img")
+    with Ext4Writer(image) as writer:
+        result = writer.add_tar_stream(io.BytesIO(tar_bytes), hasher=hasher)
+        assert writer.read_file("bin/ash") == writer.read_file("bin/sh")
+        assert writer.read_file("home/user/big") == BIG
+    assert hasher.hexdigest() == hashlib.sha256(tar_bytes).hexdigest()
+    assert result["bytes"] == len(tar_bytes)
+
+
+def test_namespace_editing(tmp_path):
+    image = str(tmp_path / "fs.img")
+    with Ext4Writer(image) as writer:
+        writer.add_tar_stream(io.BytesIO(layer_tar([("a", "dir", None), ("a/b", "file", b"b")])))
+        writer.add_file("a/c", b"c")
+        writer.add_symlink("link", "a/c")
+        assert writer.exists("a/b")
+        assert writer.read_file("link") == b"c"
+        assert writer.remove("a")
+        assert not writer.exists("a/b") and not writer.remove("a")
+        assert writer.exists("link") and not writer.exists("link", follow_symlinks=True)
+        with pytest.raises(Ext4WriterError):
+            writer.add_hardlink("dir-link", "lost+found")
+        with pytest.raises(Ext4WriterError):
+            writer.remove("/")
+
+
+def test_device_modes(tmp_path):
+    image = str(tmp_path / "fs.img")
+    with Ext4Writer(image) as writer:
+        writer.add_device("fifo", stat.S_IFIFO)
+        assert writer.exists("fifo")
+        assert writer.stats["devices"] == 1
+
+
+def test_rejects_unaligned_offset(tmp_path):
+    with pytest.raises(Ext4WriterError, match="not aligned"):
+        Ext4Writer(str(tmp_path / "fs.img"), offset=512)
+
+
+def test_close_twice(tmp_path):
+    writer = Ext4Writer(str(tmp_path / "fs.img"))
+    writer.close()
+    with pytest.raises(Ext4WriterError, match="already closed"):
+        writer.close()
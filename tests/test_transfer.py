@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+from docker2img.transfer import STATE_SUFFIX, ChunkChecksumError, download_image, plan_ranges, read_range
+
+MB = 1024 * 1024
+CHUNK = 4 * MB
+DATA_AT = (0, 5 * MB + 123, 40 * MB, 99 * MB)
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "src.img"
+    with open(path, "wb") as f:
+        f.truncate(100 * MB)
+        for offset in DATA_AT:
+            f.seek(offset)
+            f.write(os.urandom(300000))
+    return str(path)
+
+
+def sha256(path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def plan_for(source):
+    plan = plan_ranges(source, CHUNK)
+    plan["image"] = "src.img"
+    return plan
+
+
+def test_plan_skips_holes(source):
+    plan = plan_ranges(source, CHUNK)
+    assert plan["size"] == 100 * MB and plan["chunk_size"] == CHUNK
+    offsets = [offset for offset, _ in plan["ranges"]]
+    assert offsets == sorted(set(offsets))
+    assert all(offset % CHUNK == 0 for offset in offsets)
+    # Every data region is covered
+    for data_at in DATA_AT:
+        assert any(offset <= data_at < offset + length for offset, length in plan["ranges"])
+    if len(offsets) == 25:
+        pytest.skip("filesystem does not report holes")
+    assert len(offsets) <= 6
+    assert plan["ranges"][-1] == [96 * MB, 4 * MB]
+
+
+def test_read_range(source):
+    chunk = read_range(source, 5 * MB, 1000)
+    with open(source, "rb") as f:
+        f.seek(5 * MB)
+        expected = f.read(1000)
+    assert chunk["offset"] == 5 * MB
+    assert chunk["data"] == expected
+    assert chunk["sha256"] == hashlib.sha256(expected).hexdigest()
+
+
+def test_download(source, tmp_path):
+    dest = str(tmp_path / "dst.img")
+    seen = []
+    result = download_image(plan_for(source), lambda o, l: read_range(source, o, l), dest,
+                            concurrency=4, progress=lambda done, total: seen.append((done, total)))
+    assert sha256(dest) == sha256(source)
+    assert result["resumed_ranges"] == 0 and result["retries"] == 0
+    assert seen[-1] == (result["bytes"], result["bytes"])
+    assert not os.path.exists(dest + STATE_SUFFIX)
+    # Holes in the source stay holes
+    assert os.stat(dest).st_blocks * 512 <= os.stat(source).st_blocks * 512 + result["ranges"] * CHUNK
+
+
+def test_resume_after_interruption(source, tmp_path):
+    dest = str(tmp_path / "dst.img")
+    plan = plan_for(source)
+    calls = []
+
+    def failing(offset, length):
+        calls.append(offset)
+        if offset == 40 * MB:
+            raise ConnectionError("connection reset")
+        return read_range(source, offset, length)
+
+    with pytest.raises(ConnectionError):
+        download_image(plan, failing, dest, concurrency=1)
+    with open(dest + STATE_SUFFIX) as f:
+        done = json.load(f)["done"]
+    assert "0" in done and str(40 * MB) not in done
+
+    fetched = []
+
+    def fetch(offset, length):
+        fetched.append(offset)
+        return read_range(source, offset, length)
+
+    result = download_image(plan, fetch, dest, concurrency=2)
+    assert sha256(dest) == sha256(source)
+    assert result["resumed_ranges"] == len(done)
+    assert result["resumed_bytes"] == sum(length for offset, length in plan["ranges"] if str(offset) in done)
+    assert sorted(fetched) == sorted(offset for offset, _ in plan["ranges"] if str(offset) not in done)
+
+
+def test_resume_refetches_damaged_ranges(source, tmp_path):
+    dest = str(tmp_path / "dst.img")
+    plan = plan_for(source)
+
+    def stop_at_last(offset, length):
+        if offset == plan["ranges"][-1][0]:
+            raise ConnectionError("connection reset")
+        return read_range(source, offset, length)
+
+    with pytest.raises(ConnectionError):
+        download_image(plan, stop_at_last, dest, concurrency=1)
+    with open(dest, "r+b") as f:
+        f.write(b"damaged")
+    result = download_image(plan, lambda o, l: read_range(source, o, l), dest, concurrency=1)
+    assert sha256(dest) == sha256(source)
+    assert result["resumed_ranges"] == len(plan["ranges"]) - 2
+
+
+def test_changed_source_starts_over(source, tmp_path):
+    dest = str(tmp_path / "dst.img")
+    plan = plan_for(source)
+
+    def failing(offset, length):
+        if offset == 40 * MB:
+            raise ConnectionError("connection reset")
+        return read_range(source, offset, length)
+
+    with pytest.raises(ConnectionError):
+        download_image(plan, failing, dest, concurrency=1)
+    with open(source, "r+b") as f:
+        f.write(b"changed")
+    new_plan = plan_for(source)
+    new_plan["mtime_ns"] += 1   # coarse timestamps may not move
+    result = download_image(new_plan, lambda o, l: read_range(source, o, l), dest)
+    assert result["resumed_ranges"] == 0
+    assert sha256(dest) == sha256(source)
+
+
+def test_corrupted_range_is_retried(source, tmp_path):
+    dest = str(tmp_path / "dst.img")
+    corrupted = []
+
+    def flaky(offset, length):
+        chunk = read_range(source, offset, length)
+        if offset == 40 * MB and not corrupted:
+            corrupted.append(offset)
+            chunk["data"] = b"x" + chunk["data"][1:]
+        return chunk
+
+    result = download_image(plan_for(source), flaky, dest, concurrency=4)
+    assert result["retries"] == 1
+    assert sha256(dest) == sha256(source)
+
+
+def test_persistent_corruption_fails(source, tmp_path):
+    dest = str(tmp_path / "dst.img")
+
+    def broken(offset, length):
+        chunk = read_range(source, offset, length)
+        if offset == 40 * MB:
+            chunk["data"] = chunk["data"][:-1]
+        return chunk
+
+    with pytest.raises(ChunkChecksumError, match=str(40 * MB)):
+        download_image(plan_for(source), broken, dest, concurrency=2)
+    assert os.path.exists(dest + STATE_SUFFIX)